@@ -4,24 +4,126 @@ Handles intelligent customer support responses
 """
 
 import os
+import json
+import time
 import logging
-from typing import Dict, List, Tuple, Optional
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Tuple, Optional
 import httpx
 from dotenv import load_dotenv
 from constants import (
-    AI_MODEL_DEFAULT,
-    AI_CONFIDENCE_THRESHOLD,
     AI_MAX_CONTEXT_MESSAGES,
+    AI_CONTEXT_TOKEN_BUDGET,
+    AI_CONTEXT_FOLD_TARGET,
+    AI_CONTEXT_SUMMARY_MAX_TOKENS,
+    AI_TICKET_SUMMARY_MAX_TOKENS,
+    AI_SUMMARY_TAIL_MESSAGES,
+    AI_MESSAGE_MAX_CHARS,
+    AI_CHARS_PER_TOKEN,
+    OLLAMA_KEEP_ALIVE_DEFAULT,
     SENDER_USER,
-    SENDER_AI,
-    AI_RESPONSE_TIMEOUT
+    AI_RESPONSE_TIMEOUT,
+    AI_HTTP_MAX_CONNECTIONS,
+    AI_HTTP_MAX_KEEPALIVE,
+    AI_HTTP_KEEPALIVE_EXPIRY,
+    ANSWER_CACHE_THRESHOLD,
+    ANSWER_CACHE_TTL,
+    ANSWER_CACHE_SIZE,
+    LLM_PRIORITY_FIRST_REPLY,
+    LLM_PRIORITY_REPLY,
+    LLM_PRIORITY_SUMMARY,
+    LLM_MAX_IN_FLIGHT,
+    LLM_QUEUE_SIZE
 )
+from phrase_matcher import get_matcher, PHRASES_UNCERTAINTY, PHRASES_ESCALATION
+from answer_cache import AnswerCache, DEFAULT_SEED_FILE, seed_from_file, learn_from_resolved
+from llm_scheduler import LLMScheduler, SchedulerOverloaded
+from llm_router import OllamaRouter, parse_backends
+from metrics import counter, gauge, histogram
+from tracing import span, SPAN_CLIENT
 
 # Load environment variables
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+AI_RESPONSE_SECONDS = histogram('helpdesk_ai_response_seconds', 'get_ai_response duration')
+AI_RESPONSES = counter('helpdesk_ai_responses_total', 'AI replies by source', ('source',))
+AI_GENERATIONS_IN_FLIGHT = gauge('helpdesk_ai_generations_in_flight', 'get_ai_response calls in progress')
+LLM_REQUEST_SECONDS = histogram('helpdesk_llm_request_seconds', 'LLM provider call duration', ('provider', 'call'))
+LLM_REQUEST_ERRORS = counter('helpdesk_llm_request_errors_total', 'Failed LLM provider calls', ('provider', 'call'))
+
+
+class ProviderMetrics:
+    """Request and connection counters for one LLM provider client"""
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.in_flight_peak = 0
+        self.new_connections = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        # Токены промпта: вычисленные моделью / прочитанные из кэша / записанные в кэш
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.cache_write_tokens = 0
+        self.output_tokens = 0
+
+    def record_usage(self, usage: Dict):
+        self.input_tokens += usage.get('input_tokens') or 0
+        self.cached_tokens += usage.get('cached_tokens') or 0
+        self.cache_write_tokens += usage.get('cache_write_tokens') or 0
+        self.output_tokens += usage.get('output_tokens') or 0
+
+    @asynccontextmanager
+    async def track(self, call: str = 'chat'):
+        self.requests += 1
+        self.in_flight += 1
+        self.in_flight_peak = max(self.in_flight_peak, self.in_flight)
+        started = time.perf_counter()
+        try:
+            with span(f'llm {self.provider} {call}', SPAN_CLIENT):
+                yield
+        except BaseException:
+            self.errors += 1
+            LLM_REQUEST_ERRORS.inc(self.provider, call)
+            raise
+        finally:
+            self.in_flight -= 1
+            elapsed = time.perf_counter() - started
+            self.latency_total += elapsed
+            self.latency_max = max(self.latency_max, elapsed)
+            LLM_REQUEST_SECONDS.observe(elapsed, self.provider, call)
+
+    async def on_request(self, request: httpx.Request):
+        """httpx request hook: count TCP connects through the httpcore trace extension"""
+        request.extensions['trace'] = self._trace
+
+    async def _trace(self, event_name: str, info: Dict):
+        if event_name == 'connection.connect_tcp.complete':
+            self.new_connections += 1
+
+    def to_dict(self) -> Dict:
+        prompt_total = self.input_tokens + self.cached_tokens + self.cache_write_tokens
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'in_flight_peak': self.in_flight_peak,
+            'new_connections': self.new_connections,
+            'connection_reuse_ratio': round(1 - self.new_connections / self.requests, 3) if self.requests else 0.0,
+            'latency_avg_ms': round(self.latency_total / self.requests * 1000, 2) if self.requests else 0.0,
+            'latency_max_ms': round(self.latency_max * 1000, 2),
+            'input_tokens': self.input_tokens,
+            'cached_tokens': self.cached_tokens,
+            'cache_write_tokens': self.cache_write_tokens,
+            'output_tokens': self.output_tokens,
+            'prompt_cache_ratio': round(self.cached_tokens / prompt_total, 3) if prompt_total else 0.0
+        }
+
 
 class AIService:
     """AI-powered customer support assistant using Ollama"""
@@ -29,19 +131,141 @@ class AIService:
     def __init__(self):
         """Initialize AI service with Ollama client"""
         self.ollama_url = os.getenv('OLLAMA_URL', 'http://localhost:11434')
+        # Несколько Ollama серверов с весами; по умолчанию - один OLLAMA_URL
+        self.ollama_backends = parse_backends(os.getenv('OLLAMA_URLS') or self.ollama_url)
         self.model = os.getenv('AI_MODEL', 'llama3.2:latest')
         self.use_ollama = os.getenv('USE_OLLAMA', 'true').lower() == 'true'
+        # Потоковая генерация: ответ показывается пользователю по мере генерации
+        self.streaming = os.getenv('AI_STREAMING', 'true').lower() == 'true'
+
+        # Ollama выгружает модель после простоя; keep_alive держит ее (и KV-кэш) в памяти
+        self.ollama_keep_alive = os.getenv('OLLAMA_KEEP_ALIVE', OLLAMA_KEEP_ALIVE_DEFAULT)
 
         # For future Anthropic support
         self.anthropic_key = os.getenv('ANTHROPIC_API_KEY')
 
+        # Системный промпт не меняется - строим один раз
+        self.system_prompt = self._build_system_prompt()
+
+        # Бюджет токенов истории диалога в промпте
+        self.context_budget = int(os.getenv('AI_CONTEXT_TOKEN_BUDGET', str(AI_CONTEXT_TOKEN_BUDGET)))
+
+        # Кэш ответов на типовые первые вопросы (без вызова модели)
+        self.answer_cache_enabled = os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() == 'true'
+        self.answer_cache = AnswerCache(
+            threshold=float(os.getenv('ANSWER_CACHE_THRESHOLD', str(ANSWER_CACHE_THRESHOLD))),
+            ttl=float(os.getenv('ANSWER_CACHE_TTL', str(ANSWER_CACHE_TTL))),
+            max_size=int(os.getenv('ANSWER_CACHE_SIZE', str(ANSWER_CACHE_SIZE)))
+        )
+        if self.answer_cache_enabled:
+            seed_from_file(self.answer_cache, os.getenv('ANSWER_CACHE_SEED_FILE', DEFAULT_SEED_FILE))
+
+        # Долгоживущие клиенты с keep-alive и лимитом соединений (создаются в start())
+        self.http_limits = httpx.Limits(
+            max_connections=int(os.getenv('AI_HTTP_MAX_CONNECTIONS', str(AI_HTTP_MAX_CONNECTIONS))),
+            max_keepalive_connections=int(os.getenv('AI_HTTP_MAX_KEEPALIVE', str(AI_HTTP_MAX_KEEPALIVE))),
+            keepalive_expiry=AI_HTTP_KEEPALIVE_EXPIRY
+        )
+        self._anthropic_client = None
+
+        # Не больше LLM_MAX_IN_FLIGHT запросов к модели, остальные ждут в очереди по приоритету
+        self.scheduler = LLMScheduler(
+            max_in_flight=int(os.getenv('LLM_MAX_IN_FLIGHT', str(LLM_MAX_IN_FLIGHT))),
+            max_queue=int(os.getenv('LLM_QUEUE_SIZE', str(LLM_QUEUE_SIZE)))
+        )
+        self.metrics = {
+            'ollama': ProviderMetrics('ollama'),
+            'anthropic': ProviderMetrics('anthropic')
+        }
+
+        self.ollama_router = OllamaRouter(self.ollama_backends, self.model, client_kwargs={
+            'timeout': AI_RESPONSE_TIMEOUT,
+            'limits': self.http_limits,
+            'event_hooks': {'request': [self.metrics['ollama'].on_request]}
+        })
+
         if self.use_ollama:
-            logger.info(f"AI Service initialized with Ollama | URL: {self.ollama_url} | Model: {self.model}")
+            urls = ', '.join(url for url, _ in self.ollama_backends)
+            logger.info(f"AI Service initialized with Ollama | URLs: {urls} | Model: {self.model}")
         else:
             if not self.anthropic_key:
                 raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
             logger.info(f"AI Service initialized with Anthropic | Model: {self.model}")
 
+    async def start(self):
+        """Create pooled provider clients (called from FastAPI lifespan / worker startup)"""
+        if self.use_ollama:
+            await self.ollama_router.start()
+        else:
+            self._get_anthropic_client()
+
+    async def close(self):
+        """Close provider clients and their keep-alive connections"""
+        await self.ollama_router.close()
+        if self._anthropic_client is not None:
+            await self._anthropic_client.close()
+            self._anthropic_client = None
+
+    def _get_anthropic_client(self):
+        if self._anthropic_client is None:
+            from anthropic import AsyncAnthropic
+            self._anthropic_client = AsyncAnthropic(
+                api_key=self.anthropic_key,
+                http_client=httpx.AsyncClient(
+                    timeout=AI_RESPONSE_TIMEOUT,
+                    limits=self.http_limits,
+                    event_hooks={'request': [self.metrics['anthropic'].on_request]}
+                )
+            )
+        return self._anthropic_client
+
+    def client_stats(self) -> Dict:
+        """Per-provider request/connection metrics"""
+        return {
+            'provider': 'ollama' if self.use_ollama else 'anthropic',
+            'limits': {
+                'max_connections': self.http_limits.max_connections,
+                'max_keepalive_connections': self.http_limits.max_keepalive_connections,
+                'keepalive_expiry': self.http_limits.keepalive_expiry
+            },
+            'providers': {name: metrics.to_dict() for name, metrics in self.metrics.items()},
+            'scheduler': self.scheduler.stats(),
+            'ollama_backends': self.ollama_router.stats() if self.use_ollama else None,
+            'answer_cache': self.answer_cache.stats() if self.answer_cache_enabled else None
+        }
+
+    async def warm_answer_cache(self, conn):
+        """Learn answers from recently resolved tickets (called on startup)"""
+        if not self.answer_cache_enabled:
+            return
+        learned = await learn_from_resolved(self.answer_cache, conn)
+        logger.info(f"Answer cache warmed with {learned} answers from resolved tickets")
+
+    def learn_answer(self, question: str, answer: str):
+        """Remember the answer of a ticket resolved without a manager"""
+        if self.answer_cache_enabled:
+            self.answer_cache.learn(question, answer)
+
+    def _cached_answer(self, ticket_id: int, conversation_history: List[Dict], any_turn: bool = False) -> Optional[str]:
+        """Cached answer for the first text message of a ticket (any last message if any_turn), or None"""
+        if not self.answer_cache_enabled or not conversation_history:
+            return None
+        if len(conversation_history) != 1 and not any_turn:
+            return None
+        message = conversation_history[-1]
+        if message['sender_type'] != SENDER_USER or message.get('media_type'):
+            return None
+
+        hit = self.answer_cache.lookup(message['content'])
+        if hit is None:
+            return None
+        entry, similarity = hit
+        logger.info(
+            f"Answer cache hit for ticket #{ticket_id} | {entry.source}: "
+            f"'{entry.question[:50]}' (similarity {similarity:.2f})"
+        )
+        return entry.answer
+
     def _build_system_prompt(self) -> str:
         """Build system prompt for AI assistant"""
         return """Ты — AI-ассистент службы поддержки Sulpak (крупнейшая сеть электроники и бытовой техники в Казахстане).
@@ -100,6 +324,56 @@ class AIService:
 
 Помни: твоя цель — помочь клиенту быстро и эффективно! 🚀"""
 
+    @staticmethod
+    def estimate_tokens(text: Optional[str]) -> int:
+        """Rough token count of a text (no tokenizer for local models)"""
+        if not text:
+            return 0
+        return int(len(text) / AI_CHARS_PER_TOKEN) + 1
+
+    @staticmethod
+    def _message_text(msg: Dict) -> str:
+        """Message content as sent to the model (media marker, long text shortened)"""
+        content = msg['content'] or ''
+        if len(content) > AI_MESSAGE_MAX_CHARS:
+            half = AI_MESSAGE_MAX_CHARS // 2
+            content = f"{content[:half]}\n[...]\n{content[-half:]}"
+
+        # Add media context if present
+        if msg.get('media_type'):
+            content = f"[{msg['media_type'].upper()}] {content if content else 'Фото/видео от пользователя'}"
+        return content
+
+    def split_context(self, messages: List[Dict], context_summary: Optional[str] = None) -> Tuple[List[Dict], List[Dict]]:
+        """
+        Split history into (older, recent) against the token budget
+
+        Nothing is split while the history fits. Once it does not, recent turns
+        are kept verbatim up to AI_CONTEXT_FOLD_TARGET of the budget and the rest
+        is returned for folding into the rolling summary, so the window then stays
+        unchanged for several turns.
+        """
+        budget = self.context_budget - self.estimate_tokens(context_summary)
+        sizes = [self.estimate_tokens(self._message_text(msg)) for msg in messages]
+        if sum(sizes) <= budget and len(messages) <= AI_MAX_CONTEXT_MESSAGES:
+            return [], messages
+
+        target_tokens = budget * AI_CONTEXT_FOLD_TARGET
+        target_count = int(AI_MAX_CONTEXT_MESSAGES * AI_CONTEXT_FOLD_TARGET)
+        start = len(messages)
+        used = 0
+        while start > 0:
+            size = sizes[start - 1]
+            if start < len(messages) and (used + size > target_tokens or len(messages) - start >= target_count):
+                break
+            used += size
+            start -= 1
+
+        # Окно начинается с сообщения клиента (требование формата диалога)
+        while start < len(messages) - 1 and messages[start]['sender_type'] != SENDER_USER:
+            start += 1
+        return messages[:start], messages[start:]
+
     def _build_conversation_context(self, messages: List[Dict], for_ollama: bool = True) -> List[Dict]:
         """
         Build conversation context for AI API
@@ -111,55 +385,35 @@ class AIService:
         Returns:
             List of messages in API format
         """
-        # Limit context to recent messages
-        recent_messages = messages[-AI_MAX_CONTEXT_MESSAGES:]
-
         formatted_messages = []
-        for msg in recent_messages:
+        for msg in messages:
             role = "user" if msg['sender_type'] == SENDER_USER else "assistant"
-            content = msg['content']
-
-            # Add media context if present
-            if msg.get('media_type'):
-                media_type = msg['media_type']
-                content = f"[{media_type.upper()}] {content if content else 'Фото/видео от пользователя'}"
-
             formatted_messages.append({
                 "role": role,
-                "content": content
+                "content": self._message_text(msg)
             })
 
         return formatted_messages
 
-    def _calculate_confidence(self, response: str) -> float:
+    def _calculate_confidence(self, response: str, hits: Optional[Dict[str, List[str]]] = None) -> float:
         """
         Calculate AI confidence score based on response content
 
         Args:
             response: AI-generated response text
+            hits: Phrase matcher result for the response (scanned if not given)
 
         Returns:
             Confidence score between 0 and 1
         """
+        if hits is None:
+            hits = get_matcher().scan(response)
+
         # Simple heuristic-based confidence scoring
         confidence = 1.0
 
         # Lower confidence indicators
-        uncertainty_phrases = [
-            'не уверен',
-            'не знаю',
-            'возможно',
-            'может быть',
-            'скорее всего',
-            'попробуйте',
-            'свяжитесь с',
-            'обратитесь к менеджеру'
-        ]
-
-        response_lower = response.lower()
-        for phrase in uncertainty_phrases:
-            if phrase in response_lower:
-                confidence -= 0.15
+        confidence -= 0.15 * len(hits.get(PHRASES_UNCERTAINTY, []))
 
         # Very short responses might indicate uncertainty
         if len(response) < 50:
@@ -172,47 +426,74 @@ class AIService:
 
         return max(0.1, min(1.0, confidence))
 
-    def _should_escalate(self, response: str, confidence: float) -> bool:
+    def _should_escalate(self, response: str, confidence: float, hits: Optional[Dict[str, List[str]]] = None) -> bool:
         """
         Determine if conversation should be escalated to human manager
 
         Args:
             response: AI-generated response
             confidence: AI confidence score
+            hits: Phrase matcher result for the response (scanned if not given)
 
         Returns:
             True if escalation needed
         """
         # Only escalate when user CONFIRMS they want a manager
         # and AI says it's transferring to specialist
+        if hits is None:
+            hits = get_matcher().scan(response)
 
-        # Explicit escalation confirmations (AI says this AFTER user confirms)
-        escalation_triggers = [
-            'передаю ваш запрос специалисту',
-            'передам ваш запрос специалисту',
-            'передаю специалисту',
-            'передам специалисту',
-            'передано специалисту',
-            'передаю менеджеру',
-            'передам менеджеру',
-            'передано менеджеру',
-            'специалист получил',
-            'менеджер получил'
-        ]
-
-        response_lower = response.lower()
-        for trigger in escalation_triggers:
-            if trigger in response_lower:
-                logger.info(f"Escalating due to user confirmation: {trigger}")
-                return True
+        triggers = hits.get(PHRASES_ESCALATION)
+        if triggers:
+            logger.info(f"Escalating due to user confirmation: {triggers[0]}")
+            return True
 
         return False
 
+    @staticmethod
+    def _anthropic_cached_request(system_prompt: str, messages: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """
+        System prompt and conversation with prompt-cache breakpoints
+
+        The system prompt is cached on its own; the breakpoint on the last message
+        caches the whole conversation, which the next turn of the ticket reads back
+        as its prefix.
+        """
+        system = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+        cached_messages = list(messages)
+        if cached_messages:
+            last = cached_messages[-1]
+            cached_messages[-1] = {
+                "role": last['role'],
+                "content": [{"type": "text", "text": last['content'], "cache_control": {"type": "ephemeral"}}]
+            }
+        return system, cached_messages
+
+    @staticmethod
+    def _anthropic_usage(usage) -> Dict:
+        return {
+            'input_tokens': usage.input_tokens,
+            'cached_tokens': getattr(usage, 'cache_read_input_tokens', None) or 0,
+            'cache_write_tokens': getattr(usage, 'cache_creation_input_tokens', None) or 0,
+            'output_tokens': usage.output_tokens
+        }
+
+    @staticmethod
+    def _ollama_usage(data: Dict) -> Dict:
+        # Ollama сообщает только вычисленные токены промпта; переиспользованный
+        # префикс в prompt_eval_count не входит
+        return {
+            'input_tokens': data.get('prompt_eval_count') or 0,
+            'cached_tokens': None,
+            'cache_write_tokens': None,
+            'output_tokens': data.get('eval_count') or 0
+        }
+
     async def _call_ollama(
         self,
         system_prompt: str,
         messages: List[Dict]
-    ) -> str:
+    ) -> Tuple[str, Dict]:
         """
         Call Ollama API
 
@@ -221,33 +502,32 @@ class AIService:
             messages: Conversation messages
 
         Returns:
-            AI response text
+            Tuple of (response_text, token_usage)
         """
         # Build full conversation with system prompt
         full_messages = [{"role": "system", "content": system_prompt}] + messages
 
-        async with httpx.AsyncClient(timeout=AI_RESPONSE_TIMEOUT) as client:
-            response = await client.post(
-                f"{self.ollama_url}/api/chat",
-                json={
+        async with self.metrics['ollama'].track():
+            data = await self.ollama_router.post_json(
+                "/api/chat",
+                {
                     "model": self.model,
                     "messages": full_messages,
                     "stream": False,
+                    "keep_alive": self.ollama_keep_alive,
                     "options": {
                         "temperature": 0.7,
                         "num_predict": 1024
                     }
                 }
             )
-            response.raise_for_status()
-            data = response.json()
-            return data['message']['content']
+            return data['message']['content'], self._ollama_usage(data)
 
     async def _call_anthropic(
         self,
         system_prompt: str,
         messages: List[Dict]
-    ) -> str:
+    ) -> Tuple[str, Dict]:
         """
         Call Anthropic API (for future use)
 
@@ -256,38 +536,164 @@ class AIService:
             messages: Conversation messages
 
         Returns:
-            AI response text
+            Tuple of (response_text, token_usage)
         """
-        from anthropic import AsyncAnthropic
-        client = AsyncAnthropic(api_key=self.anthropic_key)
-
-        response = await client.messages.create(
-            model=self.model,
-            max_tokens=1024,
-            system=system_prompt,
-            messages=messages,
-            temperature=0.7
-        )
+        system, cached_messages = self._anthropic_cached_request(system_prompt, messages)
+        client = self._get_anthropic_client()
+        async with self.metrics['anthropic'].track():
+            response = await client.messages.create(
+                model=self.model,
+                max_tokens=1024,
+                system=system,
+                messages=cached_messages,
+                temperature=0.7
+            )
+
+        return response.content[0].text, self._anthropic_usage(response.usage)
+
+    async def _stream_ollama(
+        self,
+        system_prompt: str,
+        messages: List[Dict],
+        usage: Dict
+    ) -> AsyncIterator[str]:
+        """
+        Stream Ollama API response (NDJSON, one chunk per line)
+
+        Args:
+            system_prompt: System prompt
+            messages: Conversation messages
+            usage: Filled with token usage from the final chunk
 
-        return response.content[0].text
+        Yields:
+            Response text chunks
+        """
+        full_messages = [{"role": "system", "content": system_prompt}] + messages
+
+        # Таймаут - на каждое чтение, а не на всю генерацию
+        async with self.metrics['ollama'].track('stream'), self.ollama_router.request() as (backend, client):
+            async with client.stream(
+                "POST",
+                "/api/chat",
+                json={
+                    "model": self.model,
+                    "messages": full_messages,
+                    "stream": True,
+                    "keep_alive": self.ollama_keep_alive,
+                    "options": {
+                        "temperature": 0.7,
+                        "num_predict": 1024
+                    }
+                }
+            ) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    if data.get('error'):
+                        raise RuntimeError(f"Ollama error: {data['error']}")
+                    chunk = data.get('message', {}).get('content', '')
+                    if chunk:
+                        yield chunk
+                    if data.get('done'):
+                        usage.update(self._ollama_usage(data))
+                        break
+
+    async def _stream_anthropic(
+        self,
+        system_prompt: str,
+        messages: List[Dict],
+        usage: Dict
+    ) -> AsyncIterator[str]:
+        """
+        Stream Anthropic API response
+
+        Args:
+            system_prompt: System prompt
+            messages: Conversation messages
+            usage: Filled with token usage of the final message
+
+        Yields:
+            Response text chunks
+        """
+        system, cached_messages = self._anthropic_cached_request(system_prompt, messages)
+        client = self._get_anthropic_client()
+        async with self.metrics['anthropic'].track('stream'):
+            async with client.messages.stream(
+                model=self.model,
+                max_tokens=1024,
+                system=system,
+                messages=cached_messages,
+                temperature=0.7
+            ) as stream:
+                async for text in stream.text_stream:
+                    yield text
+                final_message = await stream.get_final_message()
+                usage.update(self._anthropic_usage(final_message.usage))
+
+    async def _generate_streaming(
+        self,
+        system_prompt: str,
+        messages: List[Dict],
+        on_partial: Callable[[str], Awaitable[None]]
+    ) -> Tuple[str, Dict]:
+        """Consume provider stream, reporting accumulated text after every chunk"""
+        usage: Dict = {}
+        if self.use_ollama:
+            stream = self._stream_ollama(system_prompt, messages, usage)
+        else:
+            stream = self._stream_anthropic(system_prompt, messages, usage)
+
+        response_text = ""
+        async for chunk in stream:
+            response_text += chunk
+            await on_partial(response_text)
+        return response_text, usage
+
+    def _record_usage(self, ticket_id: int, usage: Dict):
+        """Aggregate token usage per provider and log it per call"""
+        provider = 'ollama' if self.use_ollama else 'anthropic'
+        self.metrics[provider].record_usage(usage)
+        logger.info(
+            f"Prompt tokens for ticket #{ticket_id} | {provider}: "
+            f"uncached={usage.get('input_tokens')}, cached={usage.get('cached_tokens')}, "
+            f"cache_write={usage.get('cache_write_tokens')}, output={usage.get('output_tokens')}"
+        )
 
     async def get_ai_response(
         self,
         ticket_id: int,
         conversation_history: List[Dict],
-        user_info: Dict
+        user_info: Dict,
+        on_partial: Optional[Callable[[str], Awaitable[None]]] = None,
+        context_summary: Optional[str] = None
     ) -> Tuple[str, float, bool]:
         """
         Generate AI response for user message
 
         Args:
             ticket_id: Ticket ID for logging
-            conversation_history: Full conversation history
+            conversation_history: Conversation history (after the summarized part)
             user_info: User information (username, user_id)
+            on_partial: Optional callback receiving the accumulated text while the
+                response is streamed (used only when streaming is enabled)
+            context_summary: Rolling summary of earlier turns that are not in
+                conversation_history
 
         Returns:
             Tuple of (response_text, confidence_score, should_escalate)
         """
+        with AI_GENERATIONS_IN_FLIGHT.track_in_progress(), AI_RESPONSE_SECONDS.time():
+            return await self._respond(ticket_id, conversation_history, on_partial, context_summary)
+
+    async def _respond(
+        self,
+        ticket_id: int,
+        conversation_history: List[Dict],
+        on_partial: Optional[Callable[[str], Awaitable[None]]],
+        context_summary: Optional[str]
+    ) -> Tuple[str, float, bool]:
         try:
             logger.info(f"Generating AI response for ticket #{ticket_id} | History: {len(conversation_history)} messages")
 
@@ -295,19 +701,40 @@ class AIService:
             for i, msg in enumerate(conversation_history):
                 logger.debug(f"  Msg {i+1}: {msg['sender_type']} - {msg['content'][:50]}...")
 
-            # Build context
-            system_prompt = self._build_system_prompt()
-            messages = self._build_conversation_context(conversation_history)
+            # Build context: history that was not folded into the summary is
+            # still kept within the budget (older turns are dropped)
+            dropped, recent_history = self.split_context(conversation_history, context_summary)
+            if dropped:
+                logger.warning(f"Context over budget for ticket #{ticket_id}: {len(dropped)} older messages dropped")
+
+            system_prompt = self.system_prompt
+            if context_summary:
+                system_prompt += f"\n\nКРАТКОЕ СОДЕРЖАНИЕ ПРЕДЫДУЩЕЙ ЧАСТИ ДИАЛОГА:\n{context_summary}"
+            messages = self._build_conversation_context(recent_history)
 
             # Call appropriate AI service
-            if self.use_ollama:
-                response_text = await self._call_ollama(system_prompt, messages)
+            cached_answer = None if context_summary else self._cached_answer(ticket_id, conversation_history)
+            if cached_answer is not None:
+                AI_RESPONSES.inc('cache')
+                response_text, usage = cached_answer, None
             else:
-                response_text = await self._call_anthropic(system_prompt, messages)
+                first_reply = len(conversation_history) == 1 and not context_summary
+                priority = LLM_PRIORITY_FIRST_REPLY if first_reply else LLM_PRIORITY_REPLY
+                try:
+                    async with self.scheduler.slot(priority):
+                        response_text, usage = await self._generate(system_prompt, messages, on_partial)
+                except SchedulerOverloaded as e:
+                    logger.warning(f"LLM overloaded, request for ticket #{ticket_id} shed: {e}")
+                    AI_RESPONSES.inc('overload')
+                    return self._overload_response(ticket_id, conversation_history)
+                AI_RESPONSES.inc('model')
+            if usage is not None:
+                self._record_usage(ticket_id, usage)
 
             # Calculate confidence and escalation
-            confidence = self._calculate_confidence(response_text)
-            should_escalate = self._should_escalate(response_text, confidence)
+            hits = get_matcher().scan(response_text)
+            confidence = self._calculate_confidence(response_text, hits)
+            should_escalate = self._should_escalate(response_text, confidence, hits)
 
             logger.info(
                 f"AI response generated for ticket #{ticket_id} | "
@@ -319,6 +746,7 @@ class AIService:
 
         except Exception as e:
             logger.error(f"Error generating AI response for ticket #{ticket_id}: {e}", exc_info=True)
+            AI_RESPONSES.inc('error')
             # Fallback response on error
             fallback_response = (
                 "Извините, возникла техническая проблема. "
@@ -326,25 +754,179 @@ class AIService:
             )
             return fallback_response, 0.0, True  # Always escalate on error
 
+    async def _generate(
+        self,
+        system_prompt: str,
+        messages: List[Dict],
+        on_partial: Optional[Callable[[str], Awaitable[None]]]
+    ) -> Tuple[str, Dict]:
+        if on_partial and self.streaming:
+            return await self._generate_streaming(system_prompt, messages, on_partial)
+        if self.use_ollama:
+            return await self._call_ollama(system_prompt, messages)
+        return await self._call_anthropic(system_prompt, messages)
+
+    def _overload_response(self, ticket_id: int, conversation_history: List[Dict]) -> Tuple[str, float, bool]:
+        """Answer without the model when the request was shed: cached answer or canned reply"""
+        cached_answer = self._cached_answer(ticket_id, conversation_history, any_turn=True)
+        if cached_answer is not None:
+            hits = get_matcher().scan(cached_answer)
+            confidence = self._calculate_confidence(cached_answer, hits)
+            return cached_answer, confidence, self._should_escalate(cached_answer, confidence, hits)
+
+        # Вопрос не теряется: менеджер получит тикет сразу, без ожидания таймаута модели
+        overload_response = (
+            "Извините, сейчас очень много обращений. "
+            "Я передам ваш вопрос менеджеру, который свяжется с вами в ближайшее время. 🙏"
+        )
+        return overload_response, 0.0, True
+
+    async def _complete_text(self, messages: List[Dict], max_tokens: int, temperature: float) -> str:
+        """Plain completion without the assistant system prompt (summaries, lowest priority)"""
+        async with self.scheduler.slot(LLM_PRIORITY_SUMMARY):
+            return await self._complete_text_unscheduled(messages, max_tokens, temperature)
+
+    async def _complete_text_unscheduled(self, messages: List[Dict], max_tokens: int, temperature: float) -> str:
+        if self.use_ollama:
+            async with self.metrics['ollama'].track('complete'):
+                data = await self.ollama_router.post_json(
+                    "/api/chat",
+                    {
+                        "model": self.model,
+                        "messages": messages,
+                        "stream": False,
+                        "keep_alive": self.ollama_keep_alive,
+                        "options": {
+                            "temperature": temperature,
+                            "num_predict": max_tokens
+                        }
+                    }
+                )
+            self.metrics['ollama'].record_usage(self._ollama_usage(data))
+            return data['message']['content'].strip()
+
+        client = self._get_anthropic_client()
+        async with self.metrics['anthropic'].track('complete'):
+            response = await client.messages.create(
+                model=self.model,
+                max_tokens=max_tokens,
+                messages=messages,
+                temperature=temperature
+            )
+        self.metrics['anthropic'].record_usage(self._anthropic_usage(response.usage))
+        return response.content[0].text.strip()
+
+    def _transcript(self, messages: List[Dict]) -> str:
+        return "\n\n".join(
+            f"{'Клиент' if msg['sender_type'] == SENDER_USER else 'AI'}: {self._message_text(msg)}"
+            for msg in messages
+        )
+
+    async def _fold_summary(
+        self,
+        previous_summary: Optional[str],
+        messages: List[Dict],
+        instructions: str,
+        max_tokens: int
+    ) -> Optional[str]:
+        """Update a stored summary with new messages (prompt size does not grow with the ticket)"""
+        prompt = f"""Ты ведешь краткое содержание диалога службы поддержки Sulpak.
+
+Текущее краткое содержание:
+{previous_summary or '(пока пусто)'}
+
+Новые сообщения:
+{self._transcript(messages)}
+
+{instructions}"""
+
+        try:
+            with span('summary.fold', messages=len(messages)):
+                summary = await self._complete_text(
+                    [{"role": "user", "content": prompt}],
+                    max_tokens=max_tokens,
+                    temperature=0.3
+                )
+            return summary or None
+        except Exception as e:
+            logger.error(f"Error updating summary: {e}", exc_info=True)
+            return None
+
+    async def summarize_context(self, previous_summary: Optional[str], messages: List[Dict]) -> Optional[str]:
+        """
+        Fold messages that leave the context window into the rolling summary
+
+        Args:
+            previous_summary: Current summary of earlier turns (None for the first fold)
+            messages: Messages to add to the summary, oldest first
+
+        Returns:
+            Updated summary, or None if the model call failed
+        """
+        return await self._fold_summary(
+            previous_summary,
+            messages,
+            "Обнови краткое содержание с учетом новых сообщений. Сохрани важные факты: суть проблемы, "
+            "номера заказов, товары, даты, что уже предложено и о чем договорились.\n"
+            "Формат: только текст, не длиннее 8 предложений.",
+            AI_CONTEXT_SUMMARY_MAX_TOKENS
+        )
+
+    async def update_conversation_summary(self, previous_summary: Optional[str], messages: List[Dict]) -> Optional[str]:
+        """
+        Fold the latest turn into the ticket summary shown to the manager
+
+        Args:
+            previous_summary: Stored ai_summary (None before the first AI answer)
+            messages: Messages after the ones already covered by the summary
+
+        Returns:
+            Updated summary, or None if the model call failed
+        """
+        return await self._fold_summary(
+            previous_summary,
+            messages,
+            "Обнови резюме для менеджера (2-3 предложения): суть проблемы/вопроса клиента "
+            "и что уже было предложено AI.\n"
+            "Формат: только текст резюме, без заголовков.",
+            AI_TICKET_SUMMARY_MAX_TOKENS
+        )
+
+    def escalation_summary(self, stored_summary: Optional[str], new_messages: List[Dict]) -> str:
+        """
+        Summary for the escalation email without a model call
+
+        The stored summary covers the conversation up to the last background
+        update; the turns after it are appended verbatim.
+        """
+        parts = []
+        if stored_summary:
+            parts.append(stored_summary)
+        tail = new_messages[-AI_SUMMARY_TAIL_MESSAGES:]
+        if tail:
+            header = "Последние сообщения:" if stored_summary else "Сообщения клиента и ответы AI:"
+            parts.append(f"{header}\n{self._transcript(tail)}")
+        return "\n\n".join(parts) or "Резюме беседы недоступно."
+
     async def generate_conversation_summary(
         self,
         conversation_history: List[Dict]
-    ) -> str:
+    ) -> Optional[str]:
         """
-        Generate concise summary of conversation for email notification
+        Generate a fresh summary of the whole conversation
+
+        Used as a background refinement of the incrementally maintained summary
+        after escalation.
 
         Args:
             conversation_history: Full conversation history
 
         Returns:
-            Summary text in Russian
+            Summary text in Russian, or None if the model call failed
         """
         try:
             # Build conversation text
-            conversation_text = "\n\n".join([
-                f"{'Клиент' if msg['sender_type'] == SENDER_USER else 'AI'}: {msg['content']}"
-                for msg in conversation_history
-            ])
+            conversation_text = self._transcript(conversation_history)
 
             # Create summarization prompt
             summary_prompt = f"""Создай краткое резюме (2-3 предложения) этой беседы службы поддержки на русском языке:
@@ -360,41 +942,15 @@ class AIService:
 
             messages = [{"role": "user", "content": summary_prompt}]
 
-            # Call appropriate AI service
-            if self.use_ollama:
-                async with httpx.AsyncClient(timeout=AI_RESPONSE_TIMEOUT) as client:
-                    response = await client.post(
-                        f"{self.ollama_url}/api/chat",
-                        json={
-                            "model": self.model,
-                            "messages": messages,
-                            "stream": False,
-                            "options": {
-                                "temperature": 0.5,
-                                "num_predict": 512
-                            }
-                        }
-                    )
-                    response.raise_for_status()
-                    data = response.json()
-                    summary = data['message']['content'].strip()
-            else:
-                from anthropic import AsyncAnthropic
-                client = AsyncAnthropic(api_key=self.anthropic_key)
-                response = await client.messages.create(
-                    model=self.model,
-                    max_tokens=512,
-                    messages=messages,
-                    temperature=0.5
-                )
-                summary = response.content[0].text.strip()
+            with span('summary.full', messages=len(conversation_history)):
+                summary = await self._complete_text(messages, max_tokens=512, temperature=0.5)
 
             logger.info(f"Generated conversation summary: {summary[:100]}...")
             return summary
 
         except Exception as e:
             logger.error(f"Error generating summary: {e}", exc_info=True)
-            return "Не удалось сгенерировать резюме беседы."
+            return None
 
 
 # Global AI service instance
@@ -407,3 +963,9 @@ def get_ai_service() -> AIService:
     if _ai_service is None:
         _ai_service = AIService()
     return _ai_service
+
+
+async def close_ai_service():
+    """Close provider clients of the singleton if it was created"""
+    if _ai_service is not None:
+        await _ai_service.close()
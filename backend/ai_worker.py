@@ -0,0 +1,652 @@
+"""
+AI Worker - executes queued AI jobs (generation, delivery, escalation, summaries)
+Runs inside the API server process (AI_WORKERS) or standalone:
+
+    python ai_worker.py --workers 4
+"""
+
+import os
+import socket
+import signal
+import asyncio
+import logging
+import argparse
+from typing import Dict, List, Optional
+import asyncpg
+from dotenv import load_dotenv
+from constants import (
+    SENDER_USER,
+    SENDER_AI,
+    STATUS_ESCALATED,
+    JOB_GENERATE,
+    JOB_DELIVER,
+    JOB_ESCALATE,
+    JOB_SUMMARIZE,
+    JOB_NOTIFY,
+    JOB_LEARN,
+    JOB_POLL_INTERVAL,
+    JOB_HEARTBEAT_INTERVAL,
+    JOB_REAP_INTERVAL,
+    GENERATE_SUPERSEDE_CHECK,
+    AI_WORKERS_DEFAULT,
+    DB_LEASE_BUDGET
+)
+from db_pool import InstrumentedPool, create_pool
+from job_queue import (
+    claim_job, complete_job, extend_lease, release_job, fail_job, enqueue_job, fail_expired_jobs, prune_jobs
+)
+from ai_service import get_ai_service, close_ai_service
+from answer_cache import fetch_resolved_answers
+from email_service import get_email_service
+from telegram_stream import TelegramStreamSink, WEBHOOK_POST_SECONDS, get_webhook_client, close_webhook_client
+from metrics import counter, histogram, start_metrics_server
+from tracing import span, start_trace, trace_headers, start_tracing, stop_tracing, SPAN_CLIENT, TRACEPARENT_HEADER
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '3002'))
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', 'localhost')
+WEBHOOK_BASE_URL = f"http://{WEBHOOK_HOST}:{WEBHOOK_PORT}"
+
+# Полное резюме после эскалации пересчитывается в фоне (письмо уходит с накопленным)
+SUMMARY_REFINE = os.getenv('ESCALATION_SUMMARY_REFINE', 'true').lower() == 'true'
+
+
+JOB_SECONDS = histogram('helpdesk_job_seconds', 'AI job handler duration', ('kind',))
+JOB_RESULTS = counter('helpdesk_jobs_total', 'Finished AI job attempts', ('kind', 'result'))
+
+
+class JobLostError(Exception):
+    """Raised when the job lease was taken over by another worker"""
+
+
+async def _load_ticket(conn: asyncpg.Connection, ticket_id: int) -> asyncpg.Record:
+    ticket = await conn.fetchrow('SELECT * FROM tickets WHERE id = $1', ticket_id)
+    if not ticket:
+        raise ValueError(f"Ticket {ticket_id} not found")
+    return ticket
+
+
+async def _load_history(
+    conn: asyncpg.Connection,
+    ticket_id: int,
+    up_to_message_id: Optional[int] = None,
+    after_message_id: Optional[int] = None
+) -> List[Dict]:
+    """Load conversation history (optionally up to a given message / after an already summarized one)"""
+    rows = await conn.fetch(
+        '''SELECT id, sender_type, content, media_type, media_url, created_at
+           FROM messages
+           WHERE ticket_id = $1 AND ($2::int IS NULL OR id <= $2) AND ($3::int IS NULL OR id > $3)
+           ORDER BY created_at ASC, id ASC''',
+        ticket_id, up_to_message_id, after_message_id
+    )
+    history = []
+    for row in rows:
+        msg = dict(row)
+        msg['created_at'] = msg['created_at'].isoformat() if msg['created_at'] else ''
+        history.append(msg)
+    return history
+
+
+def _user_info(ticket: asyncpg.Record) -> Dict:
+    return {
+        'telegram_user_id': ticket['telegram_user_id'],
+        'telegram_username': ticket['telegram_username']
+    }
+
+
+# Генерации, устаревшие из-за нового сообщения пользователя: не начатые,
+# прерванные на ходу и готовые, но не сохраненные (новое сообщение пришло перед записью)
+supersede_stats = {'skipped': 0, 'cancelled': 0, 'discarded': 0}
+
+
+async def _has_newer_user_message(conn: asyncpg.Connection, ticket_id: int, message_id: Optional[int]) -> bool:
+    if message_id is None:
+        return False
+    return await conn.fetchval(
+        'SELECT EXISTS (SELECT 1 FROM messages WHERE ticket_id = $1 AND sender_type = $2 AND id > $3)',
+        ticket_id, SENDER_USER, message_id
+    )
+
+
+async def _run_unless_superseded(pool: InstrumentedPool, ticket_id: int, message_id: Optional[int], task: asyncio.Task) -> bool:
+    """
+    Wait for the generation task, cancelling it if the user writes again meanwhile
+    (the newer message has its own generate job). Cancelling closes the provider
+    request, so the model stops generating too.
+
+    Returns:
+        True if the generation was superseded and cancelled
+    """
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=GENERATE_SUPERSEDE_CHECK)
+            if done:
+                return False
+            async with pool.acquire('ai_worker.generate.supersede_check') as conn:
+                superseded = await _has_newer_user_message(conn, ticket_id, message_id)
+            if superseded:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                return True
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+
+
+async def _complete(conn: asyncpg.Connection, job: Dict):
+    if not await complete_job(conn, job):
+        raise JobLostError(f"Job {job['id']} lease lost")
+
+
+# Обработчики получают пул, а не соединение: соединение берется только на короткие
+# DB операции и не удерживается во время вызовов LLM, webhook и SMTP.
+
+async def handle_generate(pool: InstrumentedPool, job: Dict):
+    """Generate AI response for a user message and queue its delivery"""
+    ticket_id = job['ticket_id']
+    message_id = job['payload'].get('message_id')
+    async with pool.acquire('ai_worker.generate.load') as conn:
+        if await _has_newer_user_message(conn, ticket_id, message_id):
+            # Ответ на более позднее сообщение даст его задача (она видит всю историю)
+            supersede_stats['skipped'] += 1
+            await _complete(conn, job)
+            logger.info(f"Generation for ticket #{ticket_id} skipped: superseded by a newer message")
+            return
+        ticket = await _load_ticket(conn, ticket_id)
+        history = await _load_history(conn, ticket_id, message_id, ticket['context_summary_upto'])
+
+    ai_service = get_ai_service()
+    context_summary = ticket['context_summary']
+    older, recent = ai_service.split_context(history, context_summary)
+    if older:
+        # Ранняя часть диалога сворачивается в краткое содержание; при ошибке
+        # остается прежнее, а лишние сообщения отбросит get_ai_response
+        updated = await ai_service.summarize_context(context_summary, older)
+        if updated:
+            async with pool.acquire('ai_worker.generate.summary') as conn:
+                await conn.execute(
+                    '''UPDATE tickets SET context_summary = $1, context_summary_upto = $2, updated_at = NOW()
+                       WHERE id = $3 AND context_summary_upto IS NOT DISTINCT FROM $4''',
+                    updated, older[-1]['id'], ticket_id, ticket['context_summary_upto']
+                )
+            logger.info(f"Context of ticket #{ticket_id}: {len(older)} messages folded into summary")
+            context_summary, history = updated, recent
+
+    # Пока модель генерирует, пользователь видит ответ в Telegram (первое сообщение + правки)
+    sink = TelegramStreamSink(WEBHOOK_BASE_URL, ticket['telegram_user_id'], ticket['ticket_number'])
+
+    generation = asyncio.create_task(ai_service.get_ai_response(
+        ticket_id=ticket_id,
+        conversation_history=history,
+        user_info=_user_info(ticket),
+        on_partial=sink,
+        context_summary=context_summary
+    ))
+    if await _run_unless_superseded(pool, ticket_id, message_id, generation):
+        supersede_stats['cancelled'] += 1
+        await sink.supersede()
+        async with pool.acquire('ai_worker.generate.superseded') as conn:
+            await _complete(conn, job)
+        logger.info(f"Generation for ticket #{ticket_id} cancelled: superseded by a newer message")
+        return
+    # Первое сообщение, если оно еще отправляется, должно получить message_id до deliver
+    await sink.close()
+    ai_response, confidence, should_escalate = generation.result()
+
+    # Ответ, доставка и эскалация фиксируются атомарно вместе с завершением задачи
+    async with pool.acquire('ai_worker.generate.store') as conn:
+        async with conn.transaction():
+            # Пользователь написал, пока ответ дописывался - сохраняется только ответ на последнее
+            discarded = await _has_newer_user_message(conn, ticket_id, message_id)
+            if not discarded:
+                await _store_response(conn, ticket, sink, ai_response, confidence, should_escalate)
+            await _complete(conn, job)
+
+    if discarded:
+        supersede_stats['discarded'] += 1
+        await sink.supersede()
+        logger.info(f"Generation for ticket #{ticket_id} discarded: superseded by a newer message")
+        return
+
+    logger.info(
+        f"AI response stored for ticket {ticket['ticket_number']} | "
+        f"Confidence: {confidence:.2f} | Escalate: {should_escalate}"
+    )
+
+
+async def _store_response(
+    conn: asyncpg.Connection,
+    ticket: asyncpg.Record,
+    sink: TelegramStreamSink,
+    ai_response: str,
+    confidence: float,
+    should_escalate: bool
+):
+    """AI message + deliver job + escalate or summarize job (inside the store transaction)"""
+    ticket_id = ticket['id']
+    ai_message = await conn.fetchrow(
+        '''INSERT INTO messages (ticket_id, sender_type, sender_id, content, ai_confidence)
+           VALUES ($1, $2, $3, $4, $5) RETURNING id''',
+        ticket_id, SENDER_AI, 'ai_assistant', ai_response, confidence
+    )
+
+    # Если ответ уже показан потоково - deliver только заменит его финальным текстом
+    await enqueue_job(conn, JOB_DELIVER, ticket_id, {
+        'message_id': ai_message['id'],
+        'telegramUserId': ticket['telegram_user_id'],
+        'telegramMessageId': sink.message_id,
+        'telegramOutboxId': sink.outbox_id,
+        'message': ai_response,
+        'ticketNumber': ticket['ticket_number']
+    })
+
+    if should_escalate:
+        await enqueue_job(conn, JOB_ESCALATE, ticket_id, {
+            'message_id': ai_message['id']
+        })
+    else:
+        # Резюме для менеджера обновляется по ходу диалога, чтобы эскалация не ждала модель
+        await enqueue_job(conn, JOB_SUMMARIZE, ticket_id, {
+            'message_id': ai_message['id']
+        })
+
+
+async def handle_deliver(pool: InstrumentedPool, job: Dict):
+    """Send stored AI response to Telegram (or finalize the streamed message) through the webhook server"""
+    payload = job['payload']
+    body = {
+        "telegramUserId": payload['telegramUserId'],
+        "message": payload['message'],
+        "ticketNumber": payload['ticketNumber']
+    }
+    if payload.get('telegramMessageId'):
+        action = 'edit-message'
+        body["messageId"] = payload['telegramMessageId']
+    else:
+        action = 'send-message'
+        if payload.get('telegramOutboxId'):
+            # Первый потоковый фрагмент еще в очереди outbox: заменить его, а не отправить второе сообщение
+            body["replaceOutboxId"] = payload['telegramOutboxId']
+
+    with WEBHOOK_POST_SECONDS.time(action), span(f'webhook {action}', SPAN_CLIENT):
+        response = await get_webhook_client().post(f"{WEBHOOK_BASE_URL}/webhook/{action}", json=body, headers=trace_headers())
+        response.raise_for_status()
+        data = response.json()
+
+    if not data.get('success'):
+        raise RuntimeError(f"Webhook delivery failed: {data.get('error')}")
+
+    async with pool.acquire('ai_worker.deliver.complete') as conn:
+        await _complete(conn, job)
+    logger.info(f"AI response sent to user {payload['telegramUserId']} for ticket {payload['ticketNumber']}")
+
+
+async def handle_escalate(pool: InstrumentedPool, job: Dict):
+    """Escalate ticket with the accumulated summary and queue the manager notification"""
+    ticket_id = job['ticket_id']
+    async with pool.acquire('ai_worker.escalate.load') as conn:
+        ticket = await _load_ticket(conn, ticket_id)
+        history = await _load_history(conn, ticket_id, job['payload'].get('message_id'))
+
+    # Без вызова модели: накопленное резюме + сообщения после последнего обновления
+    summary_upto = ticket['ai_summary_upto']
+    new_messages = [msg for msg in history if summary_upto is None or msg['id'] > summary_upto]
+    summary = get_ai_service().escalation_summary(ticket['ai_summary'], new_messages)
+
+    async with pool.acquire('ai_worker.escalate.store') as conn:
+        async with conn.transaction():
+            await conn.execute(
+                '''UPDATE tickets SET status = $1, ai_summary = $2, ai_summary_upto = $3,
+                       escalated_at = NOW(), updated_at = NOW()
+                   WHERE id = $4''',
+                STATUS_ESCALATED, summary, history[-1]['id'] if history else summary_upto, ticket_id
+            )
+            # Письмо - отдельная задача: ошибка SMTP повторяется очередью, эскалация уже зафиксирована
+            await enqueue_job(conn, JOB_NOTIFY, ticket_id, {
+                'message_id': job['payload'].get('message_id'),
+                'summary': summary
+            })
+            if SUMMARY_REFINE:
+                await enqueue_job(conn, JOB_SUMMARIZE, ticket_id, {
+                    'message_id': job['payload'].get('message_id'),
+                    'full': True
+                })
+            await _complete(conn, job)
+
+    logger.info(f"Ticket {ticket['ticket_number']} escalated to manager")
+
+
+async def handle_notify(pool: InstrumentedPool, job: Dict):
+    """Email the escalated ticket to the manager; a failed send is retried by the queue"""
+    ticket_id = job['ticket_id']
+    email_service = get_email_service()
+    if not email_service.configured:
+        # Повтор не поможет, пока SMTP не настроен
+        logger.error(f"Escalation email for ticket #{ticket_id} skipped: email service not configured")
+        async with pool.acquire('ai_worker.notify.complete') as conn:
+            await _complete(conn, job)
+        return
+
+    async with pool.acquire('ai_worker.notify.load') as conn:
+        ticket = await _load_ticket(conn, ticket_id)
+        history = await _load_history(conn, ticket_id, job['payload'].get('message_id'))
+
+    sent = await email_service.send_escalation_email(
+        ticket_number=ticket['ticket_number'],
+        ticket_id=ticket_id,
+        user_info=_user_info(ticket),
+        conversation_history=history,
+        ai_summary=job['payload'].get('summary') or ticket['ai_summary']
+    )
+    if not sent:
+        raise RuntimeError(f"Escalation email for ticket {ticket['ticket_number']} not sent")
+
+    async with pool.acquire('ai_worker.notify.complete') as conn:
+        await _complete(conn, job)
+
+
+async def handle_summarize(pool: InstrumentedPool, job: Dict):
+    """Fold new messages into the ticket summary (or rebuild it after escalation)"""
+    ticket_id = job['ticket_id']
+    full = job['payload'].get('full', False)
+    async with pool.acquire('ai_worker.summarize.load') as conn:
+        ticket = await _load_ticket(conn, ticket_id)
+        after_id = None if full else ticket['ai_summary_upto']
+        history = await _load_history(conn, ticket_id, job['payload'].get('message_id'), after_id)
+
+    summary = None
+    if history:
+        ai_service = get_ai_service()
+        if full:
+            summary = await ai_service.generate_conversation_summary(history)
+        else:
+            summary = await ai_service.update_conversation_summary(ticket['ai_summary'], history)
+
+    async with pool.acquire('ai_worker.summarize.store') as conn:
+        async with conn.transaction():
+            if summary:
+                # Не затираем резюме, если его уже продвинула другая задача
+                await conn.execute(
+                    '''UPDATE tickets SET ai_summary = $1, ai_summary_upto = $2, updated_at = NOW()
+                       WHERE id = $3 AND ai_summary_upto IS NOT DISTINCT FROM $4''',
+                    summary, history[-1]['id'], ticket_id, ticket['ai_summary_upto']
+                )
+            await _complete(conn, job)
+
+
+async def handle_learn(pool: InstrumentedPool, job: Dict):
+    """
+    Add the answer of a ticket resolved without a manager to the answer cache
+
+    The cache lives in worker memory, so only the process that runs this job
+    learns right away; other worker processes pick the answer up from the
+    database on their next start (warm_answer_cache).
+    """
+    ticket_id = job['ticket_id']
+    async with pool.acquire('ai_worker.learn') as conn:
+        for question, answer in await fetch_resolved_answers(conn, ticket_id, limit=1):
+            get_ai_service().learn_answer(question, answer)
+        await _complete(conn, job)
+
+
+async def on_generate_failed(conn: asyncpg.Connection, job: Dict):
+    """Fallback: escalate ticket when AI generation permanently fails"""
+    await conn.execute(
+        '''UPDATE tickets SET status = $1, escalated_at = NOW(), updated_at = NOW()
+           WHERE id = $2''',
+        STATUS_ESCALATED, job['ticket_id']
+    )
+
+
+JOB_HANDLERS = {
+    JOB_GENERATE: handle_generate,
+    JOB_DELIVER: handle_deliver,
+    JOB_ESCALATE: handle_escalate,
+    JOB_SUMMARIZE: handle_summarize,
+    JOB_NOTIFY: handle_notify,
+    JOB_LEARN: handle_learn,
+}
+
+JOB_FAILURE_HANDLERS = {
+    JOB_GENERATE: on_generate_failed,
+}
+
+
+class AIWorker:
+    """Single queue consumer: claims one job at a time and runs its handler"""
+
+    def __init__(self, pool: InstrumentedPool, worker_id: str, poll_interval: float = JOB_POLL_INTERVAL):
+        self.pool = pool
+        self.worker_id = worker_id
+        self.poll_interval = poll_interval
+
+    async def run_once(self) -> bool:
+        """
+        Claim and execute one job
+
+        Returns:
+            True if a job was processed, False if the queue was empty
+        """
+        job = await claim_job(self.pool, self.worker_id)
+        if not job:
+            return False
+
+        handler = JOB_HANDLERS.get(job['kind'])
+        logger.info(f"[{self.worker_id}] Job #{job['id']} ({job['kind']}) attempt {job['attempts']}")
+
+        try:
+            if handler is None:
+                raise ValueError(f"Unknown job kind: {job['kind']}")
+            # Трейс запроса, поставившего задачу (traceparent в payload)
+            with JOB_SECONDS.time(job['kind']), start_trace(
+                f"job {job['kind']}", job['payload'].get(TRACEPARENT_HEADER),
+                job_id=job['id'], ticket_id=job['ticket_id'], attempt=job['attempts']
+            ):
+                await self._run_with_heartbeat(handler, job)
+            JOB_RESULTS.inc(job['kind'], 'done')
+        except asyncio.CancelledError:
+            # Остановка воркера: вернуть задачу в очередь, не дожидаясь истечения lease
+            async with self.pool.acquire('ai_worker.release') as conn:
+                await release_job(conn, job)
+            raise
+        except JobLostError as e:
+            JOB_RESULTS.inc(job['kind'], 'lost')
+            logger.warning(f"[{self.worker_id}] {e}")
+        except Exception as e:
+            JOB_RESULTS.inc(job['kind'], 'failed')
+            logger.error(f"[{self.worker_id}] Job #{job['id']} ({job['kind']}) failed: {e}", exc_info=True)
+            async with self.pool.acquire('ai_worker.fail') as conn:
+                permanently_failed = await fail_job(conn, job, str(e))
+                on_failure = JOB_FAILURE_HANDLERS.get(job['kind'])
+                if permanently_failed and on_failure:
+                    await on_failure(conn, job)
+
+        return True
+
+    async def _run_with_heartbeat(self, handler, job: Dict):
+        """
+        Run the handler while extending the job lease every JOB_HEARTBEAT_INTERVAL
+
+        A slow generation (or a wait in the LLM scheduler) must not let the lease
+        expire: another worker would re-claim the job and call the model and stream
+        to Telegram a second time. If the lease is lost anyway, the handler is stopped.
+        """
+        task = asyncio.create_task(handler(self.pool, job))
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=JOB_HEARTBEAT_INTERVAL)
+                if done:
+                    return task.result()
+                try:
+                    async with self.pool.acquire('ai_worker.heartbeat') as conn:
+                        owned = await extend_lease(conn, job)
+                except Exception as e:
+                    # Временная ошибка БД: следующая попытка через интервал, lease еще действует
+                    logger.warning(f"[{self.worker_id}] Lease heartbeat for job #{job['id']} failed: {e}")
+                    continue
+                if not owned:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    raise JobLostError(f"Job {job['id']} lease lost while running")
+        except asyncio.CancelledError:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            raise
+
+    async def run(self, stop_event: asyncio.Event):
+        """Process jobs until stop_event is set"""
+        logger.info(f"AI worker {self.worker_id} started")
+        while not stop_event.is_set():
+            try:
+                processed = await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"AI worker {self.worker_id} loop error: {e}", exc_info=True)
+                processed = False
+
+            if not processed:
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        logger.info(f"AI worker {self.worker_id} stopped")
+
+
+class WorkerPool:
+    """Group of AIWorker tasks sharing one asyncpg pool, plus queue housekeeping"""
+
+    def __init__(self, pool: InstrumentedPool, count: int):
+        self.pool = pool
+        self.count = count
+        self.stop_event = asyncio.Event()
+        self.tasks: List[asyncio.Task] = []
+        self.maintenance_tasks: List[asyncio.Task] = []
+
+    def start(self):
+        prefix = f"{socket.gethostname()}:{os.getpid()}"
+        for i in range(self.count):
+            worker = AIWorker(self.pool, f"{prefix}:{i}")
+            self.tasks.append(asyncio.create_task(worker.run(self.stop_event)))
+        self.maintenance_tasks = [
+            asyncio.create_task(self._reap_periodically()),
+            asyncio.create_task(self._prune_periodically())
+        ]
+        logger.info(f"Started {self.count} AI workers")
+
+    async def stop(self, grace_period: float = 5.0):
+        """Stop workers; jobs still running after the grace period are released back to the queue"""
+        self.stop_event.set()
+        for task in self.maintenance_tasks:
+            task.cancel()
+        await asyncio.gather(*self.maintenance_tasks, return_exceptions=True)
+        self.maintenance_tasks = []
+        if not self.tasks:
+            return
+        _, pending = await asyncio.wait(self.tasks, timeout=grace_period)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await close_webhook_client()
+
+    async def _reap_periodically(self):
+        while True:
+            try:
+                await reap_expired_jobs(self.pool)
+            except Exception as e:
+                logger.error(f"Expired job reap failed: {e}")
+            await asyncio.sleep(JOB_REAP_INTERVAL)
+
+    async def _prune_periodically(self):
+        while True:
+            try:
+                deleted = await prune_jobs(self.pool)
+                if deleted:
+                    logger.info(f"Pruned {deleted} finished AI jobs")
+            except Exception as e:
+                logger.error(f"AI job prune failed: {e}")
+            await asyncio.sleep(3600)
+
+
+async def reap_expired_jobs(pool: InstrumentedPool) -> int:
+    """Fail jobs that used up their attempts on expired leases and run their failure handlers"""
+    async with pool.acquire('ai_worker.reap') as conn:
+        async with conn.transaction():
+            jobs = await fail_expired_jobs(conn)
+            for job in jobs:
+                JOB_RESULTS.inc(job['kind'], 'failed')
+                logger.error(f"Job #{job['id']} ({job['kind']}) failed: {job['last_error']}")
+                on_failure = JOB_FAILURE_HANDLERS.get(job['kind'])
+                if on_failure:
+                    await on_failure(conn, job)
+    return len(jobs)
+
+
+async def _run_standalone(count: int):
+    pool = await create_pool(
+        lease_budget=float(os.getenv('DB_LEASE_BUDGET', str(DB_LEASE_BUDGET))),
+        user=os.getenv('DB_USER', 'postgres'),
+        password=os.getenv('DB_PASSWORD', 'postgres'),
+        database=os.getenv('DB_NAME', 'sulpak_helpdesk'),
+        host=os.getenv('DB_HOST', '127.0.0.1'),
+        port=int(os.getenv('DB_PORT', '5432')),
+        min_size=1,
+        max_size=count + 2
+    )
+
+    await start_tracing('ai_worker')
+    ai_service = get_ai_service()
+    await ai_service.start()
+    async with pool.acquire('answer_cache.warmup') as conn:
+        await ai_service.warm_answer_cache(conn)
+    workers = WorkerPool(pool, count)
+    workers.start()
+
+    # У отдельного процесса воркеров нет HTTP API - метрики на своем порту (0 - выключено)
+    metrics_port = int(os.getenv('WORKER_METRICS_PORT', '0'))
+    metrics_server = None
+    if metrics_port:
+        metrics_server = await start_metrics_server(os.getenv('METRICS_HOST', '127.0.0.1'), metrics_port)
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows: сигнал придет как KeyboardInterrupt
+            pass
+
+    try:
+        await stop.wait()
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        await workers.stop()
+        await close_ai_service()
+        await pool.close()
+        await stop_tracing()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description="Sulpak HelpDesk AI worker")
+    parser.add_argument('--workers', type=int, default=int(os.getenv('AI_WORKERS', str(AI_WORKERS_DEFAULT))))
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(_run_standalone(args.workers))
+    except KeyboardInterrupt:
+        pass
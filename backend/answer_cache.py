@@ -0,0 +1,258 @@
+"""
+Answer Cache - reuse answers to recurring FAQ questions without calling the model
+Questions are compared by cosine similarity of character trigrams of the
+normalized text. The cache is seeded from GOLDEN_QUESTIONS.md (answers that need
+no escalation) and learns from resolved tickets that the AI answered on its own.
+
+Numbers are collapsed in the similarity key, so a learned pair must not depend
+on them: questions and answers with an identifier (ANSWER_CACHE_ID_DIGITS or
+more digits in a row - order, phone, ticket numbers) are not learned.
+"""
+
+import os
+import re
+import math
+import time
+import logging
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Tuple
+import asyncpg
+from constants import (
+    SENDER_USER,
+    SENDER_AI,
+    STATUS_RESOLVED,
+    AI_CONFIDENCE_THRESHOLD,
+    ANSWER_CACHE_THRESHOLD,
+    ANSWER_CACHE_TTL,
+    ANSWER_CACHE_SIZE,
+    ANSWER_CACHE_MAX_QUERY_CHARS,
+    ANSWER_CACHE_LEARN_LIMIT,
+    ANSWER_CACHE_ID_DIGITS
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEED_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'GOLDEN_QUESTIONS.md')
+
+_NON_WORD = re.compile(r'[^\w\s]+', re.UNICODE)
+_SPACES = re.compile(r'\s+')
+_DIGITS = re.compile(r'\d+')
+_IDENTIFIER = re.compile(rf'\d{{{ANSWER_CACHE_ID_DIGITS},}}')
+
+# Вопрос, блок ответа и решение об эскалации в GOLDEN_QUESTIONS.md
+_GOLDEN_ENTRY = re.compile(
+    r'^#### ❓ "(?P<question>[^"]+)"\s*\n'
+    r'\*\*Правильный ответ AI:\*\*\s*\n```\n(?P<answer>.*?)\n```\s*\n'
+    r'\*\*Эскалация:\*\*\s*(?P<escalation>\S+)',
+    re.MULTILINE | re.DOTALL
+)
+
+
+def normalize_question(text: str) -> str:
+    """Lowercase, ё -> е, numbers collapsed, punctuation and emoji removed"""
+    text = text.lower().replace('ё', 'е')
+    text = _DIGITS.sub('0', text)
+    text = _NON_WORD.sub(' ', text)
+    return _SPACES.sub(' ', text).strip()
+
+
+def _trigrams(normalized: str) -> Tuple[Counter, float]:
+    padded = f' {normalized} '
+    grams = Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+    norm = math.sqrt(sum(count * count for count in grams.values()))
+    return grams, norm
+
+
+def _cosine(a: Tuple[Counter, float], b: Tuple[Counter, float]) -> float:
+    (grams_a, norm_a), (grams_b, norm_b) = a, b
+    if not norm_a or not norm_b:
+        return 0.0
+    if len(grams_a) > len(grams_b):
+        grams_a, grams_b = grams_b, grams_a
+    dot = sum(count * grams_b.get(gram, 0) for gram, count in grams_a.items())
+    return dot / (norm_a * norm_b)
+
+
+class CachedAnswer:
+    """One cached question/answer pair; pinned entries (golden) never expire"""
+
+    __slots__ = ('question', 'answer', 'vector', 'source', 'pinned', 'stored_at', 'hits')
+
+    def __init__(self, question: str, answer: str, source: str, pinned: bool):
+        self.question = question
+        self.answer = answer
+        self.vector = _trigrams(normalize_question(question))
+        self.source = source
+        self.pinned = pinned
+        self.stored_at = time.monotonic()
+        self.hits = 0
+
+
+class AnswerCache:
+    """
+    Similarity-keyed answer cache with TTL and LRU eviction
+
+    Only the first message of a ticket is looked up: later turns depend on the
+    conversation and always go to the model.
+    """
+
+    def __init__(
+        self,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+        ttl: float = ANSWER_CACHE_TTL,
+        max_size: int = ANSWER_CACHE_SIZE
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, CachedAnswer]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.learned = 0
+        self.not_learned = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, question: str, answer: str, source: str = 'learned', pinned: bool = False):
+        key = normalize_question(question)
+        if not key or not answer.strip():
+            return
+        existing = self._entries.get(key)
+        if existing is not None and existing.pinned and not pinned:
+            # Эталонный ответ не заменяется выученным
+            return
+
+        self._entries[key] = CachedAnswer(question, answer.strip(), source, pinned)
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            for key, entry in self._entries.items():
+                if not entry.pinned:
+                    del self._entries[key]
+                    break
+            else:
+                return
+
+    def lookup(self, question: str) -> Optional[Tuple[CachedAnswer, float]]:
+        """Best entry with similarity >= threshold, or None"""
+        if len(question) > ANSWER_CACHE_MAX_QUERY_CHARS:
+            # Длинное сообщение - конкретная ситуация, а не типовой вопрос
+            self.skipped += 1
+            return None
+
+        vector = _trigrams(normalize_question(question))
+        now = time.monotonic()
+        best_key, best_score = None, 0.0
+        for key, entry in list(self._entries.items()):
+            if not entry.pinned and now - entry.stored_at > self.ttl:
+                del self._entries[key]
+                continue
+            score = _cosine(vector, entry.vector)
+            if score > best_score:
+                best_key, best_score = key, score
+
+        if best_key is None or best_score < self.threshold:
+            self.misses += 1
+            return None
+
+        entry = self._entries[best_key]
+        self._entries.move_to_end(best_key)
+        entry.hits += 1
+        self.hits += 1
+        return entry, best_score
+
+    def learn(self, question: str, answer: str) -> bool:
+        """
+        Remember an answer that resolved a ticket without a manager
+
+        Returns:
+            False if the pair mentions an identifier and was not learned
+        """
+        if _IDENTIFIER.search(question) or _IDENTIFIER.search(answer):
+            # "Заказ 12345 не пришел" и "заказ 67890 не пришел" - один ключ, но разные ответы
+            self.not_learned += 1
+            return False
+        self.add(question, answer, source='learned')
+        self.learned += 1
+        return True
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'pinned': sum(1 for entry in self._entries.values() if entry.pinned),
+            'threshold': self.threshold,
+            'hits': self.hits,
+            'misses': self.misses,
+            'skipped': self.skipped,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'learned': self.learned,
+            'not_learned': self.not_learned
+        }
+
+
+def parse_golden_questions(text: str) -> List[Tuple[str, str]]:
+    """(question, answer) pairs from GOLDEN_QUESTIONS.md that need no escalation"""
+    pairs = []
+    for match in _GOLDEN_ENTRY.finditer(text):
+        if match.group('escalation').upper().startswith('НЕТ'):
+            pairs.append((match.group('question'), match.group('answer')))
+    return pairs
+
+
+def seed_from_file(cache: AnswerCache, path: str = DEFAULT_SEED_FILE) -> int:
+    """Load golden answers as pinned entries; returns number of entries"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            pairs = parse_golden_questions(f.read())
+    except OSError as e:
+        logger.warning(f"Answer cache seed file not loaded ({path}): {e}")
+        return 0
+
+    for question, answer in pairs:
+        cache.add(question, answer, source='golden', pinned=True)
+    logger.info(f"Answer cache seeded with {len(pairs)} golden answers")
+    return len(pairs)
+
+
+async def fetch_resolved_answers(
+    conn: asyncpg.Connection,
+    ticket_id: Optional[int] = None,
+    limit: int = ANSWER_CACHE_LEARN_LIMIT
+) -> List[Tuple[str, str]]:
+    """
+    First question and AI answer of tickets resolved by the AI alone
+    (not escalated, confident answer), most recently updated first
+    """
+    rows = await conn.fetch(
+        '''SELECT q.content AS question, a.content AS answer
+           FROM tickets t
+           JOIN LATERAL (
+               SELECT id, content FROM messages
+               WHERE ticket_id = t.id AND sender_type = $2 AND media_type IS NULL
+               ORDER BY id ASC LIMIT 1
+           ) q ON true
+           JOIN LATERAL (
+               SELECT content, ai_confidence FROM messages
+               WHERE ticket_id = t.id AND sender_type = $3 AND id > q.id
+               ORDER BY id ASC LIMIT 1
+           ) a ON true
+           WHERE ($1::int IS NULL OR t.id = $1)
+             AND t.status = $4 AND t.escalated_at IS NULL
+             AND a.ai_confidence >= $5
+           ORDER BY t.updated_at DESC
+           LIMIT $6''',
+        ticket_id, SENDER_USER, SENDER_AI, STATUS_RESOLVED, AI_CONFIDENCE_THRESHOLD, limit
+    )
+    return [(row['question'], row['answer']) for row in rows]
+
+
+async def learn_from_resolved(cache: AnswerCache, conn: asyncpg.Connection, limit: int = ANSWER_CACHE_LEARN_LIMIT) -> int:
+    """Warm the cache from recently resolved tickets; returns number of learned answers"""
+    pairs = await fetch_resolved_answers(conn, limit=limit)
+    # Старые первыми: самые свежие окажутся в конце LRU
+    return sum(cache.learn(question, answer) for question, answer in reversed(pairs))
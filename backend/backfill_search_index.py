@@ -0,0 +1,89 @@
+"""
+One-shot backfill of full-text search vectors
+(messages.search_tsv, tickets.search_tsv)
+
+New and edited rows get their vectors from the trg_messages_search_tsv and
+trg_tickets_search_tsv triggers (created by server.py on startup). Run this once
+for messages and summaries written before the triggers existed; rows that
+already have a vector are skipped, so the script can be re-run after an
+interruption:
+
+    python backfill_search_index.py [--batch-size 5000]
+"""
+import os
+import sys
+import argparse
+import psycopg2
+from dotenv import load_dotenv
+from constants import SEARCH_CONFIG
+
+load_dotenv()
+
+
+# (таблица, колонка с текстом)
+TARGETS = [
+    ('messages', 'content'),
+    ('tickets', 'ai_summary')
+]
+
+BACKFILL_SQL = """
+    UPDATE {table} SET search_tsv = to_tsvector('{config}', COALESCE({column}, ''))
+    WHERE id > %s AND id <= %s AND search_tsv IS NULL
+"""
+
+
+def backfill_table(conn, cursor, table: str, column: str, batch_size: int) -> int:
+    """Fill search_tsv in id ranges, one short transaction per batch"""
+    cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}')
+    max_id = cursor.fetchone()[0]
+    print(f'Backfill {table}.search_tsv: {max_id} ids, batch {batch_size}')
+
+    sql = BACKFILL_SQL.format(table=table, config=SEARCH_CONFIG, column=column)
+    updated = 0
+    last_id = 0
+    while last_id < max_id:
+        upper = last_id + batch_size
+        cursor.execute(sql, (last_id, upper))
+        updated += cursor.rowcount
+        conn.commit()
+        last_id = upper
+        print(f'  ...{min(last_id, max_id)}/{max_id} ({updated} updated)')
+    return updated
+
+
+def backfill(batch_size: int):
+    conn = psycopg2.connect(
+        user=os.getenv('DB_USER', 'postgres'),
+        host=os.getenv('DB_HOST', '127.0.0.1'),
+        database=os.getenv('DB_NAME', 'sulpak_helpdesk'),
+        password=os.getenv('DB_PASSWORD', 'postgres'),
+        port=int(os.getenv('DB_PORT', '5432'))
+    )
+    cursor = conn.cursor()
+
+    try:
+        results = [
+            f'{table}: {backfill_table(conn, cursor, table, column, batch_size)}'
+            for table, column in TARGETS
+        ]
+        # Планировщику нужна свежая статистика по новым значениям колонки
+        conn.autocommit = True
+        for table, _ in TARGETS:
+            cursor.execute(f'ANALYZE {table}')
+
+        print(f"\n[SUCCESS] Backfill completed: {', '.join(results)} rows updated")
+
+    except Exception as e:
+        conn.rollback()
+        print(f'[ERROR] Backfill failed: {e}')
+        sys.exit(1)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill full-text search vectors")
+    parser.add_argument('--batch-size', type=int, default=5000, help='Rows per transaction')
+    args = parser.parse_args()
+    backfill(args.batch_size)
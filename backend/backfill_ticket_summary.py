@@ -0,0 +1,86 @@
+"""
+One-shot backfill of denormalized ticket columns
+(first_message, message_count, last_message_at, last_sender_type, last_ai_confidence)
+
+New messages keep these columns up to date through the trg_messages_ticket_summary
+trigger (created by server.py on startup). Run this once for data created before
+the trigger existed, or any time to recompute them:
+
+    python backfill_ticket_summary.py [--batch-size 1000]
+"""
+import os
+import sys
+import argparse
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+BACKFILL_SQL = """
+    UPDATE tickets t SET
+        first_message = (
+            SELECT content FROM messages m
+            WHERE m.ticket_id = t.id ORDER BY m.created_at ASC, m.id ASC LIMIT 1
+        ),
+        message_count = (
+            SELECT COUNT(*) FROM messages m WHERE m.ticket_id = t.id
+        ),
+        last_message_at = (
+            SELECT MAX(m.created_at) FROM messages m WHERE m.ticket_id = t.id
+        ),
+        last_sender_type = (
+            SELECT sender_type FROM messages m
+            WHERE m.ticket_id = t.id ORDER BY m.created_at DESC, m.id DESC LIMIT 1
+        ),
+        last_ai_confidence = (
+            SELECT ai_confidence FROM messages m
+            WHERE m.ticket_id = t.id AND m.sender_type = 'ai'
+            ORDER BY m.created_at DESC, m.id DESC LIMIT 1
+        )
+    WHERE t.id > %s AND t.id <= %s
+"""
+
+
+def backfill(batch_size: int):
+    """Recompute summary columns in id ranges, one short transaction per batch"""
+    conn = psycopg2.connect(
+        user=os.getenv('DB_USER', 'postgres'),
+        host=os.getenv('DB_HOST', '127.0.0.1'),
+        database=os.getenv('DB_NAME', 'sulpak_helpdesk'),
+        password=os.getenv('DB_PASSWORD', 'postgres'),
+        port=int(os.getenv('DB_PORT', '5432'))
+    )
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM tickets')
+        max_id = cursor.fetchone()[0]
+        print(f'Backfill ticket summary columns: {max_id} ticket ids, batch {batch_size}')
+
+        updated = 0
+        last_id = 0
+        while last_id < max_id:
+            upper = last_id + batch_size
+            cursor.execute(BACKFILL_SQL, (last_id, upper))
+            updated += cursor.rowcount
+            conn.commit()
+            last_id = upper
+            print(f'  ...{min(last_id, max_id)}/{max_id} ({updated} updated)')
+
+        print(f'\n[SUCCESS] Backfill completed: {updated} tickets updated')
+
+    except Exception as e:
+        conn.rollback()
+        print(f'[ERROR] Backfill failed: {e}')
+        sys.exit(1)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill denormalized ticket summary columns")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+    backfill(args.batch_size)
@@ -0,0 +1 @@
+"""Benchmarks - load test harness and stand-ins for external services"""
@@ -0,0 +1,245 @@
+"""
+Fakes - stand-ins for Ollama, the Telegram Bot API and SMTP for load tests
+All three run inside the load driver's event loop and count what they receive,
+so a run needs neither a model, nor a bot token, nor a mail server.
+
+    FakeOllama     POST /api/chat (streaming and not), GET /api/tags; `failing` answers 503,
+                   `failing_chat` only on /api/chat
+    FakeTelegram   POST /bot<token>/sendMessage, /editMessageText, /getMe
+    SmtpSink       EHLO / AUTH / MAIL / RCPT / DATA, messages are counted and dropped
+"""
+
+import json
+import time
+import random
+import asyncio
+import logging
+from typing import Dict, Optional
+from urllib.parse import parse_qs
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+# Ответ модели; часть ответов с фразой эскалации, чтобы нагрузить путь эскалации и SMTP
+REPLY_TEXT = (
+    "Здравствуйте! Спасибо за обращение. Проверьте, пожалуйста, номер заказа в личном кабинете. "
+    "Доставка обычно занимает от одного до трех рабочих дней, статус обновляется автоматически. "
+    "Если остались вопросы, напишите, и я помогу."
+)
+ESCALATION_TEXT = "Понимаю вашу ситуацию. Передаю ваш запрос специалисту, он свяжется с вами в ближайшее время."
+
+
+async def serve_app(app: FastAPI, host: str, port: int) -> uvicorn.Server:
+    """Run an ASGI app in the current loop; returns once it accepts connections"""
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level='warning', access_log=False))
+    server.install_signal_handlers = lambda: None
+    asyncio.create_task(server.serve())
+    while not server.started:
+        if server.should_exit:
+            raise RuntimeError(f"Fake server on {host}:{port} failed to start")
+        await asyncio.sleep(0.05)
+    return server
+
+
+class FakeOllama:
+    """
+    Ollama /api/chat with a configurable time to first token and token rate
+
+    Every reply is `reply_tokens` words long; a share of `escalate_rate` replies
+    ask for a human so the escalation path (summary, SMTP) is exercised too.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        first_token_latency: float = 0.5,
+        token_rate: float = 50.0,
+        reply_tokens: int = 60,
+        escalate_rate: float = 0.0
+    ):
+        self.model = model
+        self.first_token_latency = first_token_latency
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.escalate_rate = escalate_rate
+        # Сервер "сломан": и чат, и проверка /api/tags отвечают 503
+        self.failing = False
+        # Сервер "мигает": /api/tags в порядке, а чат отвечает 503
+        self.failing_chat = False
+        self.requests = 0
+        self.streamed = 0
+        self.in_flight = 0
+        self.in_flight_peak = 0
+        self.app = FastAPI()
+        self.app.add_api_route('/api/tags', self.tags, methods=['GET'])
+        self.app.add_api_route('/api/chat', self.chat, methods=['POST'])
+
+    def _reply_words(self) -> list:
+        text = ESCALATION_TEXT if random.random() < self.escalate_rate else REPLY_TEXT
+        words = text.split()
+        # Повторяем текст до нужной длины ответа
+        return [words[i % len(words)] for i in range(max(self.reply_tokens, len(words)))]
+
+    def _final_chunk(self, prompt_tokens: int, tokens: int) -> Dict:
+        return {
+            'model': self.model,
+            'done': True,
+            'prompt_eval_count': prompt_tokens,
+            'eval_count': tokens,
+            'message': {'role': 'assistant', 'content': ''}
+        }
+
+    async def tags(self):
+        if self.failing:
+            return JSONResponse({'error': 'unavailable'}, status_code=503)
+        return {'models': [{'name': self.model, 'model': self.model}]}
+
+    async def chat(self, request: Request):
+        if self.failing or self.failing_chat:
+            self.requests += 1
+            return JSONResponse({'error': 'unavailable'}, status_code=503)
+        body = await request.json()
+        prompt_tokens = sum(len(m.get('content', '')) for m in body.get('messages', [])) // 3
+        words = self._reply_words()
+        self.requests += 1
+
+        if not body.get('stream', True):
+            self._enter()
+            try:
+                await asyncio.sleep(self.first_token_latency + len(words) / self.token_rate)
+            finally:
+                self._exit()
+            data = self._final_chunk(prompt_tokens, len(words))
+            data['message']['content'] = ' '.join(words)
+            return data
+
+        self.streamed += 1
+
+        async def chunks():
+            self._enter()
+            try:
+                await asyncio.sleep(self.first_token_latency)
+                for i, word in enumerate(words):
+                    if i:
+                        await asyncio.sleep(1 / self.token_rate)
+                    chunk = {'model': self.model, 'done': False, 'message': {'role': 'assistant', 'content': word + ' '}}
+                    yield json.dumps(chunk, ensure_ascii=False) + '\n'
+                yield json.dumps(self._final_chunk(prompt_tokens, len(words))) + '\n'
+            finally:
+                self._exit()
+
+        return StreamingResponse(chunks(), media_type='application/x-ndjson')
+
+    def _enter(self):
+        self.in_flight += 1
+        self.in_flight_peak = max(self.in_flight_peak, self.in_flight)
+
+    def _exit(self):
+        self.in_flight -= 1
+
+    def stats(self) -> Dict:
+        return {
+            'requests': self.requests,
+            'streamed': self.streamed,
+            'in_flight_peak': self.in_flight_peak
+        }
+
+
+class FakeTelegram:
+    """Bot API methods used by webhook.py; answers after `latency` seconds"""
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self.chats = set()
+        self._message_id = 0
+        self.app = FastAPI()
+        self.app.add_api_route('/bot{token}/{method}', self.method, methods=['GET', 'POST'])
+
+    @staticmethod
+    async def _params(request: Request) -> Dict:
+        raw = await request.body()
+        content_type = request.headers.get('content-type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(raw or b'{}')
+        # python-telegram-bot отправляет параметры как form-urlencoded
+        return {key: values[-1] for key, values in parse_qs(raw.decode('utf-8')).items()}
+
+    async def method(self, token: str, method: str, request: Request):
+        params = await self._params(request)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        await asyncio.sleep(self.latency)
+
+        if method == 'getMe':
+            return {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}}
+
+        chat_id = int(params.get('chat_id', 0))
+        self.chats.add(chat_id)
+        if method == 'sendMessage':
+            self._message_id += 1
+            message_id = self._message_id
+        else:
+            message_id = int(params.get('message_id', 0))
+        return {'ok': True, 'result': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text', '')
+        }}
+
+    def stats(self) -> Dict:
+        return {'calls': dict(self.calls), 'chats': len(self.chats)}
+
+
+class SmtpSink:
+    """Minimal SMTP server that accepts (and discards) every message"""
+
+    def __init__(self):
+        self.messages = 0
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str, port: int):
+        self.server = await asyncio.start_server(self._session, host, port)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def _session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        async def reply(line: str):
+            writer.write(line.encode('ascii') + b'\r\n')
+            await writer.drain()
+
+        try:
+            await reply('220 bench.local ESMTP sink')
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode('utf-8', 'replace').strip().upper()
+                if command.startswith(('EHLO', 'HELO')):
+                    writer.write(b'250-bench.local\r\n250-AUTH PLAIN LOGIN\r\n')
+                    await reply('250 SIZE 10485760')
+                elif command.startswith('AUTH'):
+                    await reply('235 2.7.0 Authentication successful')
+                elif command == 'DATA':
+                    await reply('354 End data with <CR><LF>.<CR><LF>')
+                    while (await reader.readline()) not in (b'.\r\n', b'.\n', b''):
+                        pass
+                    self.messages += 1
+                    await reply('250 OK')
+                elif command == 'QUIT':
+                    await reply('221 Bye')
+                    break
+                else:
+                    # MAIL FROM, RCPT TO, RSET, NOOP
+                    await reply('250 OK')
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def stats(self) -> Dict:
+        return {'messages': self.messages}
@@ -0,0 +1,404 @@
+"""
+Load Test - N simulated customers against server.py + webhook.py with fake dependencies
+Starts the fakes (Ollama, Telegram Bot API, SMTP) in this process, launches
+server.py and webhook.py as subprocesses pointed at them, then runs N
+concurrent users: each creates a ticket and sends follow-up messages. The
+result (latency percentiles per endpoint, throughput, DB pool saturation,
+what reached the fakes) is written as JSON so runs can be compared across
+versions.
+
+Needs PostgreSQL with an existing database (DB_NAME, default
+sulpak_helpdesk_bench; tables are created by server.py on startup).
+
+    cd backend
+    python -m benchmarks.loadtest --users 50 --followups 3
+    python -m benchmarks.loadtest --users 50 --baseline benchmarks/results/loadtest-<previous>.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import asyncio
+import logging
+import argparse
+import platform
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional
+import httpx
+from benchmarks.fakes import FakeOllama, FakeTelegram, SmtpSink, serve_app
+
+logger = logging.getLogger('loadtest')
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+
+ENDPOINT_CREATE = 'POST /tickets'
+ENDPOINT_MESSAGE = 'POST /tickets/{id}/messages'
+
+FAKE_MODEL = 'bench-model:latest'
+FAKE_TOKEN = '123456:bench-token'
+
+FIRST_MESSAGES = [
+    "Здравствуйте, заказ {n} до сих пор не доставлен, курьер не звонил",
+    "Не проходит оплата картой в приложении, заказ {n}",
+    "Купил товар по заказу {n}, он не включается, хочу оформить возврат",
+    "Приложение вылетает при оформлении заказа, пробовал переустановить"
+]
+FOLLOW_UPS = [
+    "Номер заказа {n}, оформлял на прошлой неделе",
+    "Подскажите, когда ждать ответа?",
+    "Спасибо, а можно поменять адрес доставки?",
+    "Пробовал, не помогло"
+]
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+class EndpointStats:
+    """Latencies and failures of one endpoint"""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.errors: Dict[str, int] = {}
+
+    def record(self, elapsed: float, error: Optional[str] = None):
+        if error:
+            self.errors[error] = self.errors.get(error, 0) + 1
+        else:
+            self.latencies.append(elapsed)
+
+    def to_dict(self, duration: float) -> Dict:
+        latencies = sorted(self.latencies)
+        return {
+            'count': len(latencies),
+            'errors': dict(self.errors),
+            'throughput_rps': round(len(latencies) / duration, 2) if duration else 0.0,
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0
+        }
+
+
+class PoolSampler:
+    """Polls GET /health/db-pool while the load runs"""
+
+    def __init__(self, client: httpx.AsyncClient, interval: float):
+        self.client = client
+        self.interval = interval
+        self.saturation: List[float] = []
+        self.waiting: List[int] = []
+        self.last: Optional[Dict] = None
+
+    async def run(self):
+        while True:
+            try:
+                response = await self.client.get('/health/db-pool')
+                self.last = response.json()
+                self.saturation.append(self.last['saturation'])
+                self.waiting.append(self.last['waiting'])
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                logger.warning(f"db-pool sample failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def to_dict(self) -> Dict:
+        last = self.last or {}
+        return {
+            'samples': len(self.saturation),
+            'saturation_avg': round(sum(self.saturation) / len(self.saturation), 3) if self.saturation else 0.0,
+            'saturation_p95': round(percentile(sorted(self.saturation), 0.95), 3),
+            'saturation_max': max(self.saturation, default=0.0),
+            'waiting_max_sampled': max(self.waiting, default=0),
+            'in_use_peak': last.get('in_use_peak'),
+            'waiting_peak': last.get('waiting_peak'),
+            'max_size': last.get('max_size'),
+            'leases': last.get('leases', {})
+        }
+
+
+async def simulate_user(
+    client: httpx.AsyncClient,
+    user_id: int,
+    followups: int,
+    think_time: float,
+    stats: Dict[str, EndpointStats]
+):
+    """One customer: create a ticket, then send follow-ups with a pause between them"""
+    order = random.randint(100000, 999999)
+
+    async def call(endpoint: str, path: str, body: Dict) -> Optional[Dict]:
+        started = time.perf_counter()
+        try:
+            response = await client.post(path, json=body)
+        except httpx.HTTPError as e:
+            stats[endpoint].record(0.0, type(e).__name__)
+            return None
+        elapsed = time.perf_counter() - started
+        if response.status_code >= 400:
+            stats[endpoint].record(elapsed, f'HTTP {response.status_code}')
+            return None
+        stats[endpoint].record(elapsed)
+        return response.json()
+
+    ticket = await call(ENDPOINT_CREATE, '/api/v1/tickets', {
+        'telegramUserId': user_id,
+        'telegramUsername': f'bench_{user_id}',
+        'message': random.choice(FIRST_MESSAGES).format(n=order)
+    })
+    if not ticket:
+        return
+
+    for _ in range(followups):
+        # Экспоненциальная пауза: сообщения пользователей не приходят строем
+        await asyncio.sleep(random.expovariate(1 / think_time) if think_time > 0 else 0)
+        await call(ENDPOINT_MESSAGE, f"/api/v1/tickets/{ticket['id']}/messages", {
+            'senderType': 'user',
+            'senderId': str(user_id),
+            'content': random.choice(FOLLOW_UPS).format(n=order)
+        })
+
+
+def service_env(args, ollama_port: int, telegram_port: int, smtp_port: int) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        'PORT': str(args.api_port),
+        'WEBHOOK_PORT': str(args.webhook_port),
+        'WEBHOOK_HOST': '127.0.0.1',
+        'DB_NAME': args.db_name,
+        'USE_OLLAMA': 'true',
+        'OLLAMA_URL': f'http://127.0.0.1:{ollama_port}',
+        'OLLAMA_URLS': '',
+        'AI_MODEL': FAKE_MODEL,
+        'AI_WORKERS': str(args.ai_workers),
+        'ANSWER_CACHE_ENABLED': 'true' if args.answer_cache else 'false',
+        'TELEGRAM_BOT_TOKEN': FAKE_TOKEN,
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{telegram_port}/bot',
+        'SMTP_HOST': '127.0.0.1',
+        'SMTP_PORT': str(smtp_port),
+        'SMTP_USE_TLS': 'false',
+        'SMTP_USE_SSL': 'false',
+        'SMTP_USERNAME': 'bench',
+        'SMTP_PASSWORD': 'bench',
+        'MANAGER_EMAIL': 'manager@bench.local',
+        'TRACE_EXPORT': os.getenv('TRACE_EXPORT', ''),
+        'BOT_METRICS_PORT': '0',
+        'PYTHONUNBUFFERED': '1'
+    })
+    return env
+
+
+def start_service(script: str, env: Dict[str, str], log_dir: Path) -> subprocess.Popen:
+    log = open(log_dir / f'{Path(script).stem}.log', 'w', encoding='utf-8')
+    return subprocess.Popen(
+        [sys.executable, script], cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+
+def stop_service(process: subprocess.Popen):
+    if process.poll() is not None:
+        return
+    # SIGINT - штатное завершение uvicorn (lifespan shutdown, возврат задач в очередь)
+    if os.name == 'nt':
+        process.terminate()
+    else:
+        process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def wait_ready(url: str, process: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2.0) as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{url} exited with code {process.returncode} (see results/*.log)")
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"{url} not ready after {timeout:.0f}s")
+
+
+async def wait_drained(telegram: FakeTelegram, expected: int, timeout: float) -> float:
+    """Wait until every user message got an AI reply in Telegram (or deliveries stop)"""
+    started = time.monotonic()
+    last_count, last_change = -1, started
+    while time.monotonic() - started < timeout:
+        count = telegram.calls.get('sendMessage', 0)
+        if count >= expected:
+            break
+        if count != last_count:
+            last_count, last_change = count, time.monotonic()
+        elif time.monotonic() - last_change > 10:
+            break
+        await asyncio.sleep(0.5)
+    return time.monotonic() - started
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> Dict:
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+
+    ollama = FakeOllama(FAKE_MODEL, args.ollama_latency, args.token_rate, args.reply_tokens, args.escalate_rate)
+    telegram = FakeTelegram(args.telegram_latency)
+    smtp = SmtpSink()
+    fake_servers = [
+        await serve_app(ollama.app, '127.0.0.1', args.ollama_port),
+        await serve_app(telegram.app, '127.0.0.1', args.telegram_port)
+    ]
+    await smtp.start('127.0.0.1', args.smtp_port)
+
+    processes = []
+    api_url = args.api_url or f'http://127.0.0.1:{args.api_port}'
+    try:
+        if not args.api_url:
+            env = service_env(args, args.ollama_port, args.telegram_port, args.smtp_port)
+            processes = [start_service('webhook.py', env, RESULTS_DIR), start_service('server.py', env, RESULTS_DIR)]
+            await wait_ready(f'http://127.0.0.1:{args.webhook_port}/health', processes[0], args.startup_timeout)
+            await wait_ready(f'{api_url}/health', processes[1], args.startup_timeout)
+
+        stats = {ENDPOINT_CREATE: EndpointStats(), ENDPOINT_MESSAGE: EndpointStats()}
+        limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+        async with httpx.AsyncClient(base_url=api_url, timeout=args.request_timeout, limits=limits) as client:
+            sampler = PoolSampler(client, args.sample_interval)
+            sampler_task = asyncio.create_task(sampler.run())
+
+            # Уникальные telegram id на каждый прогон - тикеты разных прогонов не смешиваются
+            base_user_id = int(time.time()) % 1_000_000 * 1000
+            logger.info(f"Running {args.users} users x (1 + {args.followups}) requests against {api_url}")
+            started = time.perf_counter()
+            users = []
+            for i in range(args.users):
+                users.append(asyncio.create_task(
+                    simulate_user(client, base_user_id + i, args.followups, args.think_time, stats)
+                ))
+                if args.ramp_up:
+                    await asyncio.sleep(args.ramp_up / args.users)
+            await asyncio.gather(*users)
+            load_duration = time.perf_counter() - started
+
+            # Верхняя граница: серия сообщений может получить один ответ (GENERATE_DEBOUNCE)
+            expected_replies = args.users * (1 + args.followups)
+            drain_seconds = await wait_drained(telegram, expected_replies, args.drain_timeout) if args.drain_timeout else 0.0
+            sampler_task.cancel()
+
+            health = {}
+            for name in ('generation', 'ai-clients'):
+                try:
+                    health[name] = (await client.get(f'/health/{name}')).json()
+                except (httpx.HTTPError, ValueError):
+                    health[name] = None
+    finally:
+        for process in processes:
+            stop_service(process)
+        for server in fake_servers:
+            server.should_exit = True
+        smtp.close()
+
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'config': {key: value for key, value in vars(args).items() if key not in ('baseline', 'output')}
+        },
+        'duration_s': round(load_duration, 2),
+        'drain_s': round(drain_seconds, 2),
+        'requests': {endpoint: endpoint_stats.to_dict(load_duration) for endpoint, endpoint_stats in stats.items()},
+        'db_pool': sampler.to_dict(),
+        'fakes': {'ollama': ollama.stats(), 'telegram': telegram.stats(), 'smtp': smtp.stats()},
+        'server': health
+    }
+
+
+def compare(result: Dict, baseline: Dict) -> str:
+    """Side-by-side of the headline numbers with relative change"""
+    lines = [f"{'metric':<44} {'baseline':>10} {'current':>10} {'change':>8}"]
+
+    def row(name: str, old, new):
+        change = f"{(new - old) / old * 100:+.1f}%" if old else 'n/a'
+        lines.append(f"{name:<44} {old:>10} {new:>10} {change:>8}")
+
+    for endpoint in (ENDPOINT_CREATE, ENDPOINT_MESSAGE):
+        old, new = baseline['requests'].get(endpoint, {}), result['requests'][endpoint]
+        for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+            row(f'{endpoint} {key}', old.get(key, 0), new[key])
+    row('db_pool saturation_max', baseline['db_pool'].get('saturation_max', 0), result['db_pool']['saturation_max'])
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="HelpDesk load test with fake Ollama, Telegram and SMTP")
+    parser.add_argument('--users', type=int, default=20, help="Concurrent simulated customers")
+    parser.add_argument('--followups', type=int, default=3, help="Follow-up messages per ticket")
+    parser.add_argument('--think-time', type=float, default=2.0, help="Mean pause between a user's messages (s)")
+    parser.add_argument('--ramp-up', type=float, default=0.0, help="Spread user start over this many seconds")
+    parser.add_argument('--ollama-latency', type=float, default=0.5, help="Fake model time to first token (s)")
+    parser.add_argument('--token-rate', type=float, default=50.0, help="Fake model tokens per second")
+    parser.add_argument('--reply-tokens', type=int, default=60, help="Fake model reply length (tokens)")
+    parser.add_argument('--escalate-rate', type=float, default=0.05, help="Share of replies that escalate")
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help="Fake Bot API latency (s)")
+    parser.add_argument('--ai-workers', type=int, default=2, help="AI_WORKERS of the API server")
+    parser.add_argument('--answer-cache', action='store_true', help="Keep the answer cache enabled")
+    parser.add_argument('--db-name', default=os.getenv('BENCH_DB_NAME', 'sulpak_helpdesk_bench'))
+    parser.add_argument('--api-port', type=int, default=3101)
+    parser.add_argument('--webhook-port', type=int, default=3102)
+    parser.add_argument('--ollama-port', type=int, default=3111)
+    parser.add_argument('--telegram-port', type=int, default=3112)
+    parser.add_argument('--smtp-port', type=int, default=3125)
+    parser.add_argument('--api-url', help="Use an already running API (its dependencies must point at the fakes)")
+    parser.add_argument('--startup-timeout', type=float, default=60.0)
+    parser.add_argument('--request-timeout', type=float, default=30.0)
+    parser.add_argument('--sample-interval', type=float, default=0.5, help="DB pool sampling interval (s)")
+    parser.add_argument('--drain-timeout', type=float, default=60.0, help="Wait for AI replies after the load (0 - don't)")
+    parser.add_argument('--output', help="Result JSON path (default: benchmarks/results/loadtest-<time>.json)")
+    parser.add_argument('--baseline', help="Previous result JSON to compare with")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run(args))
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"loadtest-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding='utf-8')
+
+    for endpoint, endpoint_stats in result['requests'].items():
+        print(
+            f"{endpoint:<30} n={endpoint_stats['count']:<6} {endpoint_stats['throughput_rps']:>7} rps  "
+            f"p50 {endpoint_stats['p50_ms']}ms  p95 {endpoint_stats['p95_ms']}ms  p99 {endpoint_stats['p99_ms']}ms  "
+            f"errors {sum(endpoint_stats['errors'].values())}"
+        )
+    print(f"DB pool saturation max {result['db_pool']['saturation_max']}, waiting peak {result['db_pool']['waiting_peak']}")
+    print(f"Fakes: {json.dumps(result['fakes'], ensure_ascii=False)}")
+    print(f"Result: {output}")
+
+    if args.baseline:
+        print()
+        print(compare(result, json.loads(Path(args.baseline).read_text(encoding='utf-8'))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,315 @@
+"""
+Micro Benchmarks - per-message hot paths with a stored baseline
+Times the pure functions that run on every customer message or escalation on
+realistic Russian inputs (short and 4000-character messages, 20- to
+500-message histories). Each run is stored in benchmarks/results/ and compared
+with the previous one; a case whose median got slower than the threshold is
+flagged and the exit code is 1, so the suite can guard changes to these
+functions.
+
+    cd backend
+    python -m benchmarks.microbench
+    python -m benchmarks.microbench --filter context --threshold 0.10
+    python -m benchmarks.microbench --baseline benchmarks/results/microbench-<run>.json
+"""
+
+import gc
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import statistics
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from constants import SENDER_USER, SENDER_AI, AI_MESSAGE_MAX_CHARS
+
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+RESULT_PREFIX = 'microbench-'
+
+# Случаи: имя -> фабрика, возвращающая вызов без аргументов (подготовка входа не замеряется)
+CASES: Dict[str, Callable[[], Callable[[], object]]] = {}
+
+
+def case(name: str):
+    def register(factory):
+        CASES[name] = factory
+        return factory
+    return register
+
+
+# ---------------------------------------------------------------------------
+# Входные данные
+# ---------------------------------------------------------------------------
+
+USER_SENTENCES = [
+    "Здравствуйте, заказ {n} до сих пор не доставлен, хотя обещали вчера.",
+    "Курьер не позвонил, в приложении статус не меняется уже третий день.",
+    "Оплатил картой, деньги списались, а заказ висит как неоплаченный.",
+    "Купил телевизор, после включения на экране полосы, хочу оформить возврат.",
+    "Подскажите, можно ли поменять адрес доставки на другой город?",
+    "Приложение вылетает при оформлении заказа, переустановка не помогла."
+]
+AI_SENTENCES = [
+    "Спасибо за обращение, проверю информацию по вашему заказу.",
+    "Обычно доставка занимает от одного до трех рабочих дней.",
+    "Возможно, платеж еще обрабатывается банком, попробуйте обновить страницу через час.",
+    "Для возврата товара надлежащего качества у вас есть 14 дней с момента покупки.",
+    "Адрес можно изменить, пока заказ не передан в службу доставки.",
+    "Если проблема повторится, опишите, пожалуйста, модель телефона и версию приложения."
+]
+REPLY_SHORT = "Заказ передан курьеру, ожидайте звонка."
+REPLY_ESCALATION = "Понимаю вашу ситуацию. Передаю ваш запрос специалисту, он свяжется с вами в ближайшее время."
+
+
+def text_of(rng: random.Random, sentences: List[str], length: int) -> str:
+    parts, size = [], 0
+    while size < length:
+        sentence = rng.choice(sentences).format(n=rng.randint(100000, 999999))
+        parts.append(sentence)
+        size += len(sentence) + 1
+    return ' '.join(parts)[:length]
+
+
+def make_history(count: int, seed: int = 1) -> List[Dict]:
+    """Alternating customer/AI messages of mixed length, some with photos"""
+    rng = random.Random(seed)
+    started = datetime(2026, 10, 1, 9, 0)
+    history = []
+    for i in range(count):
+        user = i % 2 == 0
+        length = rng.choice((60, 150, 400, 1200)) if user else rng.choice((200, 500, 900))
+        message = {
+            'id': i + 1,
+            'sender_type': SENDER_USER if user else SENDER_AI,
+            'content': text_of(rng, USER_SENTENCES if user else AI_SENTENCES, length),
+            'media_type': None,
+            'media_url': None,
+            'created_at': started + timedelta(minutes=i)
+        }
+        if user and rng.random() < 0.1:
+            message['media_type'] = 'photo'
+            message['media_url'] = f'https://api.telegram.org/file/bot/photos/{i}.jpg'
+        history.append(message)
+    return history
+
+
+MESSAGE_SHORT = "Где мой заказ 482913?"
+MESSAGE_LONG = text_of(random.Random(7), USER_SENTENCES, AI_MESSAGE_MAX_CHARS)
+REPLY_LONG = text_of(random.Random(8), AI_SENTENCES, 1500)
+HISTORY_SIZES = (20, 100, 500)
+
+
+def _ai_service():
+    from ai_service import AIService
+    return AIService()
+
+
+def _run_coroutine(coro):
+    """Drive a coroutine that never suspends without an event loop (no loop overhead in timings)"""
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError("Coroutine suspended; benchmark it with an event loop")
+
+
+# ---------------------------------------------------------------------------
+# Случаи
+# ---------------------------------------------------------------------------
+
+for _size in HISTORY_SIZES:
+    @case(f'ai.build_context[{_size} msgs]')
+    def _build_context(size=_size):
+        service, history = _ai_service(), make_history(size)
+        return lambda: service._build_conversation_context(history)
+
+    @case(f'ai.split_context[{_size} msgs]')
+    def _split_context(size=_size):
+        service, history = _ai_service(), make_history(size)
+        return lambda: service.split_context(history, "Клиент ждет заказ, курьер не звонил.")
+
+    @case(f'email.build_html[{_size} msgs]')
+    def _build_html(size=_size):
+        from email_service import EmailService
+        service, history = EmailService(), make_history(size)
+        user_info = {'telegram_user_id': 123456789, 'telegram_username': 'customer'}
+        return lambda: service._build_html_email('SH2610A1B2C3', user_info, history, REPLY_LONG[:400], 42)
+
+for _name, _reply in (('short', REPLY_SHORT), ('long', REPLY_LONG), ('escalation', REPLY_ESCALATION)):
+    @case(f'ai.calculate_confidence[{_name} reply]')
+    def _confidence(reply=_reply):
+        service = _ai_service()
+        return lambda: service._calculate_confidence(reply)
+
+    @case(f'ai.should_escalate[{_name} reply]')
+    def _escalate(reply=_reply):
+        service = _ai_service()
+        return lambda: service._should_escalate(reply, 0.8)
+
+def _substring_scan(phrases: Dict[str, List[tuple]], text: str) -> Dict[str, List[str]]:
+    """Reference: per-phrase `in` loops that the phrase matcher replaced"""
+    lowered = text.lower()
+    hits = {}
+    for category, items in phrases.items():
+        found = [phrase for phrase, variants in items if any(v in lowered for v in variants)]
+        if found:
+            hits[category] = found
+    return hits
+
+
+for _name, _text in (('short reply', REPLY_SHORT), ('4000 chars', MESSAGE_LONG)):
+    @case(f'phrases.scan[{_name}]')
+    def _scan(text=_text):
+        from phrase_matcher import PhraseMatcher, DEFAULT_PHRASES
+        matcher = PhraseMatcher(DEFAULT_PHRASES)
+        return lambda: matcher.scan(text)
+
+    @case(f'phrases.substring_scan[{_name}]')
+    def _substring(text=_text):
+        from phrase_matcher import DEFAULT_PHRASES, phrase_variants
+        phrases = {
+            category: [(phrase, phrase_variants(phrase.lower())) for phrase in items]
+            for category, items in DEFAULT_PHRASES.items()
+        }
+        return lambda: _substring_scan(phrases, text)
+
+for _name, _message in (('short', MESSAGE_SHORT), ('4000 chars', MESSAGE_LONG)):
+    @case(f'server.validate_with_ai[{_name}]')
+    def _validate(message=_message):
+        from server import validate_with_ai
+        return lambda: _run_coroutine(validate_with_ai(message))
+
+
+# ---------------------------------------------------------------------------
+# Замер
+# ---------------------------------------------------------------------------
+
+def calibrate(fn: Callable, min_time: float) -> int:
+    """Iterations per round so that one round lasts at least min_time"""
+    iterations = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        if time.perf_counter() - started >= min_time:
+            return iterations
+        iterations *= 2
+
+
+def measure(fn: Callable, rounds: int, min_time: float) -> Dict:
+    fn()  # прогрев: ленивые синглтоны, компиляция регулярных выражений
+    iterations = calibrate(fn, min_time)
+    timings = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            started = time.perf_counter()
+            for _ in range(iterations):
+                fn()
+            timings.append((time.perf_counter() - started) / iterations)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    timings.sort()
+    return {
+        'median_us': round(statistics.median(timings) * 1e6, 3),
+        'min_us': round(timings[0] * 1e6, 3),
+        'mean_us': round(statistics.fmean(timings) * 1e6, 3),
+        'stdev_us': round(statistics.stdev(timings) * 1e6, 3) if len(timings) > 1 else 0.0,
+        'rounds': rounds,
+        'iterations': iterations
+    }
+
+
+def previous_result(exclude: Optional[Path] = None) -> Optional[Path]:
+    runs = sorted(path for path in RESULTS_DIR.glob(f'{RESULT_PREFIX}*.json') if path != exclude)
+    return runs[-1] if runs else None
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> Tuple[List[str], List[str]]:
+    """Table lines and names of cases slower than baseline by more than threshold"""
+    lines = [f"{'case':<44} {'median':>12} {'baseline':>12} {'change':>8}"]
+    regressions = []
+    for name, current in results.items():
+        old = baseline.get(name)
+        if old is None:
+            lines.append(f"{name:<44} {current['median_us']:>10.2f}us {'-':>12} {'new':>8}")
+            continue
+        change = (current['median_us'] - old['median_us']) / old['median_us'] if old['median_us'] else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        lines.append(
+            f"{name:<44} {current['median_us']:>10.2f}us {old['median_us']:>10.2f}us {change * 100:>+7.1f}%{flag}"
+        )
+    return lines, regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Micro benchmarks of per-message hot paths")
+    parser.add_argument('--filter', help="Only cases whose name contains this text")
+    parser.add_argument('--rounds', type=int, default=20, help="Timed rounds per case")
+    parser.add_argument('--min-time', type=float, default=0.02, help="Minimum duration of one round (s)")
+    parser.add_argument('--threshold', type=float, default=0.20, help="Median slowdown flagged as regression (0.2 = 20%%)")
+    parser.add_argument('--baseline', help="Result JSON to compare with (default: previous run)")
+    parser.add_argument('--no-save', action='store_true', help="Do not store this run")
+    parser.add_argument('--list', action='store_true', help="List cases and exit")
+    args = parser.parse_args(argv)
+
+    # Логи сервисов (эскалация, неполная настройка SMTP) не нужны в выводе
+    logging.basicConfig(level=logging.ERROR)
+
+    names = [name for name in CASES if not args.filter or args.filter in name]
+    if args.list:
+        print('\n'.join(names))
+        return 0
+
+    results = {}
+    for name in names:
+        results[name] = measure(CASES[name](), args.rounds, args.min_time)
+        print(f"{name:<44} {results[name]['median_us']:>10.2f}us  (min {results[name]['min_us']:.2f}us, ±{results[name]['stdev_us']:.2f})")
+
+    run = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.node(),
+            'rounds': args.rounds,
+            'min_time': args.min_time
+        },
+        'results': results
+    }
+
+    output = None
+    if not args.no_save:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        output = RESULTS_DIR / f"{RESULT_PREFIX}{time.strftime('%Y%m%d-%H%M%S')}.json"
+        output.write_text(json.dumps(run, ensure_ascii=False, indent=2), encoding='utf-8')
+        print(f"\nResult: {output}")
+
+    baseline_path = Path(args.baseline) if args.baseline else previous_result(exclude=output)
+    if baseline_path is None:
+        print("No previous run to compare with")
+        return 0
+
+    baseline = json.loads(baseline_path.read_text(encoding='utf-8'))
+    if baseline['meta'].get('machine') != run['meta']['machine'] or baseline['meta'].get('python') != run['meta']['python']:
+        print(f"Warning: baseline was recorded on {baseline['meta'].get('machine')} / Python {baseline['meta'].get('python')}")
+    lines, regressions = compare(results, baseline['results'], args.threshold)
+    print(f"\nCompared with {baseline_path}:")
+    print('\n'.join(lines))
+    if regressions:
+        print(f"\n{len(regressions)} case(s) slower than baseline by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
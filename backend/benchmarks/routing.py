@@ -0,0 +1,199 @@
+"""
+Routing Check - weighted balancing and failover of llm_router against fake Ollama servers
+Starts several FakeOllama instances in this process and drives an OllamaRouter
+over them through five phases:
+
+    distribution   every backend healthy: request shares follow the weights
+    ejection       one backend answers 503: it is ejected after OLLAMA_EJECT_FAILURES
+                   errors and the health probe marks it down
+    recovery       the backend is fixed: it comes back after OLLAMA_RECOVERY_PROBES
+                   successful probes, not after the first one
+    flapping       the backend answers /api/tags but fails chats: the probes bring it
+                   back, and its first failed requests eject it again
+    failover       one URL refuses connections: requests fail over, none is lost
+
+Each phase prints its checks; the exit code is 1 if any check failed.
+
+    cd backend
+    python -m benchmarks.routing
+    python -m benchmarks.routing --weights 3,1,1 --requests 900 --concurrency 24
+"""
+
+import sys
+import time
+import asyncio
+import logging
+import argparse
+from typing import List, Optional, Tuple
+import httpx
+from constants import OLLAMA_EJECT_FAILURES, OLLAMA_RECOVERY_PROBES
+from llm_router import OllamaRouter
+from benchmarks.fakes import FakeOllama, serve_app
+
+MODEL = 'bench-model'
+HOST = '127.0.0.1'
+
+
+class Checks:
+    """Collected pass/fail lines of all phases"""
+
+    def __init__(self):
+        self.failed = 0
+
+    def check(self, name: str, passed: bool, detail: str):
+        if not passed:
+            self.failed += 1
+        print(f"  [{'OK' if passed else 'FAIL'}] {name}: {detail}")
+
+
+async def run_requests(router: OllamaRouter, count: int, concurrency: int) -> Tuple[int, int]:
+    """Send `count` chat requests through the router; returns (succeeded, failed)"""
+    semaphore = asyncio.Semaphore(concurrency)
+    payload = {'model': MODEL, 'messages': [{'role': 'user', 'content': 'Где мой заказ?'}], 'stream': False}
+    results = {'ok': 0, 'error': 0}
+
+    async def one():
+        async with semaphore:
+            try:
+                await router.post_json('/api/chat', payload)
+                results['ok'] += 1
+            except httpx.HTTPError:
+                results['error'] += 1
+
+    await asyncio.gather(*(one() for _ in range(count)))
+    return results['ok'], results['error']
+
+
+def shares(counts: List[int]) -> List[float]:
+    total = sum(counts) or 1
+    return [count / total for count in counts]
+
+
+def check_distribution(checks: Checks, fakes: List[FakeOllama], before: List[int], weights: List[float], tolerance: float):
+    counts = [fake.requests - start for fake, start in zip(fakes, before)]
+    expected = shares(weights)
+    for i, (got, want) in enumerate(zip(shares(counts), expected)):
+        checks.check(
+            f"backend {i} share", abs(got - want) <= tolerance,
+            f"{got:.1%} of {sum(counts)} requests, weight share {want:.1%} (±{tolerance:.0%})"
+        )
+
+
+async def probe_until_readmitted(checks: Checks, router: OllamaRouter, index: int):
+    """Run health probes on an ejected backend: it must stay out until OLLAMA_RECOVERY_PROBES pass"""
+    backend = router.backends[index]
+    for _ in range(1, OLLAMA_RECOVERY_PROBES):
+        await router.check_health()
+        if backend.available:
+            break
+    checks.check(
+        f"still ejected after {OLLAMA_RECOVERY_PROBES - 1} probe(s)", not backend.available,
+        f"healthy={backend.healthy}, ejected_for_s={backend.stats()['ejected_for_s']}"
+    )
+    await router.check_health()
+    checks.check(
+        f"back after {OLLAMA_RECOVERY_PROBES} probes", backend.available,
+        f"healthy={backend.healthy}, ejected_for_s={backend.stats()['ejected_for_s']}"
+    )
+
+
+async def run(args) -> int:
+    weights = [float(w) for w in args.weights.split(',')]
+    fakes = [
+        FakeOllama(MODEL, first_token_latency=args.latency, token_rate=1000.0, reply_tokens=10)
+        for _ in weights
+    ]
+    urls = [f"http://{HOST}:{args.base_port + i}" for i in range(len(fakes))]
+    servers = [await serve_app(fake.app, HOST, args.base_port + i) for i, fake in enumerate(fakes)]
+    client_kwargs = {'timeout': httpx.Timeout(10.0)}
+    checks = Checks()
+    # Сломанный бэкенд: не самый тяжелый, чтобы остальные выдержали нагрузку
+    broken = len(fakes) - 1
+
+    router = OllamaRouter(list(zip(urls, weights)), MODEL, client_kwargs)
+    try:
+        print(f"Distribution: {args.requests} requests, concurrency {args.concurrency}, weights {weights}")
+        await router.check_health()
+        before = [fake.requests for fake in fakes]
+        ok, errors = await run_requests(router, args.requests, args.concurrency)
+        checks.check("all requests succeeded", errors == 0, f"{ok} ok, {errors} failed")
+        check_distribution(checks, fakes, before, weights, args.tolerance)
+
+        print(f"Ejection: backend {broken} answers 503")
+        fakes[broken].failing = True
+        before = fakes[broken].requests
+        ok, errors = await run_requests(router, args.requests, args.concurrency)
+        hits = fakes[broken].requests - before
+        backend = router.backends[broken]
+        checks.check("backend ejected", backend.ejected_until > time.monotonic(), f"ejected for {backend.stats()['ejected_for_s']}s")
+        # Запросы, уже выбравшие бэкенд до исключения, тоже получают 503
+        checks.check(
+            "failing backend stopped receiving requests", hits <= OLLAMA_EJECT_FAILURES + args.concurrency - 1,
+            f"{hits} requests reached it, {errors} failed, eject after {OLLAMA_EJECT_FAILURES}"
+        )
+        await router.check_health()
+        checks.check("health probe marks it down", not backend.healthy, backend.health_error or 'healthy')
+
+        print(f"Recovery: backend {broken} fixed")
+        fakes[broken].failing = False
+        await probe_until_readmitted(checks, router, broken)
+        before = [fake.requests for fake in fakes]
+        ok, errors = await run_requests(router, args.requests, args.concurrency)
+        checks.check("all requests succeeded", errors == 0, f"{ok} ok, {errors} failed")
+        check_distribution(checks, fakes, before, weights, args.tolerance)
+
+        print(f"Flapping: backend {broken} answers /api/tags but fails chats")
+        fakes[broken].failing_chat = True
+        await run_requests(router, args.requests, args.concurrency)
+        checks.check("backend ejected", backend.ejected_until > time.monotonic(), f"{backend.consecutive_failures} failures in a row")
+        await probe_until_readmitted(checks, router, broken)
+        before = fakes[broken].requests
+        ok, errors = await run_requests(router, args.requests, args.concurrency)
+        hits = fakes[broken].requests - before
+        # Счетчик ошибок после проб не сброшен: хватает одной ошибки (плюс запросы, уже выбравшие сервер)
+        checks.check(
+            "first failed request ejects it again", backend.ejected_until > time.monotonic() and hits <= args.concurrency,
+            f"{hits} requests reached it, ejected for {backend.stats()['ejected_for_s']}s"
+        )
+        fakes[broken].failing_chat = False
+    finally:
+        await router.close()
+
+    # Нет слушателя на порту: соединение отклоняется, запрос уходит на другой бэкенд
+    dead_url = f"http://{HOST}:{args.base_port + len(fakes)}"
+    print(f"Failover: {dead_url} refuses connections (highest weight, picked first)")
+    router = OllamaRouter([(dead_url, max(weights) * 2)] + list(zip(urls, weights)), MODEL, client_kwargs)
+    try:
+        ok, errors = await run_requests(router, args.requests, args.concurrency)
+        dead = router.backends[0]
+        checks.check("no request lost", errors == 0, f"{ok} ok, {errors} failed")
+        checks.check("dead backend ejected", dead.ejected_until > time.monotonic(), f"{dead.failures} connection failures")
+        checks.check(
+            "dead backend tried only until ejected", dead.failures <= OLLAMA_EJECT_FAILURES + args.concurrency - 1,
+            f"{dead.failures} attempts, eject after {OLLAMA_EJECT_FAILURES}"
+        )
+    finally:
+        await router.close()
+        for server in servers:
+            server.should_exit = True
+        await asyncio.sleep(0.2)
+
+    print(f"\n{'All checks passed' if not checks.failed else f'{checks.failed} check(s) failed'}")
+    return 1 if checks.failed else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.ERROR)
+    parser = argparse.ArgumentParser(description="Check weighted routing and failover of llm_router against fake Ollama")
+    parser.add_argument('--weights', default='2,1,1', help="Backend weights, comma separated")
+    parser.add_argument('--requests', type=int, default=600, help="Requests per phase")
+    parser.add_argument('--concurrency', type=int, default=16, help="Requests in flight")
+    parser.add_argument('--latency', type=float, default=0.05, help="Fake model response time (s)")
+    parser.add_argument('--tolerance', type=float, default=0.08, help="Allowed deviation of a backend's share")
+    parser.add_argument('--base-port', type=int, default=3131, help="Port of the first fake Ollama")
+    args = parser.parse_args(argv)
+    return asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
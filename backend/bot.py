@@ -1,16 +1,25 @@
 import os
+import re
+import time
+import asyncio
 import logging
+import functools
+from typing import Dict, List, Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from telegram.constants import ParseMode
+from telegram.constants import ParseMode, ChatAction
 from dotenv import load_dotenv
 import httpx
 from datetime import datetime
 
 from constants import (
-    SENDER_USER, SENDER_AI, MIN_MESSAGE_LENGTH, HTTP_TIMEOUT,
-    STATUS_EMOJI, STATUS_TEXT_RU
+    HTTP_TIMEOUT,
+    STATUS_EMOJI, STATUS_TEXT_RU, BOT_HTTP_MAX_CONNECTIONS, BOT_HTTP_MAX_KEEPALIVE,
+    BOT_HTTP_KEEPALIVE_EXPIRY, SESSION_CACHE_STATS_INTERVAL, MEDIA_GROUP_WAIT
 )
+from session_cache import SessionCache
+from metrics import gauge, histogram, start_metrics_server
+from tracing import span, start_trace, trace_headers, start_tracing, stop_tracing, SPAN_CLIENT
 
 # Настройка логирования
 logging.basicConfig(
@@ -26,22 +35,103 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 BACKEND_URL = os.getenv('BACKEND_URL', 'http://localhost:3001')
 WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '3002'))
 
+# Сколько последних запросов показывать в списке "Мои запросы"
+USER_TICKETS_LIMIT = 20
+
 # Валидация конфигурации
 if not TELEGRAM_BOT_TOKEN:
     logger.error("TELEGRAM_BOT_TOKEN is not set in environment variables!")
     logger.error("Please set TELEGRAM_BOT_TOKEN in backend/.env file")
     raise ValueError("TELEGRAM_BOT_TOKEN is required to run the bot")
 
+# Один HTTP клиент на все время работы бота: keep-alive соединения к backend
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Общий клиент backend API (создается при первом обращении)"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            base_url=BACKEND_URL,
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=BOT_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=BOT_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=BOT_HTTP_KEEPALIVE_EXPIRY
+            ),
+            event_hooks={'request': [_mark_request_start], 'response': [_observe_request]}
+        )
+    return _http_client
+
+
+async def _mark_request_start(request: httpx.Request):
+    request.extensions['started_at'] = time.perf_counter()
+    # Трейс обработчика продолжается на backend и в задачах AI
+    request.headers.update(trace_headers())
+
+
+async def _observe_request(response: httpx.Response):
+    # /api/v1/tickets/42 -> /api/v1/tickets/{id}: число серий метрики не растет с числом тикетов
+    endpoint = _ID_SEGMENT.sub('/{id}', response.request.url.path)
+    BACKEND_REQUEST_SECONDS.observe(time.perf_counter() - response.request.extensions['started_at'], endpoint)
+
+
+# Кэш сессий: чтение без запроса к API, запись - сквозная с проверкой версии
+session_cache = SessionCache()
+_stats_task: Optional[asyncio.Task] = None
+_metrics_server: Optional[asyncio.AbstractServer] = None
+_ID_SEGMENT = re.compile(r'/\d+')
+
+# Метрики бота: GET /metrics на BOT_METRICS_PORT (0 - выключено)
+BOT_METRICS_PORT = int(os.getenv('BOT_METRICS_PORT', '3003'))
+BACKEND_REQUEST_SECONDS = histogram('helpdesk_bot_backend_request_seconds', 'Bot request to the API server', ('endpoint',))
+SESSION_CACHE_ENTRIES = gauge('helpdesk_bot_session_cache', 'Bot session cache counters', ('stat',))
+for _stat in ('size', 'hits', 'misses', 'writes', 'writes_skipped', 'conflicts'):
+    SESSION_CACHE_ENTRIES.set_function(lambda stat=_stat: session_cache.stats()[stat], _stat)
+
+
+async def log_session_cache_stats():
+    while True:
+        await asyncio.sleep(SESSION_CACHE_STATS_INTERVAL)
+        logger.info(f"Session cache: {session_cache.stats()}")
+
+
+async def on_startup(application: Application):
+    """post_init: периодический лог статистики кэша сессий и endpoint метрик"""
+    global _stats_task, _metrics_server
+    await start_tracing('bot')
+    _stats_task = asyncio.create_task(log_session_cache_stats())
+    if BOT_METRICS_PORT:
+        _metrics_server = await start_metrics_server(os.getenv('METRICS_HOST', '127.0.0.1'), BOT_METRICS_PORT)
+
+
+async def on_shutdown(application: Application):
+    """post_shutdown: остановить фоновые задачи и закрыть соединения к backend"""
+    global _http_client
+    if _stats_task is not None:
+        _stats_task.cancel()
+    if _metrics_server is not None:
+        _metrics_server.close()
+    logger.info(f"Session cache: {session_cache.stats()}")
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+    await stop_tracing()
+
+
 async def get_session(user_id: int) -> dict:
-    """Получить или создать сессию пользователя из БД"""
+    """Получить сессию пользователя (из кэша или из БД)"""
+    cached = session_cache.get(user_id)
+    if cached is not None:
+        return cached
+
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{BACKEND_URL}/api/v1/sessions/{user_id}",
-                timeout=HTTP_TIMEOUT
-            )
-            response.raise_for_status()
-            return response.json()
+        response = await get_http_client().get(f"/api/v1/sessions/{user_id}")
+        response.raise_for_status()
+        session = response.json()
+        session_cache.put(session)
+        return dict(session)
     except Exception as e:
         logger.error(f"Error fetching session for user {user_id}: {e}")
         # Возвращаем дефолтную сессию в случае ошибки
@@ -57,20 +147,38 @@ async def get_session(user_id: int) -> dict:
         }
 
 
-async def update_session(session_data: dict):
-    """Обновить сессию пользователя в БД"""
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{BACKEND_URL}/api/v1/sessions",
-                json=session_data,
-                timeout=HTTP_TIMEOUT
-            )
+async def update_session(user_id: int, **changes) -> Optional[dict]:
+    """
+    Изменить поля сессии пользователя в БД.
+    Неизмененная сессия не отправляется; при конфликте версий (409)
+    кэш обновляется с сервера и изменения применяются повторно.
+    """
+    for _ in range(2):
+        session = await get_session(user_id)
+        session.update(changes)
+        if session_cache.is_unchanged(session):
+            session_cache.writes_skipped += 1
+            return session
+
+        try:
+            response = await get_http_client().post("/api/v1/sessions", json=session)
+            if response.status_code == 409:
+                session_cache.conflicts += 1
+                session_cache.put(response.json()['detail']['session'])
+                continue
             response.raise_for_status()
-            return response.json()
-    except Exception as e:
-        logger.error(f"Error updating session: {e}")
-        return None
+            saved = response.json()
+            session_cache.writes += 1
+            session_cache.put(saved)
+            return saved
+        except Exception as e:
+            logger.error(f"Error updating session: {e}")
+            session_cache.invalidate(user_id)
+            return None
+
+    logger.error(f"Session of user {user_id} keeps changing concurrently, update dropped")
+    session_cache.invalidate(user_id)
+    return None
 
 
 def main_menu() -> InlineKeyboardMarkup:
@@ -96,15 +204,13 @@ def ticket_menu(ticket_id: int) -> InlineKeyboardMarkup:
 async def get_user_tickets(user_id: int) -> list:
     """Получить тикеты пользователя"""
     try:
-        async with httpx.AsyncClient() as client:
-            # Используем query параметр для фильтрации на уровне SQL
-            response = await client.get(
-                f"{BACKEND_URL}/api/v1/tickets",
-                params={"user_id": user_id},
-                timeout=HTTP_TIMEOUT
-            )
-            response.raise_for_status()
-            return response.json()
+        # Используем query параметр для фильтрации на уровне SQL
+        response = await get_http_client().get(
+            "/api/v1/tickets",
+            params={"user_id": user_id, "limit": USER_TICKETS_LIMIT}
+        )
+        response.raise_for_status()
+        return response.json()['items']
     except Exception as e:
         logger.error(f"Error fetching user tickets: {e}")
         return []
@@ -113,9 +219,8 @@ async def get_user_tickets(user_id: int) -> list:
 async def get_ticket_details(ticket_id: int) -> dict:
     """Получить детали тикета"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{BACKEND_URL}/api/v1/tickets/{ticket_id}", timeout=10.0)
-            return response.json()
+        response = await get_http_client().get(f"/api/v1/tickets/{ticket_id}")
+        return response.json()
     except Exception as e:
         print(f"Error fetching ticket details: {e}")
         return None
@@ -166,9 +271,7 @@ async def show_ticket_details(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.effective_message.reply_text("❌ Запрос не найден.")
         return
 
-    session = await get_session(user_id)
-    session['active_ticket_id'] = ticket_id
-    await update_session(session)
+    await update_session(user_id, active_ticket_id=ticket_id)
 
     ticket = details['ticket']
     messages = details.get('messages', [])
@@ -196,58 +299,36 @@ async def show_ticket_details(update: Update, context: ContextTypes.DEFAULT_TYPE
     )
 
 
-async def create_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, username: str, message: str):
-    """Создать новый тикет"""
+async def send_inbound(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, username: str, text: str, media_type: str = None, media_url: str = None, media_file_id: str = None, extra_media: Optional[List[dict]] = None):
+    """
+    Отправить входящее сообщение на backend одним запросом.
+    Сессия, уточнение, создание тикета или добавление сообщения - на стороне сервера.
+    extra_media - остальные элементы альбома (становятся сообщениями того же тикета).
+    """
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{BACKEND_URL}/api/v1/tickets",
+        await context.bot.send_chat_action(update.effective_chat.id, ChatAction.TYPING)
+
+        with span('api inbound', SPAN_CLIENT, media_type=media_type or 'text', extra_media=len(extra_media or [])):
+            response = await get_http_client().post(
+                "/api/v1/inbound",
                 json={
                     "telegramUserId": user_id,
                     "telegramUsername": username,
-                    "message": message
-                },
-                timeout=10.0
+                    "text": text,
+                    "mediaType": media_type,
+                    "mediaUrl": media_url,
+                    "mediaFileId": media_file_id,
+                    "extraMedia": extra_media or []
+                }
             )
-            data = response.json()
+            response.raise_for_status()
+        data = response.json()
+        # Сервер уже обновил сессию в той же транзакции - берем ее версию в кэш
+        session_cache.put(data['session'])
 
-        if data.get('needsClarification'):
+        if data['action'] == 'clarification':
             await update.effective_message.reply_text(f"❓ {data['suggestion']}")
-            session = await get_session(user_id)
-            session['awaiting_clarification'] = True
-            session['original_message'] = message
-            await update_session(session)
-        elif data.get('success'):
-            session = await get_session(user_id)
-            ticket_id = data['ticket']['id']
-            session['active_ticket_id'] = ticket_id
-
-            # Если было отправлено медиа вместе с созданием тикета
-            if session.get('pending_media_type'):
-                try:
-                    async with httpx.AsyncClient() as client:
-                        await client.post(
-                            f"{BACKEND_URL}/api/v1/tickets/{ticket_id}/messages",
-                            json={
-                                "senderType": "user",
-                                "senderId": str(user_id),
-                                "content": session['pending_media_caption'] or "Медиа",
-                                "mediaType": session['pending_media_type'],
-                                "mediaUrl": session['pending_media_url'],
-                                "mediaFileId": session['pending_media_file_id']
-                            },
-                            timeout=HTTP_TIMEOUT
-                        )
-                    # Очистить pending media из сессии
-                    session['pending_media_type'] = None
-                    session['pending_media_url'] = None
-                    session['pending_media_file_id'] = None
-                    session['pending_media_caption'] = None
-                except Exception as e:
-                    logger.error(f"Error saving media to ticket {ticket_id}: {e}", exc_info=True)
-
-            await update_session(session)
-
+        elif data['action'] == 'ticket_created':
             await update.effective_message.reply_text(
                 f"✅ *Запрос создан!*\n\n"
                 f"📋 Номер: *{data['ticket']['ticketNumber']}*\n"
@@ -256,54 +337,80 @@ async def create_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE, user
                 f"🤖 AI ассистент уже готовит ответ...\n\n"
                 f"💬 Ваши следующие сообщения будут добавлены в этот запрос.",
                 parse_mode=ParseMode.MARKDOWN,
-                reply_markup=ticket_menu(ticket_id)
+                reply_markup=ticket_menu(data['ticket']['id'])
             )
         else:
-            await update.effective_message.reply_text("❌ Произошла ошибка при создании запроса.")
-    except Exception as e:
-        logger.error(f"Error creating ticket: {e}")
-        await update.effective_message.reply_text("❌ Ошибка связи с сервером.")
+            response_text = "✅ Сообщение добавлено в запрос.\n\n🤖 AI ассистент скоро ответит."
+            if extra_media:
+                response_text = f"✅ Альбом ({len(extra_media) + 1} шт.) добавлен в запрос.\n\n🤖 AI ассистент скоро ответит."
+            elif media_type:
+                response_text = f"✅ {media_type.capitalize()} добавлено в запрос.\n\n🤖 AI ассистент скоро ответит."
 
-
-async def add_message_to_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, ticket_id: int, message: str, media_type: str = None, media_url: str = None, media_file_id: str = None):
-    """Добавить сообщение в существующий тикет"""
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{BACKEND_URL}/api/v1/tickets/{ticket_id}/messages",
-                json={
-                    "senderType": SENDER_USER,
-                    "senderId": str(user_id),
-                    "content": message,
-                    "mediaType": media_type,
-                    "mediaUrl": media_url,
-                    "mediaFileId": media_file_id
-                },
-                timeout=HTTP_TIMEOUT
+            await update.effective_message.reply_text(
+                response_text,
+                reply_markup=ticket_menu(data['ticket']['id'])
             )
-            response.raise_for_status()
-
-        response_text = "✅ Сообщение добавлено в запрос.\n\n🤖 AI ассистент скоро ответит."
-        if media_type:
-            response_text = f"✅ {media_type.capitalize()} добавлено в запрос.\n\n🤖 AI ассистент скоро ответит."
-
-        await update.effective_message.reply_text(
-            response_text,
-            reply_markup=ticket_menu(ticket_id)
-        )
     except httpx.HTTPStatusError as e:
-        logger.error(f"HTTP error adding message: {e.response.status_code} - {e.response.text}")
-        await update.effective_message.reply_text(f"❌ Ошибка сервера при добавлении сообщения: {e.response.status_code}")
+        logger.error(f"HTTP error on inbound message: {e.response.status_code} - {e.response.text}")
+        await update.effective_message.reply_text(f"❌ Ошибка сервера при обработке сообщения: {e.response.status_code}")
     except httpx.TimeoutException:
-        logger.error(f"Timeout adding message to ticket {ticket_id}")
+        logger.error(f"Timeout on inbound message from user {user_id}")
         await update.effective_message.reply_text("❌ Превышено время ожидания. Попробуйте позже.")
     except Exception as e:
-        logger.error(f"Error adding message to ticket {ticket_id}: {e}", exc_info=True)
-        await update.effective_message.reply_text("❌ Ошибка при добавлении сообщения.")
+        logger.error(f"Error on inbound message from user {user_id}: {e}", exc_info=True)
+        await update.effective_message.reply_text("❌ Ошибка связи с сервером.", reply_markup=main_menu())
+
+
+# Альбомы Telegram приходят отдельными сообщениями с общим media_group_id:
+# собираем их MEDIA_GROUP_WAIT секунд и отправляем одним запросом (один AI ответ)
+_media_groups: Dict[str, dict] = {}
+
+
+async def collect_media_group(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, username: str, item: dict):
+    """Добавить элемент альбома; первый элемент запускает отложенную отправку"""
+    group_id = update.message.media_group_id
+    group = _media_groups.get(group_id)
+    if group is None:
+        group = _media_groups[group_id] = {'update': update, 'context': context, 'items': []}
+        group['task'] = asyncio.create_task(flush_media_group(group_id, user_id, username))
+    group['items'].append(item)
+
+
+async def flush_media_group(group_id: str, user_id: int, username: str):
+    await asyncio.sleep(MEDIA_GROUP_WAIT)
+    group = _media_groups.pop(group_id)
+    items = group['items']
+
+    # Подпись альбома обычно только у одного элемента - он становится основным сообщением
+    main = next((item for item in items if item['hasCaption']), items[0])
+    extra = [{key: item[key] for key in ('text', 'mediaType', 'mediaUrl', 'mediaFileId')}
+             for item in items if item is not main]
+    logger.info(f"Media group {group_id} from user {user_id}: {len(items)} items sent as one message")
+
+    # Отправка после ожидания альбома - отдельный трейс (обработчики первых фото уже завершились)
+    with start_trace('bot media_group', user_id=user_id, items=len(items)):
+        await send_inbound(
+            group['update'], group['context'], user_id, username, main['text'],
+            media_type=main['mediaType'], media_url=main['mediaUrl'], media_file_id=main['mediaFileId'],
+            extra_media=extra
+        )
+
+
+def traced(name: str):
+    """Обработчик апдейта начинает трейс (TRACE_EXPORT): bot -> API -> AI -> webhook -> Telegram"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            user = update.effective_user
+            with start_trace(name, **({'user_id': user.id} if user else {})):
+                return await handler(update, context)
+        return wrapper
+    return decorator
 
 
 # Обработчики команд
 
+@traced('bot /start')
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start"""
     await update.message.reply_text(
@@ -315,6 +422,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@traced('bot /menu')
 async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /menu"""
     await update.message.reply_text(
@@ -324,6 +432,7 @@ async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@traced('bot callback')
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка нажатий на кнопки"""
     query = update.callback_query
@@ -335,15 +444,14 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "list_tickets":
         await show_ticket_list(update, context, user_id)
     elif data == "new_ticket":
-        session = await get_session(user_id)
-        session['active_ticket_id'] = None
-        await update_session(session)
+        await update_session(user_id, active_ticket_id=None)
         await query.message.reply_text("✍️ Опишите вашу проблему:")
     elif data.startswith("open_"):
         ticket_id = int(data.replace("open_", ""))
         await show_ticket_details(update, context, user_id, ticket_id)
 
 
+@traced('bot message')
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка текстовых сообщений"""
     if not update.message or not update.message.text:
@@ -351,39 +459,11 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_id = update.message.from_user.id
     username = update.message.from_user.username or update.message.from_user.first_name
-    message = update.message.text
 
-    session = await get_session(user_id)
-
-    try:
-        # Если ожидаем уточнение
-        if session.get('awaiting_clarification'):
-            full_message = f"{session['original_message']}\n\nДополнительно: {message}"
-            session['awaiting_clarification'] = False
-            session['original_message'] = ''
-            await update_session(session)
-
-            await update.message.reply_text("⏳ Обрабатываю ваш запрос...")
-            await create_ticket(update, context, user_id, username, full_message)
-            return
-
-        # Если есть активный тикет - добавляем сообщение в него
-        if session.get('active_ticket_id'):
-            await add_message_to_ticket(update, context, user_id, session['active_ticket_id'], message)
-            return
-
-        # Создаем новый тикет
-        await update.message.reply_text("⏳ Обрабатываю ваш запрос...")
-        await create_ticket(update, context, user_id, username, message)
-
-    except Exception as e:
-        print(f"Bot error: {e}")
-        await update.message.reply_text(
-            "❌ Ошибка связи с сервером.",
-            reply_markup=main_menu()
-        )
+    await send_inbound(update, context, user_id, username, update.message.text)
 
 
+@traced('bot photo')
 async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка фото от пользователя"""
     if not update.message or not update.message.photo:
@@ -392,39 +472,31 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     username = update.message.from_user.username or update.message.from_user.first_name
     caption = update.message.caption or "Фото"
-    session = await get_session(user_id)
 
     try:
         # Получаем файл с максимальным разрешением
         photo = update.message.photo[-1]
         file = await context.bot.get_file(photo.file_id)
-
-        # Получаем URL файла из Telegram
-        media_url = file.file_path
-        media_file_id = photo.file_id
-
-        # Если есть активный тикет - добавляем фото в него
-        if session.get('active_ticket_id'):
-            await add_message_to_ticket(
-                update, context, user_id, session['active_ticket_id'],
-                caption, media_type='photo', media_url=media_url, media_file_id=media_file_id
-            )
-        else:
-            # Создаем новый тикет с фото
-            await update.message.reply_text("⏳ Обрабатываю ваш запрос с фото...")
-            # Для нового тикета сохраним информацию о медиа в сессию
-            session['pending_media_type'] = 'photo'
-            session['pending_media_url'] = media_url
-            session['pending_media_file_id'] = media_file_id
-            session['pending_media_caption'] = caption
-            await update_session(session)
-            await create_ticket(update, context, user_id, username, caption)
-
     except Exception as e:
         logger.error(f"Photo handler error: {e}", exc_info=True)
         await update.message.reply_text("❌ Ошибка обработки фото.", reply_markup=main_menu())
+        return
+
+    if update.message.media_group_id:
+        await collect_media_group(update, context, user_id, username, {
+            'text': caption, 'hasCaption': bool(update.message.caption),
+            'mediaType': 'photo', 'mediaUrl': file.file_path, 'mediaFileId': photo.file_id
+        })
+        return
+
+    # Фото добавляется в активный тикет или становится первым сообщением нового
+    await send_inbound(
+        update, context, user_id, username, caption,
+        media_type='photo', media_url=file.file_path, media_file_id=photo.file_id
+    )
 
 
+@traced('bot video')
 async def video_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка видео от пользователя"""
     if not update.message or not update.message.video:
@@ -433,36 +505,26 @@ async def video_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     username = update.message.from_user.username or update.message.from_user.first_name
     caption = update.message.caption or "Видео"
-    session = await get_session(user_id)
 
     try:
-        # Получаем файл видео
         video = update.message.video
         file = await context.bot.get_file(video.file_id)
-
-        # Получаем URL файла из Telegram
-        media_url = file.file_path
-        media_file_id = video.file_id
-
-        # Если есть активный тикет - добавляем видео в него
-        if session.get('active_ticket_id'):
-            await add_message_to_ticket(
-                update, context, user_id, session['active_ticket_id'],
-                caption, media_type='video', media_url=media_url, media_file_id=media_file_id
-            )
-        else:
-            # Создаем новый тикет с видео
-            await update.message.reply_text("⏳ Обрабатываю ваш запрос с видео...")
-            session['pending_media_type'] = 'video'
-            session['pending_media_url'] = media_url
-            session['pending_media_file_id'] = media_file_id
-            session['pending_media_caption'] = caption
-            await update_session(session)
-            await create_ticket(update, context, user_id, username, caption)
-
     except Exception as e:
         logger.error(f"Video handler error: {e}", exc_info=True)
         await update.message.reply_text("❌ Ошибка обработки видео.", reply_markup=main_menu())
+        return
+
+    if update.message.media_group_id:
+        await collect_media_group(update, context, user_id, username, {
+            'text': caption, 'hasCaption': bool(update.message.caption),
+            'mediaType': 'video', 'mediaUrl': file.file_path, 'mediaFileId': video.file_id
+        })
+        return
+
+    await send_inbound(
+        update, context, user_id, username, caption,
+        media_type='video', media_url=file.file_path, media_file_id=video.file_id
+    )
 
 
 def main():
@@ -470,7 +532,13 @@ def main():
     logger.info("Starting Telegram bot...")
 
     # Создание приложения
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # Регистрация обработчиков
     application.add_handler(CommandHandler("start", start_command))
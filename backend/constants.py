@@ -12,6 +12,9 @@ CATEGORY_PAYMENT = 'оплата'
 CATEGORY_PRODUCT = 'товар'
 CATEGORY_GENERAL = 'general'
 
+# Проверка изменений файла фраз PHRASES_FILE (сек)
+PHRASES_RELOAD_INTERVAL = 5.0
+
 # Статусы тикетов (AI-focused)
 STATUS_NEW = 'new'
 STATUS_AI_PROCESSING = 'ai_processing'
@@ -31,6 +34,47 @@ MEDIA_VIDEO = 'video'
 AI_CONFIDENCE_THRESHOLD = 0.7  # Порог уверенности AI для автоответа
 AI_MODEL_DEFAULT = 'qwen2.5:3b'  # Ollama default model (отлично работает с русским)
 AI_MAX_CONTEXT_MESSAGES = 20  # Максимум сообщений в контексте
+AI_CONTEXT_TOKEN_BUDGET = 3000  # Токенов истории в промпте (краткое содержание + последние сообщения)
+AI_CONTEXT_FOLD_TARGET = 0.6  # После сворачивания дословно остается эта доля бюджета (окно стабильно несколько ходов)
+AI_CONTEXT_SUMMARY_MAX_TOKENS = 400  # Длина краткого содержания ранней части диалога
+AI_TICKET_SUMMARY_MAX_TOKENS = 256  # Резюме тикета для менеджера (обновляется после каждого ответа AI)
+AI_SUMMARY_TAIL_MESSAGES = 4  # Сколько последних несвернутых сообщений добавить к резюме при эскалации
+AI_MESSAGE_MAX_CHARS = 4000  # Длинное сообщение в промпте сокращается до начала и конца
+AI_CHARS_PER_TOKEN = 3.0  # Оценка без токенизатора (кириллица ~3 символа на токен)
+OLLAMA_KEEP_ALIVE_DEFAULT = '30m'  # Держать модель загруженной между запросами
+
+# Кэш ответов на типовые вопросы (GOLDEN_QUESTIONS.md + решенные тикеты)
+ANSWER_CACHE_THRESHOLD = 0.8        # Минимальное сходство вопросов (косинус по триграммам)
+ANSWER_CACHE_TTL = 7 * 24 * 3600.0  # Время жизни выученных ответов (сек)
+ANSWER_CACHE_SIZE = 1000
+ANSWER_CACHE_MAX_QUERY_CHARS = 200  # Длинные сообщения не ищутся в кэше
+ANSWER_CACHE_LEARN_LIMIT = 500      # Решенных тикетов для прогрева при старте
+ANSWER_CACHE_ID_DIGITS = 4          # Число из стольких цифр (номер заказа, телефон) - ответ не запоминается
+
+# Потоковая доставка AI ответа (первое сообщение + редактирование)
+STREAM_EDIT_INTERVAL = 1.5          # Минимальный интервал между правками сообщения (сек)
+STREAM_FIRST_MESSAGE_MAX_WAIT_CHARS = 200  # Отправить первое сообщение, даже если предложение не закончено
+
+# Очередь исходящих сообщений Telegram (webhook.py)
+OUTBOX_STATUS_PENDING = 'pending'
+OUTBOX_STATUS_SENDING = 'sending'
+OUTBOX_STATUS_SENT = 'sent'
+OUTBOX_STATUS_FAILED = 'failed'
+OUTBOX_ACTION_SEND = 'send'
+OUTBOX_ACTION_EDIT = 'edit'
+OUTBOX_GLOBAL_RATE = 30.0           # Сообщений в секунду на бота (лимит Telegram)
+OUTBOX_CHAT_RATE = 1.0              # Сообщений в секунду в один чат
+OUTBOX_CHAT_BURST = 3               # Допустимая короткая серия в один чат
+OUTBOX_MAX_IN_FLIGHT = 32           # Одновременных запросов к Bot API
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_DELAY = 2.0            # Базовая пауза перед повтором (сек, растет линейно)
+OUTBOX_SEND_LEASE = 60.0            # Через сколько зависшая отправка снова берется в работу (сек)
+OUTBOX_POLL_INTERVAL = 1.0          # Максимальная пауза диспетчера без новых сообщений (сек)
+OUTBOX_FETCH_LIMIT = 200            # Чатов за один проход диспетчера
+OUTBOX_SEND_WAIT = 3.0              # Сколько send-message ждет фактической отправки (сек)
+OUTBOX_BATCH_MAX = 100              # Сообщений в одном запросе send-batch
+OUTBOX_LATENCY_WINDOW = 1000        # Последних доставок для статистики задержки
+OUTBOX_RETENTION_HOURS = 24         # Сколько хранить отправленные сообщения
 
 # Email константы
 EMAIL_ESCALATION_SUBJECT = "🚨 Sulpak HelpDesk - Escalation Required"
@@ -38,9 +82,114 @@ EMAIL_FROM_NAME = "Sulpak AI HelpDesk"
 
 # Таймауты (в секундах)
 HTTP_TIMEOUT = 10.0
+
+# HTTP клиент бота к backend (keep-alive пул)
+BOT_HTTP_MAX_CONNECTIONS = 20
+BOT_HTTP_MAX_KEEPALIVE = 10
+BOT_HTTP_KEEPALIVE_EXPIRY = 60.0
+
+# Кэш сессий пользователей в боте
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = 300.0           # Сек; ограничивает устаревание при нескольких экземплярах бота
+SESSION_CACHE_STATS_INTERVAL = 300.0
 WEBHOOK_TIMEOUT = 5.0
 AI_RESPONSE_TIMEOUT = 30.0
 
+# HTTP клиенты LLM провайдеров (keep-alive пул)
+AI_HTTP_MAX_CONNECTIONS = 20
+AI_HTTP_MAX_KEEPALIVE = 10
+AI_HTTP_KEEPALIVE_EXPIRY = 60.0
+
+# Планировщик запросов к модели (llm_scheduler.py)
+LLM_PRIORITY_FIRST_REPLY = 0  # Первый ответ в новом тикете
+LLM_PRIORITY_REPLY = 1  # Ответ в продолжающемся диалоге
+LLM_PRIORITY_SUMMARY = 2  # Резюме и краткое содержание (фон)
+LLM_MAX_IN_FLIGHT = 4  # Одновременных запросов к модели (OLLAMA_NUM_PARALLEL)
+LLM_QUEUE_SIZE = 64  # Максимум ожидающих запросов, дальше - отказ
+LLM_QUEUE_TIMEOUTS = {  # Сколько запрос может ждать слот (сек)
+    LLM_PRIORITY_FIRST_REPLY: 10.0,
+    LLM_PRIORITY_REPLY: 15.0,
+    LLM_PRIORITY_SUMMARY: 120.0
+}
+LLM_WAIT_WINDOW = 1000  # Окно замеров ожидания для перцентилей
+
+# Несколько Ollama серверов (llm_router.py)
+OLLAMA_HEALTH_INTERVAL = 10.0  # Период проверки /api/tags (сек, 0 - не проверять)
+OLLAMA_HEALTH_TIMEOUT = 3.0  # Таймаут проверки (сек)
+OLLAMA_EJECT_FAILURES = 3  # Ошибок подряд до исключения сервера из ротации
+OLLAMA_EJECT_SECONDS = 30.0  # На сколько исключается сервер (или до OLLAMA_RECOVERY_PROBES проверок)
+OLLAMA_RECOVERY_PROBES = 3  # Успешных проверок /api/tags подряд до досрочного возврата сервера
+OLLAMA_LATENCY_WINDOW = 200  # Окно замеров задержки на сервер
+
+# Очередь AI задач (ai_jobs)
+JOB_GENERATE = 'generate'   # Генерация AI ответа
+JOB_DELIVER = 'deliver'     # Доставка AI ответа в Telegram через webhook
+JOB_ESCALATE = 'escalate'   # Эскалация тикета (резюме уже накоплено), ставит JOB_NOTIFY
+JOB_SUMMARIZE = 'summarize' # Фоновое обновление резюме тикета (ai_summary)
+JOB_NOTIFY = 'notify'       # Email менеджеру об эскалации (повторяется при ошибке SMTP)
+JOB_LEARN = 'learn'         # Ответ решенного тикета - в кэш типовых вопросов воркера
+
+JOB_STATUS_PENDING = 'pending'
+JOB_STATUS_RUNNING = 'running'
+JOB_STATUS_DONE = 'done'
+JOB_STATUS_FAILED = 'failed'
+
+AI_WORKERS_DEFAULT = 2          # Количество воркеров внутри процесса API сервера
+JOB_POLL_INTERVAL = 0.5         # Пауза воркера при пустой очереди (сек)
+JOB_LEASE_TIMEOUT = 120.0       # Через сколько секунд зависшая задача снова доступна (сек)
+JOB_HEARTBEAT_INTERVAL = 30.0   # Продление lease, пока обработчик работает (сек, меньше JOB_LEASE_TIMEOUT)
+JOB_MAX_ATTEMPTS = 3            # Максимум попыток выполнения задачи
+JOB_RETRY_DELAY = 5.0           # Базовая задержка перед повтором (сек, растет линейно)
+JOB_REAP_INTERVAL = 30.0        # Как часто задачи с истекшим lease и без попыток переводятся в failed (сек)
+JOB_RETENTION_HOURS = 72        # Сколько хранить завершенные (done / failed) задачи
+
+# Серия сообщений пользователя -> одна генерация AI ответа
+GENERATE_DEBOUNCE = 1.5         # Генерация ждет новых сообщений тикета столько секунд (0 - без ожидания)
+GENERATE_DEBOUNCE_MAX = 6.0     # Но не дольше этого от первого сообщения серии (сек)
+MEDIA_GROUP_WAIT = 1.0          # Бот собирает фото альбома (media_group_id) столько секунд
+MEDIA_GROUP_MAX_ITEMS = 10      # Максимум фото/видео в альбоме Telegram
+GENERATE_SUPERSEDE_CHECK = 1.0  # Как часто идущая генерация проверяет, не написал ли пользователь еще (сек)
+
+# Пул соединений PostgreSQL
+DB_POOL_MIN_SIZE = 5
+DB_POOL_MAX_SIZE = 20
+DB_LEASE_BUDGET = 1.0           # Предупреждение, если соединение удерживается дольше (сек)
+
+# Трассировка запросов (tracing.py)
+TRACE_FLUSH_INTERVAL = 2.0      # Как часто буфер спанов выгружается в файл/коллектор (сек)
+TRACE_BUFFER_MAX = 10000        # Спаны сверх буфера отбрасываются, если экспорт не успевает
+TRACE_EXPORT_TIMEOUT = 5.0      # Таймаут отправки в OTLP коллектор (сек)
+
+# Live поток событий (SSE + PostgreSQL LISTEN/NOTIFY)
+EVENTS_CHANNEL = 'ticket_events'
+EVENT_TICKET_CREATED = 'ticket_created'
+EVENT_MESSAGE_ADDED = 'message_added'
+EVENT_STATUS_CHANGED = 'status_changed'
+EVENT_RESYNC = 'resync'             # Пропущенные события не восстановить точно - клиент перезагружает данные
+EVENTS_HEARTBEAT_INTERVAL = 15.0    # Комментарий-пинг в SSE потоке (сек)
+EVENTS_SUBSCRIBER_QUEUE = 1000      # Буфер событий на одного подписчика
+EVENTS_REPLAY_LIMIT = 1000          # Максимум событий при возобновлении по Last-Event-ID
+EVENTS_RETENTION_HOURS = 24         # Сколько хранить события для возобновления
+EVENTS_RECONNECT_DELAY = 2.0        # Пауза перед переподключением LISTEN соединения (сек)
+
+# Пагинация списка тикетов
+TICKETS_PAGE_SIZE_DEFAULT = 50
+TICKETS_PAGE_SIZE_MAX = 200
+
+# Инкрементальная загрузка сообщений тикета (?after_id=)
+MESSAGES_PAGE_SIZE_DEFAULT = 100
+MESSAGES_PAGE_SIZE_MAX = 500
+
+# Полнотекстовый поиск по переписке (GET /api/v1/search)
+SEARCH_CONFIG = 'russian'           # Конфигурация текстового поиска PostgreSQL (стемминг)
+SEARCH_PAGE_SIZE_DEFAULT = 20
+SEARCH_PAGE_SIZE_MAX = 100
+SEARCH_CANDIDATES = 1000            # Сколько последних совпадений каждого источника ранжируется
+SEARCH_WINDOW_DAYS = 90             # Поиск по тексту за последние N дней (граница сканирования)
+SEARCH_WINDOW_DAYS_MAX = 730        # Максимальное окно, которое можно запросить (?days=)
+SEARCH_QUERY_MAX_LENGTH = 200       # Максимальная длина запроса (символов)
+SEARCH_SNIPPET_WORDS = 20           # Длина фрагмента с подсветкой (слов)
+
 # Интервалы обновления (в миллисекундах для фронтенда)
 TICKETS_UPDATE_INTERVAL = 5000
 MESSAGES_UPDATE_INTERVAL = 3000
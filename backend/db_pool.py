@@ -0,0 +1,142 @@
+"""
+DB Pool - instrumented wrapper around asyncpg.Pool
+Records acquire wait time, lease duration per label (endpoint / job step)
+and pool saturation; warns when a connection is held longer than the budget.
+"""
+
+import time
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+import asyncpg
+from constants import DB_LEASE_BUDGET
+from metrics import gauge, histogram
+from tracing import span, SPAN_CLIENT
+
+logger = logging.getLogger(__name__)
+
+# Метка lease - endpoint или шаг задачи, т.е. семейство SQL запросов
+DB_WAIT_SECONDS = histogram('helpdesk_db_acquire_wait_seconds', 'Wait for a pooled DB connection', ('label',))
+DB_LEASE_SECONDS = histogram('helpdesk_db_lease_seconds', 'DB connection hold time per statement family', ('label',))
+DB_POOL_CONNECTIONS = gauge('helpdesk_db_pool_connections', 'asyncpg pool connections by state', ('state',))
+
+
+class LeaseStats:
+    """Aggregated acquire/lease timings for one label"""
+
+    __slots__ = ('count', 'wait_total', 'wait_max', 'lease_total', 'lease_max', 'over_budget')
+
+    def __init__(self):
+        self.count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.lease_total = 0.0
+        self.lease_max = 0.0
+        self.over_budget = 0
+
+    def to_dict(self) -> Dict:
+        return {
+            'count': self.count,
+            'wait_avg_ms': round(self.wait_total / self.count * 1000, 2) if self.count else 0.0,
+            'wait_max_ms': round(self.wait_max * 1000, 2),
+            'lease_avg_ms': round(self.lease_total / self.count * 1000, 2) if self.count else 0.0,
+            'lease_max_ms': round(self.lease_max * 1000, 2),
+            'over_budget': self.over_budget
+        }
+
+
+class InstrumentedPool:
+    """
+    asyncpg.Pool with per-label lease accounting
+
+    Usage:
+        async with db_pool.acquire('get_tickets') as conn:
+            ...
+
+    Other pool methods (close, get_size, ...) are delegated to asyncpg.Pool.
+    """
+
+    def __init__(self, pool: asyncpg.Pool, lease_budget: float = DB_LEASE_BUDGET):
+        self._pool = pool
+        self.lease_budget = lease_budget
+        self.stats: Dict[str, LeaseStats] = {}
+        self.in_use = 0
+        self.in_use_peak = 0
+        self.waiting = 0
+        self.waiting_peak = 0
+
+        DB_POOL_CONNECTIONS.set_function(self._pool.get_size, 'open')
+        DB_POOL_CONNECTIONS.set_function(self._pool.get_idle_size, 'idle')
+        DB_POOL_CONNECTIONS.set_function(self._pool.get_max_size, 'max')
+        DB_POOL_CONNECTIONS.set_function(lambda: self.in_use, 'in_use')
+        DB_POOL_CONNECTIONS.set_function(lambda: self.waiting, 'waiting')
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    @asynccontextmanager
+    async def acquire(self, label: str = 'default', timeout: Optional[float] = None):
+        with span(f'db {label}', SPAN_CLIENT) as lease_span:
+            self.waiting += 1
+            self.waiting_peak = max(self.waiting_peak, self.waiting)
+            wait_start = time.perf_counter()
+            try:
+                conn = await self._pool.acquire(timeout=timeout)
+            finally:
+                self.waiting -= 1
+            acquired_at = time.perf_counter()
+            if lease_span is not None:
+                lease_span.set('wait_ms', round((acquired_at - wait_start) * 1000, 2))
+
+            self.in_use += 1
+            self.in_use_peak = max(self.in_use_peak, self.in_use)
+            try:
+                yield conn
+            finally:
+                self.in_use -= 1
+                released_at = time.perf_counter()
+                try:
+                    await self._pool.release(conn)
+                finally:
+                    self._record(label, acquired_at - wait_start, released_at - acquired_at)
+
+    def _record(self, label: str, wait: float, lease: float):
+        DB_WAIT_SECONDS.observe(wait, label)
+        DB_LEASE_SECONDS.observe(lease, label)
+        stats = self.stats.get(label)
+        if stats is None:
+            stats = self.stats[label] = LeaseStats()
+        stats.count += 1
+        stats.wait_total += wait
+        stats.wait_max = max(stats.wait_max, wait)
+        stats.lease_total += lease
+        stats.lease_max = max(stats.lease_max, lease)
+
+        if lease > self.lease_budget:
+            stats.over_budget += 1
+            logger.warning(
+                f"DB connection held too long | {label}: {lease * 1000:.0f}ms "
+                f"(budget {self.lease_budget * 1000:.0f}ms, waited {wait * 1000:.0f}ms)"
+            )
+
+    def snapshot(self) -> Dict:
+        """Current pool state and per-label statistics"""
+        max_size = self._pool.get_max_size()
+        return {
+            'size': self._pool.get_size(),
+            'idle': self._pool.get_idle_size(),
+            'max_size': max_size,
+            'in_use': self.in_use,
+            'in_use_peak': self.in_use_peak,
+            'waiting': self.waiting,
+            'waiting_peak': self.waiting_peak,
+            'saturation': round(self.in_use / max_size, 3) if max_size else 0.0,
+            'lease_budget_ms': round(self.lease_budget * 1000, 2),
+            'leases': {label: stats.to_dict() for label, stats in sorted(self.stats.items())}
+        }
+
+
+async def create_pool(lease_budget: float = DB_LEASE_BUDGET, **kwargs) -> InstrumentedPool:
+    """Create asyncpg pool wrapped with lease instrumentation"""
+    pool = await asyncpg.create_pool(**kwargs)
+    return InstrumentedPool(pool, lease_budget=lease_budget)
@@ -17,12 +17,16 @@ from constants import (
     SENDER_USER,
     SENDER_AI
 )
+from metrics import histogram
+from tracing import span, SPAN_CLIENT
 
 # Load environment variables
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+SMTP_SEND_SECONDS = histogram('helpdesk_smtp_send_seconds', 'Escalation email SMTP send duration')
+
 
 class EmailService:
     """Email notification service for manager escalations"""
@@ -38,7 +42,8 @@ class EmailService:
         self.from_name = EMAIL_FROM_NAME
 
         # Validate configuration
-        if not all([self.smtp_username, self.smtp_password, self.manager_email]):
+        self.configured = all([self.smtp_username, self.smtp_password, self.manager_email])
+        if not self.configured:
             logger.warning(
                 "Email service not fully configured. "
                 "Set SMTP_USERNAME, SMTP_PASSWORD, MANAGER_EMAIL in .env"
@@ -219,7 +224,7 @@ class EmailService:
         Returns:
             True if email sent successfully, False otherwise
         """
-        if not all([self.smtp_username, self.smtp_password, self.manager_email]):
+        if not self.configured:
             logger.error("Email service not configured. Skipping email send.")
             return False
 
@@ -249,15 +254,16 @@ class EmailService:
             use_tls = os.getenv('SMTP_USE_TLS', 'true').lower() == 'true'
             use_ssl = os.getenv('SMTP_USE_SSL', 'false').lower() == 'true'
 
-            await aiosmtplib.send(
-                message,
-                hostname=self.smtp_host,
-                port=self.smtp_port,
-                username=self.smtp_username,
-                password=self.smtp_password,
-                start_tls=use_tls,
-                use_tls=use_ssl
-            )
+            with SMTP_SEND_SECONDS.time(), span('smtp.send', SPAN_CLIENT, ticket_id=ticket_id):
+                await aiosmtplib.send(
+                    message,
+                    hostname=self.smtp_host,
+                    port=self.smtp_port,
+                    username=self.smtp_username,
+                    password=self.smtp_password,
+                    start_tls=use_tls,
+                    use_tls=use_ssl
+                )
 
             logger.info(
                 f"Escalation email sent successfully for ticket {ticket_number} "
@@ -0,0 +1,326 @@
+"""
+Event Feed - live ticket events from PostgreSQL LISTEN/NOTIFY
+Write paths emit events through triggers (ticket created, message added,
+status changed); every API process LISTENs and fans events out to its SSE
+subscribers. Events are also stored in ticket_events so a reconnecting client
+can resume from its Last-Event-ID.
+
+Ordering: event ids come from a sequence taken inside the writing transaction,
+so a lower id may commit after a higher one (NOTIFY is delivered in commit
+order, the ids are not). Resuming by `id > Last-Event-ID` would skip such a
+late event, so the hub remembers which ids arrived late; when a resume could
+have missed one, when more than EVENTS_REPLAY_LIMIT events were missed or the
+resume point was already pruned, the client gets a `resync` event instead of a
+replay and reloads its data.
+"""
+
+import json
+import asyncio
+import logging
+from collections import deque
+from typing import Dict, List, Optional, Set, Tuple
+import asyncpg
+from db_pool import InstrumentedPool
+from constants import (
+    EVENTS_CHANNEL,
+    EVENT_TICKET_CREATED,
+    EVENT_MESSAGE_ADDED,
+    EVENT_STATUS_CHANGED,
+    EVENT_RESYNC,
+    EVENTS_SUBSCRIBER_QUEUE,
+    EVENTS_REPLAY_LIMIT,
+    EVENTS_RETENTION_HOURS,
+    EVENTS_RECONNECT_DELAY
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def init_events_schema(conn: asyncpg.Connection):
+    """Create ticket_events table and the triggers that emit events"""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS ticket_events (
+            id BIGSERIAL PRIMARY KEY,
+            event_type VARCHAR(30) NOT NULL,
+            ticket_id INT,
+            payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+    ''')
+
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_ticket_events_created_at
+        ON ticket_events(created_at);
+    ''')
+
+    # Событие сохраняется и публикуется в одной транзакции с изменением данных;
+    # NOTIFY доставляется слушателям только после COMMIT
+    await conn.execute(f'''
+        CREATE OR REPLACE FUNCTION emit_ticket_event(p_type TEXT, p_ticket_id INT, p_payload JSONB)
+        RETURNS VOID AS $$
+        DECLARE
+            v_id BIGINT;
+        BEGIN
+            INSERT INTO ticket_events (event_type, ticket_id, payload)
+            VALUES (p_type, p_ticket_id, p_payload)
+            RETURNING id INTO v_id;
+
+            PERFORM pg_notify('{EVENTS_CHANNEL}', json_build_object(
+                'id', v_id, 'type', p_type, 'ticketId', p_ticket_id, 'data', p_payload
+            )::text);
+        END;
+        $$ LANGUAGE plpgsql;
+    ''')
+
+    await conn.execute(f'''
+        CREATE OR REPLACE FUNCTION tickets_emit_event() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM emit_ticket_event('{EVENT_TICKET_CREATED}', NEW.id, jsonb_build_object(
+                    'ticketNumber', NEW.ticket_number, 'status', NEW.status
+                ));
+            ELSIF NEW.status IS DISTINCT FROM OLD.status THEN
+                PERFORM emit_ticket_event('{EVENT_STATUS_CHANGED}', NEW.id, jsonb_build_object(
+                    'status', NEW.status, 'previousStatus', OLD.status
+                ));
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    ''')
+
+    await conn.execute(f'''
+        CREATE OR REPLACE FUNCTION messages_emit_event() RETURNS trigger AS $$
+        BEGIN
+            PERFORM emit_ticket_event('{EVENT_MESSAGE_ADDED}', NEW.ticket_id, jsonb_build_object(
+                'messageId', NEW.id, 'senderType', NEW.sender_type
+            ));
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    ''')
+
+    await conn.execute('''
+        DROP TRIGGER IF EXISTS trg_tickets_emit_event ON tickets;
+        CREATE TRIGGER trg_tickets_emit_event
+        AFTER INSERT OR UPDATE OF status ON tickets
+        FOR EACH ROW EXECUTE FUNCTION tickets_emit_event();
+    ''')
+
+    await conn.execute('''
+        DROP TRIGGER IF EXISTS trg_messages_emit_event ON messages;
+        CREATE TRIGGER trg_messages_emit_event
+        AFTER INSERT ON messages
+        FOR EACH ROW EXECUTE FUNCTION messages_emit_event();
+    ''')
+
+
+def _event_from_row(row: asyncpg.Record) -> Dict:
+    payload = row['payload']
+    return {
+        'id': row['id'],
+        'type': row['event_type'],
+        'ticketId': row['ticket_id'],
+        'data': json.loads(payload) if isinstance(payload, str) else payload
+    }
+
+
+class Subscription:
+    """Event queue of one SSE client; None in the queue means the client fell behind"""
+
+    def __init__(self, ticket_id: Optional[int] = None):
+        self.ticket_id = ticket_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=EVENTS_SUBSCRIBER_QUEUE)
+        self.overflowed = False
+
+    def offer(self, event: Dict):
+        if self.overflowed:
+            return
+        if self.ticket_id is not None and event['type'] != EVENT_RESYNC and event['ticketId'] != self.ticket_id:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Клиент не успевает читать: закрываем поток, он переподключится с Last-Event-ID
+            self.close()
+
+    def close(self):
+        """End the stream: the next read returns None"""
+        self.overflowed = True
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+class EventHub:
+    """
+    One LISTEN connection per API process, fanned out to in-process subscribers
+
+    The LISTEN connection is opened outside the pool: it is held for the whole
+    process lifetime and must not count against request connections.
+    """
+
+    def __init__(self, pool: InstrumentedPool, connect_kwargs: Dict):
+        self.pool = pool
+        self.connect_kwargs = connect_kwargs
+        self.subscribers: Set[Subscription] = set()
+        self.last_event_id = 0
+        # Первое событие, которое видел этот процесс; про более ранние порядок неизвестен
+        self.started_from = 0
+        # (id опоздавшего события, максимальный id, уже опубликованный до него)
+        self.late_events: deque = deque(maxlen=EVENTS_REPLAY_LIMIT)
+        self.late_tracked_from = 0
+        self._conn: Optional[asyncpg.Connection] = None
+        self._connection_lost = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        async with self.pool.acquire('event_hub.start') as conn:
+            self.last_event_id = await conn.fetchval('SELECT COALESCE(MAX(id), 0) FROM ticket_events')
+        self.started_from = self.last_event_id
+        await self._connect()
+        self._tasks = [
+            asyncio.create_task(self._supervise()),
+            asyncio.create_task(self._prune_periodically())
+        ]
+        logger.info(f"Event hub listening on '{EVENTS_CHANNEL}' from event #{self.last_event_id}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._conn and not self._conn.is_closed():
+            await self._conn.close()
+        for sub in list(self.subscribers):
+            sub.close()
+
+    def subscribe(self, ticket_id: Optional[int] = None) -> Subscription:
+        sub = Subscription(ticket_id)
+        self.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        self.subscribers.discard(sub)
+
+    async def fetch_since(
+        self,
+        last_event_id: int,
+        ticket_id: Optional[int] = None,
+        limit: int = EVENTS_REPLAY_LIMIT
+    ) -> List[Dict]:
+        """Stored events after last_event_id (for resuming a stream)"""
+        async with self.pool.acquire('event_hub.fetch_since') as conn:
+            rows = await conn.fetch(
+                '''SELECT * FROM ticket_events
+                   WHERE id > $1 AND ($2::int IS NULL OR ticket_id = $2)
+                   ORDER BY id ASC LIMIT $3''',
+                last_event_id, ticket_id, limit
+            )
+        return [_event_from_row(row) for row in rows]
+
+    def may_have_missed(self, last_event_id: int) -> bool:
+        """True if an event with a lower id may have committed after the client saw last_event_id"""
+        if last_event_id <= self.started_from or last_event_id <= self.late_tracked_from:
+            return True
+        return any(late_id < last_event_id <= seen for late_id, seen in self.late_events)
+
+    async def resume(self, last_event_id: int, ticket_id: Optional[int] = None) -> Tuple[List[Dict], Optional[str]]:
+        """
+        Events missed since last_event_id
+
+        Returns:
+            (events, None), or ([], reason) when the events cannot be replayed
+            exactly and the client has to resync
+        """
+        if self.may_have_missed(last_event_id):
+            return [], 'late events'
+        async with self.pool.acquire('event_hub.resume') as conn:
+            known = await conn.fetchval('SELECT EXISTS (SELECT 1 FROM ticket_events WHERE id = $1)', last_event_id)
+        if not known:
+            return [], 'resume point expired'
+        events = await self.fetch_since(last_event_id, ticket_id, EVENTS_REPLAY_LIMIT + 1)
+        if len(events) > EVENTS_REPLAY_LIMIT:
+            return [], 'too many missed events'
+        return events, None
+
+    def resync_event(self, reason: str) -> Dict:
+        """Tells the client to reload; its id lets the next reconnect resume from here"""
+        return {'id': self.last_event_id, 'type': EVENT_RESYNC, 'ticketId': None, 'data': {'reason': reason}}
+
+    def _publish(self, event: Dict):
+        if event['id'] < self.last_event_id:
+            # Закоммичено позже события с большим id: возобновление по id могло его пропустить
+            if len(self.late_events) == self.late_events.maxlen:
+                self.late_tracked_from = self.late_events[0][1]
+            self.late_events.append((event['id'], self.last_event_id))
+        self.last_event_id = max(self.last_event_id, event['id'])
+        for sub in list(self.subscribers):
+            sub.offer(event)
+
+    def _on_notify(self, conn, pid, channel, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            logger.error(f"Invalid event payload: {payload[:200]}")
+            return
+        self._publish(event)
+
+    def _on_termination(self, conn):
+        self._connection_lost.set()
+
+    async def _connect(self):
+        self._connection_lost.clear()
+        self._conn = await asyncpg.connect(**self.connect_kwargs)
+        self._conn.add_termination_listener(self._on_termination)
+        await self._conn.add_listener(EVENTS_CHANNEL, self._on_notify)
+
+    async def _supervise(self):
+        """Reconnect the LISTEN connection and replay events missed while it was down"""
+        while True:
+            await self._connection_lost.wait()
+            logger.warning("Event hub LISTEN connection lost, reconnecting")
+            while True:
+                await asyncio.sleep(EVENTS_RECONNECT_DELAY)
+                try:
+                    await self._connect()
+                    break
+                except Exception as e:
+                    logger.error(f"Event hub reconnect failed: {e}")
+
+            try:
+                for event in await self.fetch_since(self.last_event_id):
+                    self._publish(event)
+            except Exception as e:
+                logger.error(f"Event hub replay failed: {e}", exc_info=True)
+
+            # Пока LISTEN не работал, события с меньшим id могли закоммититься незамеченными
+            resync = self.resync_event('event hub reconnected')
+            self.started_from = self.last_event_id
+            for sub in list(self.subscribers):
+                sub.offer(resync)
+
+    async def _prune_periodically(self):
+        while True:
+            try:
+                deleted = await prune_events(self.pool)
+                if deleted:
+                    logger.info(f"Pruned {deleted} old ticket events")
+            except Exception as e:
+                logger.error(f"Event prune failed: {e}")
+            await asyncio.sleep(3600)
+
+
+async def prune_events(pool: InstrumentedPool, retention_hours: int = EVENTS_RETENTION_HOURS) -> int:
+    """Delete events older than the retention window"""
+    async with pool.acquire('event_feed.prune') as conn:
+        result = await conn.execute(
+            'DELETE FROM ticket_events WHERE created_at < NOW() - make_interval(hours => $1)',
+            retention_hours
+        )
+    return int(result.split()[-1])
+
+
+def format_sse(event: Dict) -> str:
+    """Serialize event as a Server-Sent Events frame"""
+    data = json.dumps(event, ensure_ascii=False, default=str)
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
@@ -0,0 +1,298 @@
+"""
+Job Queue - durable Postgres-backed queue for AI work
+Workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED, so any number of
+worker processes can share one table without double-processing a job.
+"""
+
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+import asyncpg
+from db_pool import InstrumentedPool
+from tracing import current_traceparent, TRACEPARENT_HEADER
+from constants import (
+    JOB_STATUS_PENDING,
+    JOB_STATUS_RUNNING,
+    JOB_STATUS_DONE,
+    JOB_STATUS_FAILED,
+    JOB_LEASE_TIMEOUT,
+    JOB_MAX_ATTEMPTS,
+    JOB_RETRY_DELAY,
+    JOB_RETENTION_HOURS
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def init_jobs_schema(conn: asyncpg.Connection):
+    """Create ai_jobs table and indexes"""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS ai_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            kind VARCHAR(30) NOT NULL,
+            ticket_id INT REFERENCES tickets(id),
+            payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            max_attempts INT NOT NULL DEFAULT 3,
+            last_error TEXT,
+            run_after TIMESTAMP NOT NULL DEFAULT NOW(),
+            locked_until TIMESTAMP,
+            worker_id VARCHAR(100),
+            created_at TIMESTAMP DEFAULT NOW(),
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        );
+    ''')
+
+    # Частичные индексы: воркеры смотрят только на незавершенные задачи
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_ai_jobs_pending
+        ON ai_jobs(run_after) WHERE status = 'pending';
+    ''')
+
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_ai_jobs_running
+        ON ai_jobs(locked_until) WHERE status = 'running';
+    ''')
+
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_ai_jobs_ticket_id
+        ON ai_jobs(ticket_id);
+    ''')
+
+
+def _with_trace(payload: Optional[Dict]) -> Dict:
+    # Воркер продолжит трейс запроса, поставившего задачу
+    traceparent = current_traceparent()
+    return {**(payload or {}), TRACEPARENT_HEADER: traceparent} if traceparent else (payload or {})
+
+
+async def enqueue_job(
+    conn: asyncpg.Connection,
+    kind: str,
+    ticket_id: Optional[int],
+    payload: Optional[Dict] = None,
+    max_attempts: int = JOB_MAX_ATTEMPTS
+) -> int:
+    """
+    Add a job to the queue
+
+    Call it on the same connection (and transaction) that writes the data the
+    job depends on, so the job becomes visible only together with that data.
+
+    Returns:
+        Job ID
+    """
+    return await conn.fetchval(
+        '''INSERT INTO ai_jobs (kind, ticket_id, payload, max_attempts)
+           VALUES ($1, $2, $3::jsonb, $4) RETURNING id''',
+        kind, ticket_id, json.dumps(_with_trace(payload)), max_attempts
+    )
+
+
+async def enqueue_debounced_job(
+    conn: asyncpg.Connection,
+    kind: str,
+    ticket_id: int,
+    payload: Dict,
+    delay: float,
+    max_delay: float
+) -> Tuple[int, bool]:
+    """
+    Add a job that runs after `delay` seconds, merging it into a pending job of
+    the same kind for the ticket if one has not been claimed yet
+
+    The merged job gets the new payload and its start is pushed back by `delay`,
+    but never later than `max_delay` after it was first queued.
+
+    Returns:
+        (job ID, True if merged into an existing job)
+    """
+    payload = _with_trace(payload)
+    # Захваченная воркером задача исключается: FOR UPDATE перепроверяет статус после ожидания блокировки
+    job_id = await conn.fetchval(
+        '''UPDATE ai_jobs SET
+               payload = $3::jsonb,
+               run_after = LEAST(NOW() + make_interval(secs => $4), created_at + make_interval(secs => $5))
+           WHERE id = (
+               SELECT id FROM ai_jobs
+               WHERE ticket_id = $1 AND kind = $2 AND status = $6
+               ORDER BY id DESC
+               FOR UPDATE
+               LIMIT 1
+           )
+           RETURNING id''',
+        ticket_id, kind, json.dumps(payload), delay, max_delay, JOB_STATUS_PENDING
+    )
+    if job_id is not None:
+        return job_id, True
+
+    job_id = await conn.fetchval(
+        '''INSERT INTO ai_jobs (kind, ticket_id, payload, run_after)
+           VALUES ($1, $2, $3::jsonb, NOW() + make_interval(secs => $4)) RETURNING id''',
+        kind, ticket_id, json.dumps(payload), delay
+    )
+    return job_id, False
+
+
+async def claim_job(
+    pool: InstrumentedPool,
+    worker_id: str,
+    lease_timeout: float = JOB_LEASE_TIMEOUT
+) -> Optional[Dict]:
+    """
+    Claim the next runnable job
+
+    A job is runnable when it is pending and due, or when it is running but its
+    lease has expired (the worker that held it crashed or was restarted) and it
+    still has attempts left; exhausted ones are failed by fail_expired_jobs.
+    The claim commits immediately; the lease keeps other workers away.
+
+    Returns:
+        Job dict with decoded payload, or None if the queue is empty
+    """
+    async with pool.acquire('job_queue.claim') as conn:
+        job = await conn.fetchrow(
+            '''UPDATE ai_jobs SET
+                   status = $1,
+                   attempts = attempts + 1,
+                   locked_until = NOW() + make_interval(secs => $2),
+                   worker_id = $3,
+                   started_at = NOW()
+               WHERE id = (
+                   SELECT id FROM ai_jobs
+                   WHERE (status = $4 AND run_after <= NOW())
+                      OR (status = $1 AND locked_until < NOW() AND attempts < max_attempts)
+                   ORDER BY id
+                   FOR UPDATE SKIP LOCKED
+                   LIMIT 1
+               )
+               RETURNING *''',
+            JOB_STATUS_RUNNING, lease_timeout, worker_id, JOB_STATUS_PENDING
+        )
+
+    if not job:
+        return None
+
+    job = dict(job)
+    job['payload'] = json.loads(job['payload']) if job['payload'] else {}
+    return job
+
+
+async def complete_job(conn: asyncpg.Connection, job: Dict) -> bool:
+    """
+    Mark job as done
+
+    The attempt number acts as a fencing token: if the lease expired and another
+    worker re-claimed the job, this worker's completion is rejected.
+
+    Returns:
+        True if the job was still owned by this attempt
+    """
+    result = await conn.execute(
+        '''UPDATE ai_jobs SET status = $1, locked_until = NULL, finished_at = NOW()
+           WHERE id = $2 AND status = $3 AND attempts = $4''',
+        JOB_STATUS_DONE, job['id'], JOB_STATUS_RUNNING, job['attempts']
+    )
+    return result != 'UPDATE 0'
+
+
+async def extend_lease(conn: asyncpg.Connection, job: Dict, lease_timeout: float = JOB_LEASE_TIMEOUT) -> bool:
+    """
+    Push the lease of a running job forward (heartbeat of a long handler)
+
+    Returns:
+        True if the job is still owned by this attempt
+    """
+    result = await conn.execute(
+        '''UPDATE ai_jobs SET locked_until = NOW() + make_interval(secs => $1)
+           WHERE id = $2 AND status = $3 AND attempts = $4''',
+        lease_timeout, job['id'], JOB_STATUS_RUNNING, job['attempts']
+    )
+    return result != 'UPDATE 0'
+
+
+async def release_job(conn: asyncpg.Connection, job: Dict):
+    """Return a claimed job to the queue without counting the attempt (graceful shutdown)"""
+    await conn.execute(
+        '''UPDATE ai_jobs SET status = $1, attempts = attempts - 1, locked_until = NULL
+           WHERE id = $2 AND status = $3 AND attempts = $4''',
+        JOB_STATUS_PENDING, job['id'], JOB_STATUS_RUNNING, job['attempts']
+    )
+
+
+async def fail_job(conn: asyncpg.Connection, job: Dict, error: str) -> bool:
+    """
+    Record a failed attempt
+
+    Reschedules the job with a linear backoff while attempts remain. Like
+    complete_job, only the attempt that still owns the job is recorded: a job
+    already done (or re-claimed after its lease expired) is left as is.
+
+    Returns:
+        True if the job is now permanently failed (no attempts left)
+    """
+    if job['attempts'] >= job['max_attempts']:
+        result = await conn.execute(
+            '''UPDATE ai_jobs SET status = $1, last_error = $2, locked_until = NULL,
+                   finished_at = NOW()
+               WHERE id = $3 AND status = $4 AND attempts = $5''',
+            JOB_STATUS_FAILED, error, job['id'], JOB_STATUS_RUNNING, job['attempts']
+        )
+        return result != 'UPDATE 0'
+
+    await conn.execute(
+        '''UPDATE ai_jobs SET status = $1, last_error = $2, locked_until = NULL,
+               run_after = NOW() + make_interval(secs => $3)
+           WHERE id = $4 AND status = $5 AND attempts = $6''',
+        JOB_STATUS_PENDING, error, JOB_RETRY_DELAY * job['attempts'], job['id'], JOB_STATUS_RUNNING, job['attempts']
+    )
+    return False
+
+
+async def fail_expired_jobs(conn: asyncpg.Connection) -> List[Dict]:
+    """
+    Permanently fail running jobs whose lease expired on the last attempt
+
+    Such a job crashed or hung its worker every time; claim_job no longer picks
+    it up, so without this it would stay 'running' forever.
+
+    Returns:
+        The failed jobs with decoded payload (for the failure handlers)
+    """
+    rows = await conn.fetch(
+        '''UPDATE ai_jobs SET status = $1, locked_until = NULL, finished_at = NOW(),
+               last_error = 'Lease expired on attempt ' || attempts || ' of ' || max_attempts
+           WHERE status = $2 AND locked_until < NOW() AND attempts >= max_attempts
+           RETURNING *''',
+        JOB_STATUS_FAILED, JOB_STATUS_RUNNING
+    )
+    jobs = []
+    for row in rows:
+        job = dict(row)
+        job['payload'] = json.loads(job['payload']) if job['payload'] else {}
+        jobs.append(job)
+    return jobs
+
+
+async def prune_jobs(pool: InstrumentedPool, retention_hours: int = JOB_RETENTION_HOURS) -> int:
+    """Delete done and failed jobs older than the retention window"""
+    async with pool.acquire('job_queue.prune') as conn:
+        result = await conn.execute(
+            '''DELETE FROM ai_jobs
+               WHERE status IN ($1, $2) AND finished_at < NOW() - make_interval(hours => $3)''',
+            JOB_STATUS_DONE, JOB_STATUS_FAILED, retention_hours
+        )
+    return int(result.split()[-1])
+
+
+async def get_job(conn: asyncpg.Connection, job_id: int) -> Optional[Dict]:
+    """Get job by ID"""
+    job = await conn.fetchrow('SELECT * FROM ai_jobs WHERE id = $1', job_id)
+    if not job:
+        return None
+
+    job = dict(job)
+    job['payload'] = json.loads(job['payload']) if job['payload'] else {}
+    return job
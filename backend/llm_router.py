@@ -0,0 +1,238 @@
+"""
+LLM Router - spreads Ollama requests over several backends
+Backends are configured as a list with weights (OLLAMA_URLS); every request goes
+to the healthy backend with the fewest outstanding requests per weight. A
+backend that fails several requests in a row is ejected for a while, and a
+background probe (GET /api/tags) marks backends up or down and checks that the
+model is loaded there.
+
+An ejected backend comes back early only after OLLAMA_RECOVERY_PROBES
+successful probes in a row, and its failure streak is reset only by a real
+request that succeeds: a backend that answers /api/tags but fails generations
+is ejected again by its first failed request.
+
+    OLLAMA_URLS=http://ollama-1:11434=2,http://ollama-2:11434
+"""
+
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+import httpx
+from constants import (
+    OLLAMA_HEALTH_INTERVAL,
+    OLLAMA_HEALTH_TIMEOUT,
+    OLLAMA_EJECT_FAILURES,
+    OLLAMA_EJECT_SECONDS,
+    OLLAMA_RECOVERY_PROBES,
+    OLLAMA_LATENCY_WINDOW
+)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_backends(spec: str) -> List[Tuple[str, float]]:
+    """'url[=weight],url[=weight]' -> [(url, weight)]"""
+    backends = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        url, weight = item, 1.0
+        head, _, tail = item.rpartition('=')
+        if head:
+            try:
+                url, weight = head, float(tail)
+            except ValueError:
+                pass
+        backends.append((url.rstrip('/'), weight))
+    if not backends:
+        raise ValueError("No Ollama backends configured")
+    return backends
+
+
+def _is_backend_failure(error: BaseException) -> bool:
+    """Errors that say something about the backend (not about the request)"""
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return False
+
+
+class OllamaBackend:
+    """One Ollama instance: pooled client, load and health state, latency stats"""
+
+    def __init__(self, url: str, weight: float = 1.0):
+        self.url = url
+        self.weight = max(weight, 0.01)
+        self.client: Optional[httpx.AsyncClient] = None
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        # Успешные проверки подряд, пока сервер исключен
+        self.recovery_probes = 0
+        self.healthy = True
+        self.health_error: Optional[str] = None
+        self.ejected_until = 0.0
+        self._latencies = deque(maxlen=OLLAMA_LATENCY_WINDOW)
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and time.monotonic() >= self.ejected_until
+
+    def load(self) -> float:
+        return (self.outstanding + 1) / self.weight
+
+    def latency_avg(self) -> float:
+        return sum(self._latencies) / len(self._latencies) if self._latencies else 0.0
+
+    def record_success(self, elapsed: float):
+        self.consecutive_failures = 0
+        self._latencies.append(elapsed)
+
+    def record_failure(self, error: BaseException):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.recovery_probes = 0
+        if self.consecutive_failures >= OLLAMA_EJECT_FAILURES:
+            self.ejected_until = time.monotonic() + OLLAMA_EJECT_SECONDS
+            logger.warning(
+                f"Ollama backend {self.url} ejected for {OLLAMA_EJECT_SECONDS:.0f}s "
+                f"after {self.consecutive_failures} failures: {error!r}"
+            )
+
+    def stats(self) -> Dict:
+        latencies = sorted(self._latencies)
+        return {
+            'url': self.url,
+            'weight': self.weight,
+            'healthy': self.healthy,
+            'health_error': self.health_error,
+            'ejected_for_s': round(max(self.ejected_until - time.monotonic(), 0.0), 1),
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'failures': self.failures,
+            'latency_avg_ms': round(self.latency_avg() * 1000, 1),
+            'latency_p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 1) if latencies else 0.0
+        }
+
+
+class OllamaRouter:
+    """Least-outstanding-requests balancing over weighted Ollama backends"""
+
+    def __init__(self, backends: List[Tuple[str, float]], model: str, client_kwargs: Optional[Dict] = None):
+        self.backends = [OllamaBackend(url, weight) for url, weight in backends]
+        self.model = model
+        # timeout/limits/event_hooks (и transport в тестах) для клиентов всех бэкендов
+        self.client_kwargs = client_kwargs or {}
+        self._health_task: Optional[asyncio.Task] = None
+
+    def _client(self, backend: OllamaBackend) -> httpx.AsyncClient:
+        if backend.client is None:
+            backend.client = httpx.AsyncClient(base_url=backend.url, **self.client_kwargs)
+        return backend.client
+
+    async def start(self):
+        for backend in self.backends:
+            self._client(backend)
+        if OLLAMA_HEALTH_INTERVAL > 0:
+            await self.check_health()
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+        for backend in self.backends:
+            if backend.client is not None:
+                await backend.client.aclose()
+                backend.client = None
+
+    def select(self, exclude: Optional[OllamaBackend] = None) -> OllamaBackend:
+        candidates = [b for b in self.backends if b.available and b is not exclude]
+        if not candidates:
+            # Все бэкенды недоступны - пробуем наименее загруженный, а не отказываем сразу
+            candidates = [b for b in self.backends if b is not exclude] or self.backends
+        return min(candidates, key=lambda b: (b.load(), b.latency_avg()))
+
+    @asynccontextmanager
+    async def request(self, exclude: Optional[OllamaBackend] = None):
+        """Pick a backend and account the request on it; yields (backend, client)"""
+        backend = self.select(exclude)
+        backend.outstanding += 1
+        backend.requests += 1
+        started = time.perf_counter()
+        try:
+            yield backend, self._client(backend)
+        except BaseException as e:
+            if _is_backend_failure(e):
+                backend.record_failure(e)
+            raise
+        else:
+            backend.record_success(time.perf_counter() - started)
+        finally:
+            backend.outstanding -= 1
+
+    async def post_json(self, path: str, payload: Dict) -> Dict:
+        """POST with one failover to another backend on connection-level errors"""
+        tried: Optional[OllamaBackend] = None
+        for attempt in range(2 if len(self.backends) > 1 else 1):
+            try:
+                async with self.request(exclude=tried) as (backend, client):
+                    tried = backend
+                    response = await client.post(path, json=payload)
+                    response.raise_for_status()
+                    return response.json()
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                if attempt or len(self.backends) == 1:
+                    raise
+                logger.warning(f"Ollama backend {tried.url} unreachable, retrying on another: {e!r}")
+
+    async def _probe(self, backend: OllamaBackend):
+        try:
+            response = await self._client(backend).get('/api/tags', timeout=OLLAMA_HEALTH_TIMEOUT)
+            response.raise_for_status()
+            models = response.json().get('models', [])
+            names = {m.get('name') for m in models} | {m.get('model') for m in models}
+            # "llama3.2" в AI_MODEL - это "llama3.2:latest" в списке моделей
+            wanted = {self.model, self.model if ':' in self.model else f"{self.model}:latest"}
+            error = None if names & wanted else f"model {self.model} not loaded"
+        except (httpx.HTTPError, ValueError) as e:
+            error = repr(e)
+
+        if (error is None) != backend.healthy:
+            logger.info(f"Ollama backend {backend.url} is {'up' if error is None else 'down'}: {error or 'ok'}")
+        backend.healthy = error is None
+        backend.health_error = error
+        if error is not None:
+            backend.recovery_probes = 0
+        elif backend.ejected_until > time.monotonic():
+            # /api/tags отвечает и у сервера, который падает на генерации: одной пробы мало.
+            # Счетчик ошибок не сбрасывается - первая же ошибка запроса снова исключит сервер
+            backend.recovery_probes += 1
+            if backend.recovery_probes >= OLLAMA_RECOVERY_PROBES:
+                backend.ejected_until = 0.0
+                backend.recovery_probes = 0
+                logger.info(f"Ollama backend {backend.url} back in rotation after {OLLAMA_RECOVERY_PROBES} probes")
+
+    async def check_health(self):
+        await asyncio.gather(*(self._probe(backend) for backend in self.backends))
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(OLLAMA_HEALTH_INTERVAL)
+            try:
+                await self.check_health()
+            except Exception as e:
+                logger.error(f"Ollama health check failed: {e}", exc_info=True)
+
+    def stats(self) -> List[Dict]:
+        return [backend.stats() for backend in self.backends]
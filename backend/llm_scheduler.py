@@ -0,0 +1,141 @@
+"""
+LLM Scheduler - concurrency limit and admission control in front of the model
+At most `max_in_flight` requests run against the provider at once; the rest wait
+in a bounded priority queue (first replies before later replies before
+summaries). A request that cannot get a slot before its queue deadline, or that
+does not fit into a full queue, is shed with SchedulerOverloaded so the caller
+can answer from cache or with a canned reply instead of piling onto the model.
+
+The limit is per process: with standalone workers set LLM_MAX_IN_FLIGHT so that
+the sum over processes matches the backend's parallel capacity.
+"""
+
+import time
+import heapq
+import asyncio
+import itertools
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, List
+from constants import (
+    LLM_PRIORITY_FIRST_REPLY,
+    LLM_PRIORITY_REPLY,
+    LLM_PRIORITY_SUMMARY,
+    LLM_MAX_IN_FLIGHT,
+    LLM_QUEUE_SIZE,
+    LLM_QUEUE_TIMEOUTS,
+    LLM_WAIT_WINDOW
+)
+
+PRIORITY_NAMES = {
+    LLM_PRIORITY_FIRST_REPLY: 'first_reply',
+    LLM_PRIORITY_REPLY: 'reply',
+    LLM_PRIORITY_SUMMARY: 'summary'
+}
+
+
+class SchedulerOverloaded(Exception):
+    """Raised when a request is shed (queue full, evicted or queue deadline passed)"""
+
+
+class LLMScheduler:
+    """Priority admission queue with a max-in-flight limit"""
+
+    def __init__(self, max_in_flight: int = LLM_MAX_IN_FLIGHT, max_queue: int = LLM_QUEUE_SIZE):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.in_flight = 0
+        # (priority, seq, future): меньший priority обслуживается раньше, внутри - FIFO
+        self._queue: List[tuple] = []
+        self._seq = itertools.count()
+        self._waits = deque(maxlen=LLM_WAIT_WINDOW)
+        self.admitted = {name: 0 for name in PRIORITY_NAMES.values()}
+        self.shed = {'queue_full': 0, 'evicted': 0, 'deadline': 0}
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, waiter in self._queue if not waiter.done())
+
+    @asynccontextmanager
+    async def slot(self, priority: int = LLM_PRIORITY_REPLY):
+        """Hold one in-flight slot for the duration of a provider call"""
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, priority: int):
+        started = time.monotonic()
+        if self.in_flight < self.max_in_flight and not self.queue_depth:
+            self._admit(priority, started)
+            return
+
+        if self.queue_depth >= self.max_queue and not self._evict_lower(priority):
+            self.shed['queue_full'] += 1
+            raise SchedulerOverloaded(f"LLM queue full ({self.max_queue})")
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), waiter))
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), LLM_QUEUE_TIMEOUTS[priority])
+        except asyncio.TimeoutError:
+            if waiter.done():
+                if waiter.exception():
+                    raise waiter.exception()
+                # Слот выдан в момент таймаута - используем его
+                self._admit(priority, started, granted=True)
+                return
+            waiter.cancel()
+            self.shed['deadline'] += 1
+            raise SchedulerOverloaded(f"No LLM slot within {LLM_QUEUE_TIMEOUTS[priority]}s")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled() and not waiter.exception():
+                # Слот уже передан нам - вернуть его следующему
+                self._release()
+            else:
+                waiter.cancel()
+            raise
+        self._admit(priority, started, granted=True)
+
+    def _admit(self, priority: int, started: float, granted: bool = False):
+        # При передаче слота из _release счетчик in_flight уже учтен
+        if not granted:
+            self.in_flight += 1
+        self.admitted[PRIORITY_NAMES[priority]] += 1
+        self._waits.append(time.monotonic() - started)
+
+    def _evict_lower(self, priority: int) -> bool:
+        """Shed the lowest-priority (newest) waiter if it ranks below `priority`"""
+        candidates = [item for item in self._queue if not item[2].done()]
+        if not candidates:
+            return False
+        victim = max(candidates, key=lambda item: (item[0], item[1]))
+        if victim[0] <= priority:
+            return False
+        victim[2].set_exception(SchedulerOverloaded("Evicted by a higher-priority request"))
+        self.shed['evicted'] += 1
+        return True
+
+    def _release(self):
+        # Слот передается следующему живому ожидающему без уменьшения in_flight
+        while self._queue:
+            _, _, waiter = heapq.heappop(self._queue)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self) -> Dict:
+        waits = sorted(self._waits)
+        return {
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'queue_depth': self.queue_depth,
+            'max_queue': self.max_queue,
+            'admitted': dict(self.admitted),
+            'shed': dict(self.shed),
+            'wait_avg_ms': round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+            'wait_p95_ms': round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+            'wait_max_ms': round(waits[-1] * 1000, 1) if waits else 0.0
+        }
@@ -0,0 +1,209 @@
+"""
+Phrase Matcher - multi-phrase scanner for response scoring and routing
+All phrase sets (uncertainty, escalation triggers, ticket topics) are compiled
+once into literal spellings; a text is lowercased once, every spelling is
+located with str.find (C speed, overlapping hits are found too) and the hits
+come back grouped by category.
+
+Phrase syntax:
+    переда{ю|м|но} специалисту   - alternative word endings
+    возврат*                      - any word ending
+    anything else                 - literal substring (case-insensitive)
+
+Phrase lists can be overridden with a JSON file ({"category": ["phrase", ...]},
+path in PHRASES_FILE); the file is re-read automatically when it changes.
+"""
+
+import os
+import re
+import json
+import itertools
+import time
+import logging
+from typing import Dict, List, Optional
+from constants import (
+    CATEGORY_APP,
+    CATEGORY_DELIVERY,
+    CATEGORY_PAYMENT,
+    CATEGORY_PRODUCT,
+    PHRASES_RELOAD_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+
+PHRASES_UNCERTAINTY = 'uncertainty'
+PHRASES_ESCALATION = 'escalation'
+TOPIC_PREFIX = 'topic:'
+
+# Порядок тем - приоритет при определении категории тикета
+DEFAULT_PHRASES: Dict[str, List[str]] = {
+    PHRASES_UNCERTAINTY: [
+        'не уверен',
+        'не знаю',
+        'возможно',
+        'может быть',
+        'скорее всего',
+        'попробуйте',
+        'свяжитесь с',
+        'обратитесь к менеджеру'
+    ],
+    # Эскалация только после согласия клиента: AI сообщает, что передает запрос
+    PHRASES_ESCALATION: [
+        'переда{ю|м} ваш запрос специалисту',
+        'переда{ю|м|но} специалисту',
+        'переда{ю|м|но} менеджеру',
+        'специалист получил',
+        'менеджер получил'
+    ],
+    TOPIC_PREFIX + CATEGORY_APP: ['приложение', 'app'],
+    TOPIC_PREFIX + CATEGORY_DELIVERY: ['доставка', 'курьер'],
+    TOPIC_PREFIX + CATEGORY_PAYMENT: ['оплата', 'карта'],
+    TOPIC_PREFIX + CATEGORY_PRODUCT: ['товар', 'продукт']
+}
+
+_SPEC_TOKEN = re.compile(r'\{([^{}]*)\}|\*')
+
+
+def phrase_to_regex(phrase: str) -> str:
+    """Translate phrase syntax ({a|b} endings, * wildcard) into a regex fragment"""
+    parts = []
+    pos = 0
+    for match in _SPEC_TOKEN.finditer(phrase):
+        parts.append(re.escape(phrase[pos:match.start()]))
+        if match.group(0) == '*':
+            parts.append(r'\w*')
+        else:
+            options = sorted(match.group(1).split('|'), key=len, reverse=True)
+            parts.append('(?:' + '|'.join(re.escape(option) for option in options) + ')')
+        pos = match.end()
+    parts.append(re.escape(phrase[pos:]))
+    return ''.join(parts)
+
+
+def phrase_variants(phrase: str) -> Optional[List[str]]:
+    """
+    Literal spellings of a phrase ({a|b} endings expanded), or None if it needs a regex
+
+    A trailing * matches an empty ending too, so for "contains" it is the same as
+    no wildcard; * inside a phrase cannot be expanded.
+    """
+    if phrase.endswith('*'):
+        phrase = phrase[:-1]
+    if '*' in phrase:
+        return None
+    pieces = []
+    pos = 0
+    for match in _SPEC_TOKEN.finditer(phrase):
+        pieces.append([phrase[pos:match.start()]])
+        pieces.append(match.group(1).split('|'))
+        pos = match.end()
+    pieces.append([phrase[pos:]])
+    return [''.join(combination) for combination in itertools.product(*pieces)]
+
+
+class PhraseMatcher:
+    """
+    Compiled matcher over categorized phrase lists
+
+    Each phrase is searched on its own (literal spellings via str.find, a regex
+    only for a * inside the phrase), so hits of different phrases may overlap.
+    """
+
+    def __init__(self, phrases: Dict[str, List[str]]):
+        self.phrases = {category: list(items) for category, items in phrases.items()}
+        # (категория, фраза, варианты написания или None, regex для фраз с * внутри)
+        self._entries: List[tuple] = []
+        for category, items in self.phrases.items():
+            for phrase in items:
+                lowered = phrase.lower()
+                variants = phrase_variants(lowered)
+                pattern = re.compile(phrase_to_regex(lowered)) if variants is None else None
+                self._entries.append((category, phrase, variants, pattern))
+
+    def scan(self, text: str) -> Dict[str, List[str]]:
+        """Distinct matched phrases by category (in order of first occurrence)"""
+        hits: Dict[str, List[str]] = {}
+        if not text:
+            return hits
+        lowered = text.lower()
+        found = []
+        for index, (category, phrase, variants, pattern) in enumerate(self._entries):
+            if variants is not None:
+                positions = [pos for pos in map(lowered.find, variants) if pos >= 0]
+                if not positions:
+                    continue
+                position = min(positions)
+            else:
+                match = pattern.search(lowered)
+                if match is None:
+                    continue
+                position = match.start()
+            found.append((position, index))
+
+        for _, index in sorted(found):
+            category, phrase = self._entries[index][:2]
+            phrases = hits.setdefault(category, [])
+            if phrase not in phrases:
+                phrases.append(phrase)
+        return hits
+
+    def topic(self, hits: Dict[str, List[str]]) -> Optional[str]:
+        """First topic category (by list order) present in scan result"""
+        for category in self.phrases:
+            if category.startswith(TOPIC_PREFIX) and category in hits:
+                return category[len(TOPIC_PREFIX):]
+        return None
+
+
+_matcher: Optional[PhraseMatcher] = None
+_source_mtime: Optional[float] = None
+_checked_at = 0.0
+
+
+def _load_phrases(path: Optional[str]) -> Dict[str, List[str]]:
+    if not path:
+        return DEFAULT_PHRASES
+    with open(path, encoding='utf-8') as f:
+        overrides = json.load(f)
+    # Категории из файла заменяют встроенные, остальные остаются по умолчанию
+    return {**DEFAULT_PHRASES, **overrides}
+
+
+def reload_phrases() -> PhraseMatcher:
+    """Rebuild the shared matcher from PHRASES_FILE (or built-in lists)"""
+    global _matcher, _source_mtime
+    path = os.getenv('PHRASES_FILE')
+    mtime = None
+    try:
+        mtime = os.path.getmtime(path) if path else None
+        matcher = PhraseMatcher(_load_phrases(path))
+    except (OSError, ValueError, re.error) as e:
+        # Битый файл не ломает скоринг: остаются предыдущие списки до следующего изменения
+        logger.error(f"Phrase lists not reloaded from {path}: {e}")
+        _source_mtime = mtime
+        if _matcher is None:
+            _matcher = PhraseMatcher(DEFAULT_PHRASES)
+        return _matcher
+
+    _matcher, _source_mtime = matcher, mtime
+    logger.info(f"Phrase matcher built: {sum(len(items) for items in matcher.phrases.values())} phrases")
+    return _matcher
+
+
+def get_matcher() -> PhraseMatcher:
+    """Shared matcher; rebuilt when PHRASES_FILE changes (checked every few seconds)"""
+    global _checked_at
+    if _matcher is None:
+        return reload_phrases()
+
+    now = time.monotonic()
+    if now - _checked_at >= PHRASES_RELOAD_INTERVAL:
+        _checked_at = now
+        path = os.getenv('PHRASES_FILE')
+        try:
+            mtime = os.path.getmtime(path) if path else None
+        except OSError:
+            mtime = _source_mtime
+        if mtime != _source_mtime:
+            return reload_phrases()
+    return _matcher
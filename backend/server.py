@@ -1,25 +1,40 @@
 import os
 import uuid
+import json
+import base64
+import hashlib
 import logging
 import asyncio
 from logging.handlers import RotatingFileHandler
 from datetime import datetime
 from typing import Optional, List
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, APIRouter
+from fastapi import FastAPI, HTTPException, APIRouter, Query, Header, Response
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, field_validator
-import asyncpg
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
-import httpx
 
 from constants import (
-    MIN_MESSAGE_LENGTH, CATEGORY_GENERAL, STATUS_NEW, STATUS_AI_PROCESSING,
-    STATUS_RESOLVED, STATUS_ESCALATED, STATUS_CLOSED,
-    SENDER_USER, SENDER_AI, HTTP_TIMEOUT, WEBHOOK_TIMEOUT
+    MIN_MESSAGE_LENGTH, CATEGORY_GENERAL, STATUS_AI_PROCESSING, STATUS_RESOLVED,
+    SENDER_USER, JOB_GENERATE, JOB_LEARN, AI_WORKERS_DEFAULT,
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_LEASE_BUDGET,
+    TICKETS_PAGE_SIZE_DEFAULT, TICKETS_PAGE_SIZE_MAX, EVENTS_HEARTBEAT_INTERVAL,
+    MESSAGES_PAGE_SIZE_DEFAULT, MESSAGES_PAGE_SIZE_MAX,
+    GENERATE_DEBOUNCE, GENERATE_DEBOUNCE_MAX, MEDIA_GROUP_MAX_ITEMS,
+    SEARCH_PAGE_SIZE_DEFAULT, SEARCH_PAGE_SIZE_MAX, SEARCH_QUERY_MAX_LENGTH,
+    SEARCH_WINDOW_DAYS, SEARCH_WINDOW_DAYS_MAX
 )
-from ai_service import get_ai_service
-from email_service import get_email_service
+from db_pool import InstrumentedPool, create_pool
+from job_queue import init_jobs_schema, enqueue_job, enqueue_debounced_job, get_job
+from ai_worker import WorkerPool, supersede_stats
+from event_feed import EventHub, init_events_schema, format_sse
+from ticket_search import init_search_schema, search_conversations, decode_search_cursor
+from ai_service import get_ai_service, close_ai_service
+from phrase_matcher import get_matcher
+from metrics import REGISTRY, CONTENT_TYPE, http_metrics_middleware
+from tracing import tracing_middleware, start_tracing, stop_tracing
 
 load_dotenv()
 
@@ -50,8 +65,17 @@ DB_HOST = os.getenv('DB_HOST', '127.0.0.1')
 DB_NAME = os.getenv('DB_NAME', 'sulpak_helpdesk')
 DB_PASSWORD = os.getenv('DB_PASSWORD', 'postgres')
 DB_PORT = int(os.getenv('DB_PORT', '5432'))
-WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '3002'))
-WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', 'localhost')
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN_SIZE', str(DB_POOL_MIN_SIZE)))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX_SIZE', str(DB_POOL_MAX_SIZE)))
+# Бюджет удержания соединения (сек) - дольше логируется предупреждение
+DB_LEASE_LIMIT = float(os.getenv('DB_LEASE_BUDGET', str(DB_LEASE_BUDGET)))
+
+# Количество AI воркеров внутри процесса API (0 - только отдельные процессы ai_worker.py)
+AI_WORKERS = int(os.getenv('AI_WORKERS', str(AI_WORKERS_DEFAULT)))
+
+# Сообщения тикета, пришедшие подряд в этом окне, получают один AI ответ
+DEBOUNCE_WINDOW = float(os.getenv('GENERATE_DEBOUNCE', str(GENERATE_DEBOUNCE)))
+DEBOUNCE_MAX = float(os.getenv('GENERATE_DEBOUNCE_MAX', str(GENERATE_DEBOUNCE_MAX)))
 
 # CORS origins - в продакшене должны быть указаны конкретные домены
 CORS_ORIGINS = os.getenv('CORS_ORIGINS', 'http://localhost:5173,http://localhost:3000').split(',')
@@ -59,24 +83,31 @@ CORS_ORIGINS = os.getenv('CORS_ORIGINS', 'http://localhost:5173,http://localhost
 print(f'DB Config: user={DB_USER}, host={DB_HOST}, database={DB_NAME}, port={DB_PORT}')
 
 # Database pool
-db_pool: Optional[asyncpg.Pool] = None
+db_pool: Optional[InstrumentedPool] = None
+
+# AI workers (очередь ai_jobs)
+ai_workers: Optional[WorkerPool] = None
+
+# Live события (LISTEN/NOTIFY -> SSE)
+event_hub: Optional[EventHub] = None
 
 
 # Инициализация БД
 async def init_db():
     global db_pool
-    db_pool = await asyncpg.create_pool(
+    db_pool = await create_pool(
+        lease_budget=DB_LEASE_LIMIT,
         user=DB_USER,
         password=DB_PASSWORD,
         database=DB_NAME,
         host=DB_HOST,
         port=DB_PORT,
-        min_size=5,
-        max_size=20
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX
     )
 
     # Создание таблиц
-    async with db_pool.acquire() as conn:
+    async with db_pool.acquire('init_db') as conn:
         await conn.execute('''
             CREATE TABLE IF NOT EXISTS tickets (
                 id SERIAL PRIMARY KEY,
@@ -87,11 +118,44 @@ async def init_db():
                 assigned_manager_id INT,
                 ai_summary TEXT,
                 escalated_at TIMESTAMP,
+                first_message TEXT,
+                message_count INT NOT NULL DEFAULT 0,
+                last_message_at TIMESTAMP,
+                last_sender_type VARCHAR(20),
+                last_ai_confidence FLOAT,
+                context_summary TEXT,
+                context_summary_upto INT,
+                ai_summary_upto INT,
                 created_at TIMESTAMP DEFAULT NOW(),
                 updated_at TIMESTAMP DEFAULT NOW()
             );
         ''')
 
+        # Денормализованные поля для списка тикетов (для существующих БД).
+        # Заполнить их для старых данных: python backfill_ticket_summary.py
+        await conn.execute('''
+            ALTER TABLE tickets
+            ADD COLUMN IF NOT EXISTS first_message TEXT,
+            ADD COLUMN IF NOT EXISTS message_count INT NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS last_sender_type VARCHAR(20),
+            ADD COLUMN IF NOT EXISTS last_ai_confidence FLOAT;
+        ''')
+
+        # Краткое содержание ранней части диалога для контекста AI
+        # (context_summary_upto - id последнего свернутого сообщения)
+        await conn.execute('''
+            ALTER TABLE tickets
+            ADD COLUMN IF NOT EXISTS context_summary TEXT,
+            ADD COLUMN IF NOT EXISTS context_summary_upto INT;
+        ''')
+
+        # Резюме для менеджера ведется инкрементально (ai_summary_upto - id последнего учтенного сообщения)
+        await conn.execute('''
+            ALTER TABLE tickets
+            ADD COLUMN IF NOT EXISTS ai_summary_upto INT;
+        ''')
+
         await conn.execute('''
             CREATE TABLE IF NOT EXISTS messages (
                 id SERIAL PRIMARY KEY,
@@ -126,10 +190,17 @@ async def init_db():
                 pending_media_url TEXT,
                 pending_media_file_id VARCHAR(255),
                 pending_media_caption TEXT,
+                version INT NOT NULL DEFAULT 1,
                 updated_at TIMESTAMP DEFAULT NOW()
             );
         ''')
 
+        # Версия сессии для оптимистичной блокировки (кэш сессий в боте)
+        await conn.execute('''
+            ALTER TABLE user_sessions
+            ADD COLUMN IF NOT EXISTS version INT NOT NULL DEFAULT 1;
+        ''')
+
         # Создание индексов для оптимизации запросов
         await conn.execute('''
             CREATE INDEX IF NOT EXISTS idx_tickets_telegram_user_id
@@ -146,16 +217,85 @@ async def init_db():
             ON tickets(created_at DESC);
         ''')
 
+        # Keyset пагинация списка тикетов по (created_at, id) с фильтрами
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_tickets_created_at_id
+            ON tickets(created_at DESC, id DESC);
+        ''')
+
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_tickets_status_created_at_id
+            ON tickets(status, created_at DESC, id DESC);
+        ''')
+
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_tickets_user_created_at_id
+            ON tickets(telegram_user_id, created_at DESC, id DESC);
+        ''')
+
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_tickets_manager_created_at_id
+            ON tickets(assigned_manager_id, created_at DESC, id DESC)
+            WHERE assigned_manager_id IS NOT NULL;
+        ''')
+
         await conn.execute('''
             CREATE INDEX IF NOT EXISTS idx_messages_ticket_id
             ON messages(ticket_id);
         ''')
 
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_messages_ticket_created_at
+            ON messages(ticket_id, created_at, id);
+        ''')
+
+        # Инкрементальная загрузка новых сообщений (?after_id=)
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_messages_ticket_id_id
+            ON messages(ticket_id, id);
+        ''')
+
         await conn.execute('''
             CREATE INDEX IF NOT EXISTS idx_messages_created_at
             ON messages(created_at ASC);
         ''')
 
+        # Триггер поддерживает денормализованные поля тикета в той же транзакции,
+        # что и INSERT сообщения (API, AI воркеры и любые другие пути записи)
+        await conn.execute('''
+            CREATE OR REPLACE FUNCTION tickets_apply_new_message() RETURNS trigger AS $$
+            BEGIN
+                UPDATE tickets SET
+                    first_message = COALESCE(first_message, NEW.content),
+                    message_count = message_count + 1,
+                    last_message_at = GREATEST(last_message_at, NEW.created_at),
+                    last_sender_type = NEW.sender_type,
+                    last_ai_confidence = CASE
+                        WHEN NEW.sender_type = 'ai' THEN NEW.ai_confidence
+                        ELSE last_ai_confidence
+                    END
+                WHERE id = NEW.ticket_id;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        ''')
+
+        await conn.execute('''
+            DROP TRIGGER IF EXISTS trg_messages_ticket_summary ON messages;
+            CREATE TRIGGER trg_messages_ticket_summary
+            AFTER INSERT ON messages
+            FOR EACH ROW EXECUTE FUNCTION tickets_apply_new_message();
+        ''')
+
+        # Очередь AI задач
+        await init_jobs_schema(conn)
+
+        # Live события тикетов
+        await init_events_schema(conn)
+
+        # Полнотекстовый поиск по сообщениям и резюме
+        await init_search_schema(conn)
+
     logger.info('Database initialized with indexes')
     print('Database initialized')
 
@@ -170,11 +310,36 @@ async def close_db():
 # Lifespan context manager
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global ai_workers, event_hub
     # Startup
+    await start_tracing('api')
     await init_db()
+    event_hub = EventHub(db_pool, {
+        'user': DB_USER,
+        'password': DB_PASSWORD,
+        'database': DB_NAME,
+        'host': DB_HOST,
+        'port': DB_PORT
+    })
+    await event_hub.start()
+    if AI_WORKERS > 0:
+        try:
+            ai_service = get_ai_service()
+            await ai_service.start()
+            async with db_pool.acquire('answer_cache.warmup') as conn:
+                await ai_service.warm_answer_cache(conn)
+        except ValueError as e:
+            logger.error(f"AI service not configured: {e}")
+        ai_workers = WorkerPool(db_pool, AI_WORKERS)
+        ai_workers.start()
     yield
     # Shutdown
+    if ai_workers:
+        await ai_workers.stop()
+        await close_ai_service()
+    await event_hub.stop()
     await close_db()
+    await stop_tracing()
 
 
 app = FastAPI(title="Sulpak HelpDesk API", version="1.0.0", lifespan=lifespan)
@@ -185,9 +350,14 @@ app.add_middleware(
     allow_origins=CORS_ORIGINS,
     allow_credentials=True,
     allow_methods=["GET", "POST", "PATCH", "DELETE", "OPTIONS"],
-    allow_headers=["Content-Type", "Authorization"],
+    allow_headers=["Content-Type", "Authorization", "Last-Event-ID"],
 )
 
+# Латентность запросов по шаблону маршрута - в /metrics
+app.middleware("http")(http_metrics_middleware)
+# Трейс из заголовка traceparent (запросы бота) продолжается в API и задачах ai_jobs
+app.middleware("http")(tracing_middleware)
+
 # API Router для версионирования
 api_v1_router = APIRouter(prefix="/api/v1", tags=["v1"])
 
@@ -209,6 +379,24 @@ class AddMessageRequest(BaseModel):
     mediaFileId: Optional[str] = Field(None, max_length=255)
 
 
+class MediaItem(BaseModel):
+    text: str = Field(min_length=1, max_length=4000)
+    mediaType: str = Field(pattern="^(photo|video)$")
+    mediaUrl: Optional[str] = Field(None, max_length=1000)
+    mediaFileId: Optional[str] = Field(None, max_length=255)
+
+
+class InboundMessageRequest(BaseModel):
+    telegramUserId: int = Field(gt=0, description="Telegram User ID должен быть положительным")
+    telegramUsername: str = Field(min_length=1, max_length=255, description="Username не может быть пустым")
+    text: str = Field(min_length=1, max_length=4000, description="Сообщение не может быть пустым")
+    mediaType: Optional[str] = Field(None, pattern="^(photo|video)$")
+    mediaUrl: Optional[str] = Field(None, max_length=1000)
+    mediaFileId: Optional[str] = Field(None, max_length=255)
+    # Остальные фото/видео альбома (media_group_id) - отдельные сообщения тикета, один AI ответ
+    extraMedia: List[MediaItem] = Field(default_factory=list, max_length=MEDIA_GROUP_MAX_ITEMS - 1)
+
+
 class UpdateStatusRequest(BaseModel):
     status: str = Field(pattern="^(new|ai_processing|resolved|escalated|closed)$", description="Недопустимый статус")
 
@@ -237,18 +425,9 @@ async def validate_with_ai(message: str) -> ValidationResult:
             category='general'
         )
 
-    # Определяем категорию по ключевым словам
-    category = 'general'
-    lower_message = message.lower()
-
-    if 'приложение' in lower_message or 'app' in lower_message:
-        category = 'приложение'
-    elif 'доставка' in lower_message or 'курьер' in lower_message:
-        category = 'доставка'
-    elif 'оплата' in lower_message or 'карта' in lower_message:
-        category = 'оплата'
-    elif 'товар' in lower_message or 'продукт' in lower_message:
-        category = 'товар'
+    # Определяем категорию по ключевым словам (первая тема по приоритету списков фраз)
+    matcher = get_matcher()
+    category = matcher.topic(matcher.scan(message)) or CATEGORY_GENERAL
 
     return ValidationResult(
         isValid=True,
@@ -269,326 +448,417 @@ def generate_ticket_number() -> str:
     return f"SH{year}{month}{unique_part}"
 
 
-# API Routes
+# Колонки TIMESTAMP хранят локальное время сервера БД без часового пояса
+def to_db_timestamp(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
 
-@api_v1_router.post("/tickets")
-async def create_ticket(request: CreateTicketRequest):
-    """Создание нового тикета с автоматическим AI ответом"""
-    # AI валидация
-    validation = await validate_with_ai(request.message)
 
-    if not validation.isValid:
-        return {
-            "success": False,
-            "needsClarification": True,
-            "suggestion": validation.suggestion,
-            "missingInfo": validation.missingInfo
-        }
+# Курсор пагинации тикетов: непрозрачная строка из (created_at, id) последнего элемента
+def encode_ticket_cursor(created_at: datetime, ticket_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), ticket_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
 
-    # Создание тикета
-    ticket_number = generate_ticket_number()
 
-    async with db_pool.acquire() as conn:
-        # Вставка тикета со статусом ai_processing
-        ticket = await conn.fetchrow(
-            '''INSERT INTO tickets (ticket_number, telegram_user_id, telegram_username, status)
-               VALUES ($1, $2, $3, $4) RETURNING *''',
-            ticket_number, request.telegramUserId, request.telegramUsername, STATUS_AI_PROCESSING
-        )
+def decode_ticket_cursor(cursor: str) -> tuple:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, ticket_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), int(ticket_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-        # Вставка первого сообщения от пользователя
-        await conn.execute(
-            '''INSERT INTO messages (ticket_id, sender_type, sender_id, content)
-               VALUES ($1, $2, $3, $4)''',
-            ticket['id'], SENDER_USER, str(request.telegramUserId), request.message
-        )
 
-        # Получить AI service
-        ai_service = get_ai_service()
+# ETag по дешевой версии тикета (id, updated_at, message_count).
+# Любая запись, меняющая возвращаемые поля тикета, обязана ставить updated_at = NOW(),
+# иначе клиенты получат 304 и останутся со старыми данными.
+# Cache-Control: no-cache - браузер сам перепроверяет ресурс через If-None-Match
+def make_etag(*parts) -> str:
+    digest = hashlib.md5('|'.join(str(part) for part in parts).encode()).hexdigest()
+    return f'W/"{digest}"'
 
-        # Подготовить conversation history
-        conversation_history = [{
-            'sender_type': SENDER_USER,
-            'content': request.message,
-            'media_type': None
-        }]
 
-        user_info = {
-            'telegram_user_id': request.telegramUserId,
-            'telegram_username': request.telegramUsername
-        }
+def ticket_version(ticket) -> str:
+    return f"{ticket['id']}:{ticket['updated_at'].isoformat() if ticket['updated_at'] else ''}:{ticket['message_count']}"
 
-        # Получить AI ответ
-        try:
-            ai_response, confidence, should_escalate = await ai_service.get_ai_response(
-                ticket_id=ticket['id'],
-                conversation_history=conversation_history,
-                user_info=user_info
-            )
 
-            # Сохранить AI ответ в базу
-            ai_message = await conn.fetchrow(
-                '''INSERT INTO messages (ticket_id, sender_type, sender_id, content, ai_confidence)
-                   VALUES ($1, $2, $3, $4, $5) RETURNING *''',
-                ticket['id'], SENDER_AI, 'ai_assistant', ai_response, confidence
-            )
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Слабое сравнение ETag (RFC 7232)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque = etag.removeprefix('W/')
+    return any(candidate.strip().removeprefix('W/') == opaque for candidate in if_none_match.split(','))
 
-            # Отправить AI ответ в Telegram через webhook
-            webhook_url = f"http://{WEBHOOK_HOST}:{WEBHOOK_PORT}/webhook/send-message"
-            try:
-                async with httpx.AsyncClient(timeout=WEBHOOK_TIMEOUT) as client:
-                    await client.post(
-                        webhook_url,
-                        json={
-                            "telegramUserId": request.telegramUserId,
-                            "message": ai_response,
-                            "ticketNumber": ticket_number
-                        }
-                    )
-                logger.info(f"AI response sent to user {request.telegramUserId} for ticket {ticket_number}")
-            except Exception as e:
-                logger.error(f"Failed to send AI response via webhook: {e}")
-
-            # Если нужна эскалация
-            if should_escalate:
-                # Генерировать summary
-                summary = await ai_service.generate_conversation_summary(
-                    conversation_history + [{
-                        'sender_type': SENDER_AI,
-                        'content': ai_response,
-                        'media_type': None
-                    }]
-                )
 
-                # Обновить тикет
-                await conn.execute(
-                    '''UPDATE tickets SET status = $1, ai_summary = $2, escalated_at = NOW()
-                       WHERE id = $3''',
-                    STATUS_ESCALATED, summary, ticket['id']
-                )
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
 
-                # Отправить email менеджеру
-                email_service = get_email_service()
-                await email_service.send_escalation_email(
-                    ticket_number=ticket_number,
-                    ticket_id=ticket['id'],
-                    user_info=user_info,
-                    conversation_history=conversation_history + [{
-                        'sender_type': SENDER_AI,
-                        'content': ai_response,
-                        'created_at': ai_message['created_at'].isoformat()
-                    }],
-                    ai_summary=summary
-                )
 
-                logger.info(f"Ticket {ticket_number} escalated to manager")
-                status = STATUS_ESCALATED
-            else:
-                status = STATUS_AI_PROCESSING
+# Счетчики объединения генераций: enqueued - новые задачи на AI ответ,
+# coalesced - сообщения, присоединенные к уже стоящей задаче (сэкономленные вызовы модели)
+generation_stats = {'enqueued': 0, 'coalesced': 0}
 
-        except Exception as e:
-            logger.error(f"AI response failed for ticket {ticket['id']}: {e}", exc_info=True)
-            # Fallback: эскалировать при ошибке
-            await conn.execute(
-                '''UPDATE tickets SET status = $1, escalated_at = NOW()
-                   WHERE id = $2''',
-                STATUS_ESCALATED, ticket['id']
+
+async def enqueue_generation(conn, ticket_id: int, message_id: int) -> int:
+    """
+    Задача на AI ответ по сообщениям тикета до message_id включительно.
+    Пока задача не взята воркером, новые сообщения тикета присоединяются к ней.
+    """
+    if DEBOUNCE_WINDOW <= 0:
+        generation_stats['enqueued'] += 1
+        return await enqueue_job(conn, JOB_GENERATE, ticket_id, {'message_id': message_id})
+
+    job_id, coalesced = await enqueue_debounced_job(
+        conn, JOB_GENERATE, ticket_id, {'message_id': message_id}, DEBOUNCE_WINDOW, DEBOUNCE_MAX
+    )
+    generation_stats['coalesced' if coalesced else 'enqueued'] += 1
+    return job_id
+
+
+# Запись тикета и сообщений (вызывается внутри транзакции)
+async def insert_ticket(conn, telegram_user_id: int, telegram_username: str, content: str,
+                        media_type: Optional[str] = None, media_url: Optional[str] = None,
+                        media_file_id: Optional[str] = None, enqueue: bool = True):
+    """Тикет со статусом ai_processing, первое сообщение пользователя и задача на AI ответ"""
+    ticket = await conn.fetchrow(
+        '''INSERT INTO tickets (ticket_number, telegram_user_id, telegram_username, status)
+           VALUES ($1, $2, $3, $4) RETURNING *''',
+        generate_ticket_number(), telegram_user_id, telegram_username, STATUS_AI_PROCESSING
+    )
+
+    message = await conn.fetchrow(
+        '''INSERT INTO messages (ticket_id, sender_type, sender_id, content, media_type, media_url, media_file_id)
+           VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING *''',
+        ticket['id'], SENDER_USER, str(telegram_user_id), content, media_type, media_url, media_file_id
+    )
+
+    # Задача на генерацию AI ответа (доставка и эскалация - следующими задачами)
+    job_id = None
+    if enqueue:
+        job_id = await enqueue_generation(conn, ticket['id'], message['id'])
+    else:
+        generation_stats['coalesced'] += 1
+    return ticket, message, job_id
+
+
+async def insert_message(conn, ticket_id: int, sender_type: str, sender_id: str, content: str,
+                         media_type: Optional[str] = None, media_url: Optional[str] = None,
+                         media_file_id: Optional[str] = None, enqueue: bool = True):
+    """Сообщение в существующий тикет; для сообщений пользователя - задача на AI ответ"""
+    message = await conn.fetchrow(
+        '''INSERT INTO messages (ticket_id, sender_type, sender_id, content, media_type, media_url, media_file_id)
+           VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING *''',
+        ticket_id, sender_type, sender_id, content, media_type, media_url, media_file_id
+    )
+
+    await conn.execute('UPDATE tickets SET updated_at = NOW() WHERE id = $1', ticket_id)
+
+    job_id = None
+    if sender_type == SENDER_USER:
+        if enqueue:
+            job_id = await enqueue_generation(conn, ticket_id, message['id'])
+        else:
+            # Ответ будет общим с последующими сообщениями (альбом)
+            generation_stats['coalesced'] += 1
+    return message, job_id
+
+
+async def insert_media_group(conn, ticket_id: int, telegram_user_id: int, items: List[MediaItem]) -> Optional[int]:
+    """Остальные элементы альбома; задача на AI ответ - одна, по последнему элементу"""
+    job_id = None
+    for index, item in enumerate(items):
+        _, job_id = await insert_message(
+            conn, ticket_id, SENDER_USER, str(telegram_user_id), item.text,
+            item.mediaType, item.mediaUrl, item.mediaFileId, enqueue=index == len(items) - 1
+        )
+    return job_id
+
+
+def ticket_summary(ticket) -> dict:
+    return {
+        "id": ticket['id'],
+        "ticketNumber": ticket['ticket_number'],
+        "status": ticket['status'],
+        "createdAt": ticket['created_at'].isoformat()
+    }
+
+
+# API Routes
+
+@api_v1_router.post("/tickets")
+async def create_ticket(request: CreateTicketRequest):
+    """Создание нового тикета; AI ответ генерируется воркером в фоне"""
+    # AI валидация
+    validation = await validate_with_ai(request.message)
+
+    if not validation.isValid:
+        return {
+            "success": False,
+            "needsClarification": True,
+            "suggestion": validation.suggestion,
+            "missingInfo": validation.missingInfo
+        }
+
+    async with db_pool.acquire('create_ticket') as conn:
+        async with conn.transaction():
+            ticket, message, job_id = await insert_ticket(
+                conn, request.telegramUserId, request.telegramUsername, request.message
             )
-            status = STATUS_ESCALATED
 
     return {
         "success": True,
-        "ticket": {
-            "id": ticket['id'],
-            "ticketNumber": ticket_number,
-            "status": status,
-            "createdAt": ticket['created_at'].isoformat()
-        },
+        "ticket": ticket_summary(ticket),
         "category": validation.category,
-        "aiResponse": ai_response if 'ai_response' in locals() else None
+        "message": dict(message),
+        "jobId": job_id
     }
 
 
 @api_v1_router.get("/tickets")
-async def get_tickets(user_id: Optional[int] = None):
-    """Получить все тикеты или отфильтровать по telegram_user_id"""
-    async with db_pool.acquire() as conn:
-        if user_id:
-            # Фильтрация по user_id на уровне SQL
-            tickets = await conn.fetch('''
-                SELECT t.*,
-                    (SELECT content FROM messages WHERE ticket_id = t.id ORDER BY created_at ASC LIMIT 1) as first_message,
-                    (SELECT COUNT(*) FROM messages WHERE ticket_id = t.id) as message_count
-                FROM tickets t
-                WHERE t.telegram_user_id = $1
-                ORDER BY t.created_at DESC
-            ''', user_id)
-        else:
-            # Все тикеты (для менеджеров)
-            tickets = await conn.fetch('''
-                SELECT t.*,
-                    (SELECT content FROM messages WHERE ticket_id = t.id ORDER BY created_at ASC LIMIT 1) as first_message,
-                    (SELECT COUNT(*) FROM messages WHERE ticket_id = t.id) as message_count
+async def get_tickets(
+    response: Response,
+    user_id: Optional[int] = None,
+    status: Optional[List[str]] = Query(None, description="Статус (можно несколько: ?status=new&status=escalated)"),
+    manager_id: Optional[int] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    limit: int = Query(TICKETS_PAGE_SIZE_DEFAULT, ge=1, le=TICKETS_PAGE_SIZE_MAX),
+    cursor: Optional[str] = None,
+    unpaged: bool = Query(False, alias="all", description="?all=true - все тикеты без пагинации (устаревший формат - список)"),
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Список тикетов с keyset пагинацией по (created_at, id) и фильтрацией на уровне SQL.
+    Ответ: {"items": [...], "nextCursor": "..."}; nextCursor передается в ?cursor= для следующей страницы.
+    """
+    conditions = []
+    args = []
+
+    def add_condition(sql: str, value):
+        args.append(value)
+        conditions.append(sql.format(f"${len(args)}"))
+
+    if user_id:
+        add_condition("t.telegram_user_id = {}", user_id)
+    if status:
+        add_condition("t.status = ANY({}::varchar[])", status)
+    if manager_id:
+        add_condition("t.assigned_manager_id = {}", manager_id)
+    if created_from:
+        add_condition("t.created_at >= {}", to_db_timestamp(created_from))
+    if created_to:
+        add_condition("t.created_at < {}", to_db_timestamp(created_to))
+
+    if not unpaged and cursor:
+        cursor_created_at, cursor_id = decode_ticket_cursor(cursor)
+        args.extend([cursor_created_at, cursor_id])
+        conditions.append(f"(t.created_at, t.id) < (${len(args) - 1}, ${len(args)})")
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    limit_sql = ""
+    if not unpaged:
+        # +1 строка, чтобы узнать, есть ли следующая страница
+        args.append(limit + 1)
+        limit_sql = f"LIMIT ${len(args)}"
+
+    async with db_pool.acquire('get_tickets') as conn:
+        if if_none_match:
+            # Сначала только версии строк страницы: если ничего не изменилось - 304 без тела
+            versions = await conn.fetch(f'''
+                SELECT t.id, t.updated_at, t.message_count
                 FROM tickets t
-                ORDER BY t.created_at DESC
-            ''')
+                {where}
+                ORDER BY t.created_at DESC, t.id DESC
+                {limit_sql}
+            ''', *args)
+            etag = make_etag(*(ticket_version(row) for row in versions))
+            if etag_matches(if_none_match, etag):
+                return not_modified(etag)
+
+        tickets = await conn.fetch(f'''
+            SELECT t.*
+            FROM tickets t
+            {where}
+            ORDER BY t.created_at DESC, t.id DESC
+            {limit_sql}
+        ''', *args)
+
+    response.headers["ETag"] = make_etag(*(ticket_version(row) for row in tickets))
+    response.headers["Cache-Control"] = "no-cache"
+
+    if unpaged:
+        return [dict(ticket) for ticket in tickets]
+
+    has_more = len(tickets) > limit
+    tickets = tickets[:limit]
+    next_cursor = None
+    if has_more:
+        last = tickets[-1]
+        next_cursor = encode_ticket_cursor(last['created_at'], last['id'])
+
+    return {
+        "items": [dict(ticket) for ticket in tickets],
+        "nextCursor": next_cursor,
+        "limit": limit
+    }
+
+
+@api_v1_router.get("/search")
+async def search_tickets(
+    q: str = Query(..., min_length=1, max_length=SEARCH_QUERY_MAX_LENGTH, description="Слова, \"фраза\", -исключение, номер тикета или @username"),
+    limit: int = Query(SEARCH_PAGE_SIZE_DEFAULT, ge=1, le=SEARCH_PAGE_SIZE_MAX),
+    days: int = Query(SEARCH_WINDOW_DAYS, ge=1, le=SEARCH_WINDOW_DAYS_MAX, description="Искать в тексте за последние N дней"),
+    cursor: Optional[str] = None
+):
+    """
+    Поиск по переписке: текст сообщений, AI резюме тикетов, номер тикета и username (по префиксу).
+    Ответ: {"items": [...], "nextCursor": "..."}; items отсортированы по релевантности,
+    snippet - HTML с <mark> вокруг найденных слов. Текст ищется за последние days дней,
+    следующую страницу запрашивать с тем же days. truncated: true - совпадений не меньше
+    SEARCH_CANDIDATES, ранжированы только самые новые (сузить days или уточнить запрос).
+    """
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Empty search query")
+
+    after = None
+    if cursor:
+        try:
+            after = decode_search_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
 
-    return [dict(ticket) for ticket in tickets]
+    async with db_pool.acquire('search') as conn:
+        result = await search_conversations(conn, q, limit, after, days)
+
+    result["limit"] = limit
+    result["days"] = days
+    return result
 
 
 @api_v1_router.get("/tickets/{ticket_id}")
 async def get_ticket(
     ticket_id: int,
+    response: Response,
     limit: Optional[int] = None,
-    offset: Optional[int] = 0
+    offset: Optional[int] = 0,
+    if_none_match: Optional[str] = Header(None)
 ):
-    """Получить тикет по ID с сообщениями (с опциональной пагинацией)"""
-    async with db_pool.acquire() as conn:
+    """Получить тикет по ID с сообщениями (с опциональной пагинацией). Поддерживает ETag / If-None-Match"""
+    async with db_pool.acquire('get_ticket') as conn:
         ticket = await conn.fetchrow('SELECT * FROM tickets WHERE id = $1', ticket_id)
 
         if not ticket:
             raise HTTPException(status_code=404, detail="Ticket not found")
 
-        # Подсчет общего количества сообщений
-        total_messages = await conn.fetchval(
-            'SELECT COUNT(*) FROM messages WHERE ticket_id = $1',
-            ticket_id
-        )
+        # Тикет не изменился - 304 после одного чтения по первичному ключу
+        etag = make_etag(ticket_version(ticket))
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
 
         # Запрос сообщений с пагинацией
         if limit:
             messages = await conn.fetch(
-                'SELECT * FROM messages WHERE ticket_id = $1 ORDER BY created_at ASC LIMIT $2 OFFSET $3',
+                'SELECT * FROM messages WHERE ticket_id = $1 ORDER BY created_at ASC, id ASC LIMIT $2 OFFSET $3',
                 ticket_id, limit, offset
             )
         else:
             # Без пагинации - все сообщения
             messages = await conn.fetch(
-                'SELECT * FROM messages WHERE ticket_id = $1 ORDER BY created_at ASC',
+                'SELECT * FROM messages WHERE ticket_id = $1 ORDER BY created_at ASC, id ASC',
                 ticket_id
             )
 
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+
     return {
         "ticket": dict(ticket),
         "messages": [dict(msg) for msg in messages],
         "pagination": {
-            "total": total_messages,
+            # Счетчик поддерживается триггером - без отдельного COUNT(*)
+            "total": ticket['message_count'],
             "limit": limit,
             "offset": offset
         } if limit else None
     }
 
 
-@api_v1_router.post("/tickets/{ticket_id}/messages")
-async def add_message(ticket_id: int, request: AddMessageRequest):
-    """Добавить сообщение в тикет и получить AI ответ"""
-    async with db_pool.acquire() as conn:
-        # Проверка существования тикета
-        ticket = await conn.fetchrow('SELECT * FROM tickets WHERE id = $1', ticket_id)
-        if not ticket:
-            raise HTTPException(status_code=404, detail="Ticket not found")
-
-        # Сохранить сообщение пользователя
-        message = await conn.fetchrow(
-            '''INSERT INTO messages (ticket_id, sender_type, sender_id, content, media_type, media_url, media_file_id)
-               VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING *''',
-            ticket_id, request.senderType, request.senderId, request.content,
-            request.mediaType, request.mediaUrl, request.mediaFileId
-        )
-
-        # Обновить время тикета
-        await conn.execute(
-            'UPDATE tickets SET updated_at = NOW() WHERE id = $1',
-            ticket_id
+@api_v1_router.get("/tickets/{ticket_id}/messages")
+async def get_ticket_messages(
+    ticket_id: int,
+    after_id: int = Query(0, ge=0, description="Вернуть только сообщения с id больше указанного"),
+    limit: int = Query(MESSAGES_PAGE_SIZE_DEFAULT, ge=1, le=MESSAGES_PAGE_SIZE_MAX)
+):
+    """Инкрементальная загрузка: только новые сообщения после after_id"""
+    async with db_pool.acquire('get_ticket_messages') as conn:
+        messages = await conn.fetch(
+            '''SELECT * FROM messages WHERE ticket_id = $1 AND id > $2
+               ORDER BY id ASC LIMIT $3''',
+            ticket_id, after_id, limit + 1
         )
 
-        # Если сообщение от пользователя - генерировать AI ответ
-        if request.senderType == SENDER_USER:
-            # Получить всю историю беседы
-            conversation_history = await conn.fetch(
-                '''SELECT sender_type, content, media_type, media_url, created_at
-                   FROM messages WHERE ticket_id = $1 ORDER BY created_at ASC''',
-                ticket_id
-            )
+        if not messages:
+            exists = await conn.fetchval('SELECT 1 FROM tickets WHERE id = $1', ticket_id)
+            if not exists:
+                raise HTTPException(status_code=404, detail="Ticket not found")
 
-            history_list = [dict(msg) for msg in conversation_history]
+    has_more = len(messages) > limit
+    messages = messages[:limit]
 
-            user_info = {
-                'telegram_user_id': ticket['telegram_user_id'],
-                'telegram_username': ticket['telegram_username']
-            }
+    return {
+        "messages": [dict(msg) for msg in messages],
+        "lastId": messages[-1]['id'] if messages else after_id,
+        "hasMore": has_more
+    }
 
-            # Получить AI ответ
-            ai_service = get_ai_service()
-            try:
-                ai_response, confidence, should_escalate = await ai_service.get_ai_response(
-                    ticket_id=ticket_id,
-                    conversation_history=history_list,
-                    user_info=user_info
-                )
 
-                # Сохранить AI ответ
-                ai_message = await conn.fetchrow(
-                    '''INSERT INTO messages (ticket_id, sender_type, sender_id, content, ai_confidence)
-                       VALUES ($1, $2, $3, $4, $5) RETURNING *''',
-                    ticket_id, SENDER_AI, 'ai_assistant', ai_response, confidence
-                )
+@api_v1_router.post("/tickets/{ticket_id}/messages")
+async def add_message(ticket_id: int, request: AddMessageRequest):
+    """Добавить сообщение в тикет; для сообщений пользователя ставится задача на AI ответ"""
+    async with db_pool.acquire('add_message') as conn:
+        async with conn.transaction():
+            # Проверка существования тикета
+            ticket = await conn.fetchrow('SELECT id FROM tickets WHERE id = $1', ticket_id)
+            if not ticket:
+                raise HTTPException(status_code=404, detail="Ticket not found")
+
+            message, job_id = await insert_message(
+                conn, ticket_id, request.senderType, request.senderId, request.content,
+                request.mediaType, request.mediaUrl, request.mediaFileId
+            )
 
-                # Отправить AI ответ в Telegram
-                webhook_url = f"http://{WEBHOOK_HOST}:{WEBHOOK_PORT}/webhook/send-message"
-                try:
-                    async with httpx.AsyncClient(timeout=WEBHOOK_TIMEOUT) as client:
-                        await client.post(
-                            webhook_url,
-                            json={
-                                "telegramUserId": ticket['telegram_user_id'],
-                                "message": ai_response,
-                                "ticketNumber": ticket['ticket_number']
-                            }
-                        )
-                    logger.info(f"AI response sent to user {ticket['telegram_user_id']} for ticket {ticket['ticket_number']}")
-                except Exception as e:
-                    logger.error(f"Failed to send AI response via webhook: {e}")
-
-                # Если нужна эскалация
-                if should_escalate:
-                    # Генерировать summary
-                    summary = await ai_service.generate_conversation_summary(history_list)
-
-                    # Обновить тикет
-                    await conn.execute(
-                        '''UPDATE tickets SET status = $1, ai_summary = $2, escalated_at = NOW()
-                           WHERE id = $3''',
-                        STATUS_ESCALATED, summary, ticket_id
-                    )
+    return {**dict(message), "jobId": job_id}
 
-                    # Отправить email менеджеру
-                    email_service = get_email_service()
-                    await email_service.send_escalation_email(
-                        ticket_number=ticket['ticket_number'],
-                        ticket_id=ticket_id,
-                        user_info=user_info,
-                        conversation_history=history_list,
-                        ai_summary=summary
-                    )
 
-                    logger.info(f"Ticket {ticket['ticket_number']} escalated to manager")
+@api_v1_router.get("/jobs/{job_id}")
+async def get_job_status(job_id: int):
+    """Статус AI задачи (генерация / доставка / эскалация)"""
+    async with db_pool.acquire('get_job_status') as conn:
+        job = await get_job(conn, job_id)
 
-            except Exception as e:
-                logger.error(f"AI response failed for ticket {ticket_id}: {e}", exc_info=True)
-                # При ошибке не блокируем сохранение сообщения
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
 
-    return dict(message)
+    return job
 
 
 @api_v1_router.patch("/tickets/{ticket_id}/status")
 async def update_status(ticket_id: int, request: UpdateStatusRequest):
     """Обновить статус тикета"""
-    async with db_pool.acquire() as conn:
-        ticket = await conn.fetchrow(
-            'UPDATE tickets SET status = $1, updated_at = NOW() WHERE id = $2 RETURNING *',
-            request.status, ticket_id
-        )
+    async with db_pool.acquire('update_status') as conn:
+        async with conn.transaction():
+            ticket = await conn.fetchrow(
+                'UPDATE tickets SET status = $1, updated_at = NOW() WHERE id = $2 RETURNING *',
+                request.status, ticket_id
+            )
+
+            if ticket and request.status == STATUS_RESOLVED:
+                # Кэш типовых вопросов живет в воркерах (в этом процессе или отдельных):
+                # ответ решенного тикета запоминает воркер, подходит ли он - решает задача
+                await enqueue_job(conn, JOB_LEARN, ticket_id, max_attempts=1)
 
     if not ticket:
         raise HTTPException(status_code=404, detail="Ticket not found")
@@ -599,7 +869,7 @@ async def update_status(ticket_id: int, request: UpdateStatusRequest):
 @api_v1_router.patch("/tickets/{ticket_id}/assign")
 async def assign_manager(ticket_id: int, request: AssignManagerRequest):
     """Назначить менеджера"""
-    async with db_pool.acquire() as conn:
+    async with db_pool.acquire('assign_manager') as conn:
         ticket = await conn.fetchrow(
             '''UPDATE tickets SET assigned_manager_id = $1, status = $2, updated_at = NOW()
                WHERE id = $3 RETURNING *''',
@@ -612,12 +882,69 @@ async def assign_manager(ticket_id: int, request: AssignManagerRequest):
     return dict(ticket)
 
 
+@api_v1_router.get("/events/stream")
+async def stream_events(
+    ticket_id: Optional[int] = None,
+    last_event_id: Optional[int] = Query(None, alias="lastEventId"),
+    last_event_id_header: Optional[int] = Header(None, alias="Last-Event-ID")
+):
+    """
+    Live поток событий (Server-Sent Events): ticket_created, message_added, status_changed.
+    Браузерный EventSource при переподключении сам передает Last-Event-ID и получает пропущенные события;
+    если их нельзя восстановить точно (см. event_feed), приходит resync - клиент перезагружает данные.
+    """
+    resume_from = last_event_id_header if last_event_id_header is not None else last_event_id
+    # Подписка до чтения истории, чтобы не потерять события между ними
+    subscription = event_hub.subscribe(ticket_id)
+
+    async def event_generator():
+        try:
+            yield "retry: 3000\n\n"
+
+            replayed = set()
+            if resume_from is not None:
+                events, resync_reason = await event_hub.resume(resume_from, ticket_id)
+                if resync_reason:
+                    # Уже полученные живые события войдут в перезагруженные клиентом данные
+                    stale = []
+                    while not subscription.queue.empty():
+                        stale.append(subscription.queue.get_nowait())
+                    if None in stale:
+                        return
+                    logger.info(f"SSE client resumed from event #{resume_from}: resync ({resync_reason})")
+                    yield format_sse(event_hub.resync_event(resync_reason))
+                for event in events:
+                    replayed.add(event['id'])
+                    yield format_sse(event)
+
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), timeout=EVENTS_HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+
+                if event is None:
+                    break
+                if event['id'] in replayed:
+                    continue
+                yield format_sse(event)
+        finally:
+            event_hub.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint для мониторинга"""
     try:
         # Проверка подключения к БД
-        async with db_pool.acquire() as conn:
+        async with db_pool.acquire('health_check') as conn:
             await conn.fetchval('SELECT 1')
 
         return {
@@ -633,6 +960,41 @@ async def health_check():
         )
 
 
+@app.get("/metrics")
+async def metrics():
+    """Метрики процесса в текстовом формате Prometheus (AI, SQL, webhook, SMTP, HTTP)"""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/health/db-pool")
+async def db_pool_stats():
+    """Статистика пула соединений: ожидание, время удержания по endpoint, насыщение"""
+    return db_pool.snapshot()
+
+
+@app.get("/health/ai-clients")
+async def ai_client_stats():
+    """Статистика HTTP клиентов LLM: запросы, ошибки, повторное использование соединений"""
+    return get_ai_service().client_stats()
+
+
+@app.get("/health/generation")
+async def generation_coalescing_stats():
+    """
+    Объединение серий сообщений: поставлено генераций и сколько сообщений к ним присоединено;
+    superseded - генерации воркеров этого процесса, устаревшие из-за нового сообщения
+    """
+    total = generation_stats['enqueued'] + generation_stats['coalesced']
+    return {
+        "debounceWindow": DEBOUNCE_WINDOW,
+        "debounceMax": DEBOUNCE_MAX,
+        "enqueued": generation_stats['enqueued'],
+        "coalesced": generation_stats['coalesced'],
+        "savedRatio": round(generation_stats['coalesced'] / total, 3) if total else 0.0,
+        "superseded": dict(supersede_stats)
+    }
+
+
 # User Sessions API
 class UserSession(BaseModel):
     user_id: int = Field(gt=0)
@@ -643,12 +1005,47 @@ class UserSession(BaseModel):
     pending_media_url: Optional[str] = None
     pending_media_file_id: Optional[str] = None
     pending_media_caption: Optional[str] = None
+    # Версия, которую видел клиент; при несовпадении запись отклоняется (409)
+    version: Optional[int] = None
+
+
+async def save_session(conn, session: dict, expected_version: Optional[int] = None) -> Optional[dict]:
+    """Upsert сессии пользователя; версия растет с каждой записью. None - версия устарела"""
+    row = await conn.fetchrow(
+        '''INSERT INTO user_sessions
+           (user_id, active_ticket_id, awaiting_clarification, original_message,
+            pending_media_type, pending_media_url, pending_media_file_id, pending_media_caption, updated_at)
+           VALUES ($1, $2, $3, $4, $5, $6, $7, $8, NOW())
+           ON CONFLICT (user_id)
+           DO UPDATE SET
+               active_ticket_id = $2,
+               awaiting_clarification = $3,
+               original_message = $4,
+               pending_media_type = $5,
+               pending_media_url = $6,
+               pending_media_file_id = $7,
+               pending_media_caption = $8,
+               version = user_sessions.version + 1,
+               updated_at = NOW()
+           WHERE $9::int IS NULL OR user_sessions.version = $9
+           RETURNING *''',
+        session['user_id'],
+        session['active_ticket_id'],
+        session['awaiting_clarification'],
+        session['original_message'],
+        session['pending_media_type'],
+        session['pending_media_url'],
+        session['pending_media_file_id'],
+        session['pending_media_caption'],
+        expected_version
+    )
+    return dict(row) if row else None
 
 
 @api_v1_router.get("/sessions/{user_id}")
 async def get_session(user_id: int):
     """Получить сессию пользователя"""
-    async with db_pool.acquire() as conn:
+    async with db_pool.acquire('get_session') as conn:
         session = await conn.fetchrow(
             'SELECT * FROM user_sessions WHERE user_id = $1',
             user_id
@@ -667,35 +1064,117 @@ async def get_session(user_id: int):
 
 @api_v1_router.post("/sessions")
 async def update_session(session_data: UserSession):
-    """Обновить или создать сессию пользователя"""
-    async with db_pool.acquire() as conn:
-        session = await conn.fetchrow(
-            '''INSERT INTO user_sessions
-               (user_id, active_ticket_id, awaiting_clarification, original_message,
-                pending_media_type, pending_media_url, pending_media_file_id, pending_media_caption, updated_at)
-               VALUES ($1, $2, $3, $4, $5, $6, $7, $8, NOW())
-               ON CONFLICT (user_id)
-               DO UPDATE SET
-                   active_ticket_id = $2,
-                   awaiting_clarification = $3,
-                   original_message = $4,
-                   pending_media_type = $5,
-                   pending_media_url = $6,
-                   pending_media_file_id = $7,
-                   pending_media_caption = $8,
-                   updated_at = NOW()
-               RETURNING *''',
-            session_data.user_id,
-            session_data.active_ticket_id,
-            session_data.awaiting_clarification,
-            session_data.original_message,
-            session_data.pending_media_type,
-            session_data.pending_media_url,
-            session_data.pending_media_file_id,
-            session_data.pending_media_caption
-        )
+    """Обновить или создать сессию пользователя (с version - только если версия не изменилась)"""
+    async with db_pool.acquire('update_session') as conn:
+        session = await save_session(conn, session_data.model_dump(), session_data.version)
+        if session is None:
+            current = await conn.fetchrow('SELECT * FROM user_sessions WHERE user_id = $1', session_data.user_id)
+            raise HTTPException(
+                status_code=409,
+                detail={"error": "Session version conflict", "session": jsonable_encoder(dict(current))}
+            )
 
-    return dict(session)
+    return session
+
+
+@api_v1_router.post("/inbound")
+async def inbound_message(request: InboundMessageRequest):
+    """
+    Входящее сообщение из Telegram за один запрос и одну транзакцию:
+    сессия -> уточнение -> новый тикет или сообщение в активный -> сессия.
+
+    action: clarification | ticket_created | message_added
+    """
+    async with db_pool.acquire('inbound_message') as conn:
+        async with conn.transaction():
+            await conn.execute(
+                '''INSERT INTO user_sessions (user_id, active_ticket_id, awaiting_clarification, original_message)
+                   VALUES ($1, NULL, false, '') ON CONFLICT (user_id) DO NOTHING''',
+                request.telegramUserId
+            )
+            # Блокируем сессию: параллельные сообщения пользователя обрабатываются по очереди
+            session = dict(await conn.fetchrow(
+                'SELECT * FROM user_sessions WHERE user_id = $1 FOR UPDATE',
+                request.telegramUserId
+            ))
+
+            media_type, media_url, media_file_id = request.mediaType, request.mediaUrl, request.mediaFileId
+            content = request.text
+
+            if session['awaiting_clarification']:
+                content = f"{session['original_message']}\n\nДополнительно: {request.text}"
+                session['awaiting_clarification'] = False
+                session['original_message'] = ''
+            elif session['active_ticket_id']:
+                ticket = await conn.fetchrow(
+                    'SELECT * FROM tickets WHERE id = $1', session['active_ticket_id']
+                )
+                if ticket:
+                    message, job_id = await insert_message(
+                        conn, ticket['id'], SENDER_USER, str(request.telegramUserId), content,
+                        media_type, media_url, media_file_id, enqueue=not request.extraMedia
+                    )
+                    if request.extraMedia:
+                        job_id = await insert_media_group(conn, ticket['id'], request.telegramUserId, request.extraMedia)
+                    return {
+                        "action": "message_added",
+                        "ticket": ticket_summary(ticket),
+                        "message": dict(message),
+                        "jobId": job_id,
+                        "session": session
+                    }
+                # Активный тикет удален - создаем новый
+                session['active_ticket_id'] = None
+
+            # Медиа, отправленное до уточнения, прикладываем к первому сообщению тикета
+            if not media_type and session['pending_media_type']:
+                media_type = session['pending_media_type']
+                media_url = session['pending_media_url']
+                media_file_id = session['pending_media_file_id']
+
+            validation = await validate_with_ai(content)
+            if not validation.isValid:
+                session['awaiting_clarification'] = True
+                session['original_message'] = content
+                session['pending_media_type'] = media_type
+                session['pending_media_url'] = media_url
+                session['pending_media_file_id'] = media_file_id
+                session['pending_media_caption'] = request.text if request.mediaType else session['pending_media_caption']
+                session = await save_session(conn, session)
+                if request.extraMedia:
+                    # В сессии хранится одно отложенное медиа - остальные элементы альбома не сохраняются
+                    logger.warning(
+                        f"Media group of user {request.telegramUserId} sent for clarification: "
+                        f"{len(request.extraMedia)} extra items dropped"
+                    )
+                return {
+                    "action": "clarification",
+                    "suggestion": validation.suggestion,
+                    "missingInfo": validation.missingInfo,
+                    "session": session
+                }
+
+            ticket, message, job_id = await insert_ticket(
+                conn, request.telegramUserId, request.telegramUsername, content,
+                media_type, media_url, media_file_id, enqueue=not request.extraMedia
+            )
+            if request.extraMedia:
+                job_id = await insert_media_group(conn, ticket['id'], request.telegramUserId, request.extraMedia)
+            session['active_ticket_id'] = ticket['id']
+            session['pending_media_type'] = None
+            session['pending_media_url'] = None
+            session['pending_media_file_id'] = None
+            session['pending_media_caption'] = None
+            session = await save_session(conn, session)
+
+    return {
+        "action": "ticket_created",
+        "ticket": ticket_summary(ticket),
+        "category": validation.category,
+        "message": dict(message),
+        "jobId": job_id,
+        "session": session
+    }
 
 
 # Подключаем router к приложению
@@ -0,0 +1,101 @@
+"""
+Session Cache - in-process LRU/TTL cache of bot user sessions
+The bot reads sessions from here and writes through to the API with the cached
+version; a write based on a stale version is rejected by the API (409) and the
+cache is refreshed from the server copy.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+from constants import SESSION_CACHE_SIZE, SESSION_CACHE_TTL
+
+# Поля, которые бот меняет; version/updated_at ведет сервер
+SESSION_FIELDS = (
+    'active_ticket_id',
+    'awaiting_clarification',
+    'original_message',
+    'pending_media_type',
+    'pending_media_url',
+    'pending_media_file_id',
+    'pending_media_caption'
+)
+
+
+class SessionCache:
+    """LRU cache of session dicts keyed by user_id, entries expire after `ttl` seconds"""
+
+    def __init__(self, max_size: int = SESSION_CACHE_SIZE, ttl: float = SESSION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.writes = 0
+        self.writes_skipped = 0
+        self.conflicts = 0
+        self.hit_age_total = 0.0
+        self.hit_age_max = 0.0
+
+    def get(self, user_id: int) -> Optional[Dict]:
+        """Copy of the cached session, or None on miss/expiry"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        session, stored_at = entry
+        age = time.monotonic() - stored_at
+        if age > self.ttl:
+            del self._entries[user_id]
+            self.expired += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        self.hit_age_total += age
+        self.hit_age_max = max(self.hit_age_max, age)
+        return dict(session)
+
+    def put(self, session: Dict):
+        """Store the server copy of a session (ignored if older than the cached version)"""
+        user_id = session['user_id']
+        cached = self._entries.get(user_id)
+        if cached and session.get('version') is not None and cached[0].get('version') is not None:
+            if session['version'] < cached[0]['version']:
+                return
+
+        self._entries[user_id] = (dict(session), time.monotonic())
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+    def is_unchanged(self, session: Dict) -> bool:
+        """True if the session has no changes against the cached copy (the write can be skipped)"""
+        entry = self._entries.get(session['user_id'])
+        if entry is None:
+            return False
+        cached = entry[0]
+        return cached.get('version') == session.get('version') and all(
+            cached.get(field) == session.get(field) for field in SESSION_FIELDS
+        )
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'writes': self.writes,
+            'writes_skipped': self.writes_skipped,
+            'conflicts': self.conflicts,
+            'hit_age_avg_s': round(self.hit_age_total / self.hits, 2) if self.hits else 0.0,
+            'hit_age_max_s': round(self.hit_age_max, 2)
+        }
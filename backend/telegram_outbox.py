@@ -0,0 +1,538 @@
+"""
+Telegram Outbox - persistent, rate-limited delivery of bot messages
+Messages are stored in telegram_outbox and sent by a dispatcher that enforces
+Telegram's global and per-chat limits with token buckets, honors retry_after
+from 429 responses and never sends a chat's next message before the previous
+one is delivered.
+"""
+
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+import asyncpg
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from db_pool import InstrumentedPool
+from metrics import gauge, histogram
+from tracing import current_traceparent, start_trace, SPAN_CLIENT
+from constants import (
+    OUTBOX_STATUS_PENDING,
+    OUTBOX_STATUS_SENDING,
+    OUTBOX_STATUS_SENT,
+    OUTBOX_STATUS_FAILED,
+    OUTBOX_ACTION_SEND,
+    OUTBOX_ACTION_EDIT,
+    OUTBOX_GLOBAL_RATE,
+    OUTBOX_CHAT_RATE,
+    OUTBOX_CHAT_BURST,
+    OUTBOX_MAX_IN_FLIGHT,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_RETRY_DELAY,
+    OUTBOX_SEND_LEASE,
+    OUTBOX_SEND_WAIT,
+    OUTBOX_POLL_INTERVAL,
+    OUTBOX_FETCH_LIMIT,
+    OUTBOX_LATENCY_WINDOW,
+    OUTBOX_RETENTION_HOURS
+)
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_SEND_SECONDS = histogram('helpdesk_telegram_send_seconds', 'Telegram Bot API call from the outbox', ('action', 'result'))
+OUTBOX_IN_FLIGHT = gauge('helpdesk_outbox_in_flight', 'Outbox messages being sent to Telegram')
+
+# sender(item) -> telegram message_id; исключения telegram.error классифицируются диспетчером
+Sender = Callable[[Dict], Awaitable[int]]
+
+
+async def init_outbox_schema(conn: asyncpg.Connection):
+    """Create telegram_outbox table and indexes"""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS telegram_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            action VARCHAR(10) NOT NULL DEFAULT 'send',
+            message_id BIGINT,
+            text TEXT NOT NULL,
+            parse_mode VARCHAR(20),
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            max_attempts INT NOT NULL DEFAULT 5,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            claimed_at TIMESTAMP,
+            telegram_message_id BIGINT,
+            last_error TEXT,
+            trace_parent VARCHAR(55),
+            created_at TIMESTAMP DEFAULT NOW(),
+            sent_at TIMESTAMP
+        );
+    ''')
+
+    # Трейс запроса, поставившего сообщение: отправка диспетчером продолжает его
+    await conn.execute('ALTER TABLE telegram_outbox ADD COLUMN IF NOT EXISTS trace_parent VARCHAR(55);')
+
+    # Диспетчер смотрит только на неотправленные сообщения, по порядку внутри чата
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_telegram_outbox_open
+        ON telegram_outbox(chat_id, id) WHERE status IN ('pending', 'sending');
+    ''')
+
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_telegram_outbox_created_at
+        ON telegram_outbox(created_at);
+    ''')
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, at most `capacity` stored"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """Seconds until one token is available (0 - available now)"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class OutboxMetrics:
+    """Delivery counters and recent enqueue-to-sent latencies"""
+
+    def __init__(self):
+        self.enqueued = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.latencies = deque(maxlen=OUTBOX_LATENCY_WINDOW)
+
+    def to_dict(self) -> Dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0.0
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2)
+
+        return {
+            'enqueued': self.enqueued,
+            'coalesced': self.coalesced,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'rate_limited': self.rate_limited,
+            'latency_p50_ms': percentile(0.5),
+            'latency_p95_ms': percentile(0.95),
+            'latency_max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0
+        }
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class Outbox:
+    """
+    Durable outbox with a single dispatcher task per process
+
+    Usage:
+        outbox = Outbox(db_pool, sender)
+        await outbox.start()
+        outbox_id = await outbox.enqueue(chat_id, 'send', text)
+        result = await outbox.wait(outbox_id, timeout=3.0)
+
+    Rows are claimed with a conditional UPDATE, so several webhook processes
+    never send the same message; rate limits are enforced per process.
+    """
+
+    def __init__(
+        self,
+        pool: InstrumentedPool,
+        sender: Sender,
+        global_rate: float = OUTBOX_GLOBAL_RATE,
+        chat_rate: float = OUTBOX_CHAT_RATE,
+        chat_burst: int = OUTBOX_CHAT_BURST
+    ):
+        self.pool = pool
+        self.sender = sender
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.chat_blocked_until: Dict[int, float] = {}
+        self.in_flight: Set[int] = set()
+        OUTBOX_IN_FLIGHT.set_function(lambda: len(self.in_flight))
+        self.metrics = OutboxMetrics()
+        self._waiters: Dict[int, List[asyncio.Future]] = {}
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._sends: Set[asyncio.Task] = set()
+
+    async def start(self):
+        self._tasks = [
+            asyncio.create_task(self._run()),
+            asyncio.create_task(self._prune_periodically())
+        ]
+        logger.info("Telegram outbox dispatcher started")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        # Начатые отправки доводим до конца, чтобы не отправить сообщение повторно после рестарта
+        if self._sends:
+            await asyncio.gather(*self._sends, return_exceptions=True)
+
+    async def enqueue(
+        self,
+        chat_id: int,
+        action: str,
+        text: str,
+        parse_mode: Optional[str] = None,
+        message_id: Optional[int] = None
+    ) -> int:
+        """Store message for delivery; a pending edit of the same message is replaced instead"""
+        async with self.pool.acquire('outbox.enqueue') as conn:
+            outbox_id = await self._insert(conn, chat_id, action, text, parse_mode, message_id)
+        self._wakeup.set()
+        return outbox_id
+
+    async def enqueue_many(self, items: List[Dict]) -> List[int]:
+        """Store several messages in one transaction (keys as in enqueue)"""
+        async with self.pool.acquire('outbox.enqueue_many') as conn:
+            async with conn.transaction():
+                ids = [
+                    await self._insert(
+                        conn, item['chat_id'], item['action'], item['text'],
+                        item.get('parse_mode'), item.get('message_id')
+                    )
+                    for item in items
+                ]
+        self._wakeup.set()
+        return ids
+
+    async def replace(self, outbox_id: int, chat_id: int, text: str, parse_mode: Optional[str] = None) -> int:
+        """
+        Deliver `text` in place of an earlier send (e.g. a streamed partial answer)
+
+        Still queued - its text is replaced, so the stale version is never sent;
+        already sent - the Telegram message is edited; failed or unknown - sent anew.
+        Returns the outbox id to wait for.
+        """
+        row = await self._replace_queued(outbox_id, chat_id, text, parse_mode)
+        if row and row['status'] == OUTBOX_STATUS_SENDING:
+            # Отправка уже идет - дождаться message_id, чтобы править, а не дублировать
+            result = await self.wait(outbox_id, OUTBOX_SEND_WAIT)
+            if result is None:
+                raise RuntimeError(f"Outbox message #{outbox_id} is still being sent")
+            row = await self._replace_queued(outbox_id, chat_id, text, parse_mode)
+
+        if row and row['status'] == OUTBOX_STATUS_PENDING:
+            self.metrics.coalesced += 1
+            self._wakeup.set()
+            return outbox_id
+        if row and row['status'] == OUTBOX_STATUS_SENT and row['telegram_message_id']:
+            return await self.enqueue(chat_id, OUTBOX_ACTION_EDIT, text, parse_mode, message_id=row['telegram_message_id'])
+        return await self.enqueue(chat_id, OUTBOX_ACTION_SEND, text, parse_mode)
+
+    async def _replace_queued(self, outbox_id: int, chat_id: int, text: str, parse_mode: Optional[str]):
+        async with self.pool.acquire('outbox.replace') as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow(
+                    'SELECT status, telegram_message_id FROM telegram_outbox WHERE id = $1 AND chat_id = $2 FOR UPDATE',
+                    outbox_id, chat_id
+                )
+                if row and row['status'] == OUTBOX_STATUS_PENDING:
+                    await conn.execute(
+                        'UPDATE telegram_outbox SET text = $2, parse_mode = $3, trace_parent = $4 WHERE id = $1',
+                        outbox_id, text, parse_mode, current_traceparent()
+                    )
+                return row
+
+    async def _insert(self, conn, chat_id, action, text, parse_mode, message_id) -> int:
+        trace_parent = current_traceparent()
+        if action == OUTBOX_ACTION_EDIT:
+            # Правки потоковой генерации: в очереди нужна только последняя версия текста
+            outbox_id = await conn.fetchval(
+                '''UPDATE telegram_outbox SET text = $1, parse_mode = $2, trace_parent = $7
+                   WHERE id = (
+                       SELECT id FROM telegram_outbox
+                       WHERE chat_id = $3 AND action = $4 AND message_id = $5 AND status = $6
+                       ORDER BY id DESC LIMIT 1
+                   )
+                   RETURNING id''',
+                text, parse_mode, chat_id, action, message_id, OUTBOX_STATUS_PENDING, trace_parent
+            )
+            if outbox_id:
+                self.metrics.coalesced += 1
+                return outbox_id
+
+        self.metrics.enqueued += 1
+        return await conn.fetchval(
+            '''INSERT INTO telegram_outbox (chat_id, action, message_id, text, parse_mode, max_attempts, trace_parent)
+               VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING id''',
+            chat_id, action, message_id, text, parse_mode, OUTBOX_MAX_ATTEMPTS, trace_parent
+        )
+
+    async def wait(self, outbox_id: int, timeout: float) -> Optional[Dict]:
+        """Wait until the message is sent or failed; None if still queued after timeout"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(outbox_id, []).append(future)
+        try:
+            # Сообщение могло быть отправлено до регистрации (или другим процессом)
+            async with self.pool.acquire('outbox.wait') as conn:
+                row = await conn.fetchrow('SELECT * FROM telegram_outbox WHERE id = $1', outbox_id)
+            if row and row['status'] in (OUTBOX_STATUS_SENT, OUTBOX_STATUS_FAILED):
+                return self._result(row)
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self._waiters.get(outbox_id, [])
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters:
+                self._waiters.pop(outbox_id, None)
+
+    @staticmethod
+    def _result(row) -> Dict:
+        return {
+            'id': row['id'],
+            'status': row['status'],
+            'messageId': row['telegram_message_id'],
+            'error': row['last_error']
+        }
+
+    def _resolve(self, row):
+        for future in self._waiters.get(row['id'], []):
+            if not future.done():
+                future.set_result(self._result(row))
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _run(self):
+        while True:
+            try:
+                delay = await self._dispatch_once()
+            except Exception as e:
+                logger.error(f"Outbox dispatch failed: {e}", exc_info=True)
+                delay = OUTBOX_POLL_INTERVAL
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch_once(self) -> float:
+        """Start every send the limits allow now; return seconds until the next one may be due"""
+        next_delay = OUTBOX_POLL_INTERVAL
+        now = time.monotonic()
+
+        async with self.pool.acquire('outbox.dispatch') as conn:
+            # Голова очереди каждого чата; более поздние сообщения ждут ее доставки
+            heads = await conn.fetch(
+                '''SELECT *, EXTRACT(EPOCH FROM next_attempt_at - NOW())::float8 AS due_in,
+                          claimed_at < NOW() - make_interval(secs => $3) AS lease_expired
+                   FROM (
+                       SELECT DISTINCT ON (chat_id) * FROM telegram_outbox
+                       WHERE status IN ($1, $2)
+                       ORDER BY chat_id, id
+                   ) heads
+                   ORDER BY id
+                   LIMIT $4''',
+                OUTBOX_STATUS_PENDING, OUTBOX_STATUS_SENDING, OUTBOX_SEND_LEASE, OUTBOX_FETCH_LIMIT
+            )
+
+            for row in heads:
+                chat_id = row['chat_id']
+                if chat_id in self.in_flight:
+                    continue
+                if row['status'] == OUTBOX_STATUS_SENDING and not row['lease_expired']:
+                    continue
+                if row['status'] == OUTBOX_STATUS_PENDING and row['due_in'] > 0:
+                    next_delay = min(next_delay, row['due_in'])
+                    continue
+
+                blocked_for = self.chat_blocked_until.get(chat_id, 0) - now
+                if blocked_for > 0:
+                    next_delay = min(next_delay, blocked_for)
+                    continue
+
+                bucket = self._chat_bucket(chat_id)
+                chat_wait = bucket.wait_time()
+                if chat_wait > 0:
+                    next_delay = min(next_delay, chat_wait)
+                    continue
+
+                global_wait = self.global_bucket.wait_time()
+                if global_wait > 0 or len(self._sends) >= OUTBOX_MAX_IN_FLIGHT:
+                    next_delay = min(next_delay, global_wait or OUTBOX_POLL_INTERVAL)
+                    break
+
+                item = await conn.fetchrow(
+                    '''UPDATE telegram_outbox
+                       SET status = $2, attempts = attempts + 1, claimed_at = NOW()
+                       WHERE id = $1 AND (status = $3 OR (status = $2 AND claimed_at < NOW() - make_interval(secs => $4)))
+                       RETURNING *''',
+                    row['id'], OUTBOX_STATUS_SENDING, OUTBOX_STATUS_PENDING, OUTBOX_SEND_LEASE
+                )
+                if not item:
+                    continue
+
+                bucket.consume()
+                self.global_bucket.consume()
+                self.in_flight.add(chat_id)
+                task = asyncio.create_task(self._deliver(dict(item)))
+                self._sends.add(task)
+                task.add_done_callback(self._sends.discard)
+
+        self._forget_idle_chats(now)
+        return max(next_delay, 0.01)
+
+    def _forget_idle_chats(self, now: float):
+        for chat_id in [c for c, until in self.chat_blocked_until.items() if until <= now]:
+            del self.chat_blocked_until[chat_id]
+        if len(self.chat_buckets) > OUTBOX_FETCH_LIMIT:
+            for chat_id in [c for c, b in self.chat_buckets.items() if c not in self.in_flight and b.idle()]:
+                del self.chat_buckets[chat_id]
+
+    async def _deliver(self, item: Dict):
+        chat_id = item['chat_id']
+        started = time.perf_counter()
+        result = 'error'
+        try:
+            try:
+                with start_trace(
+                    f"telegram {item['action']}", item.get('trace_parent'), SPAN_CLIENT,
+                    outbox_id=item['id'], attempt=item['attempts']
+                ):
+                    message_id = await self.sender(item)
+                result = 'sent'
+            except RetryAfter as e:
+                result = 'retry_after'
+                await self._reschedule(item, _retry_after_seconds(e), str(e), consume_attempt=False)
+            except (BadRequest, Forbidden) as e:
+                # Ошибка запроса или бот заблокирован - повтор не поможет
+                await self._fail(item, str(e))
+            except Exception as e:
+                if item['attempts'] >= item['max_attempts']:
+                    await self._fail(item, str(e))
+                else:
+                    await self._reschedule(item, OUTBOX_RETRY_DELAY * item['attempts'], str(e))
+            else:
+                await self._mark_sent(item, message_id)
+        except Exception as e:
+            # Статус не записан: строка вернется в очередь по истечении аренды
+            logger.error(f"Outbox bookkeeping failed for #{item['id']}: {e}", exc_info=True)
+        finally:
+            TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - started, item['action'], result)
+            self.in_flight.discard(chat_id)
+            self._wakeup.set()
+
+    async def _mark_sent(self, item: Dict, message_id: int):
+        async with self.pool.acquire('outbox.sent') as conn:
+            row = await conn.fetchrow(
+                '''UPDATE telegram_outbox
+                   SET status = $2, telegram_message_id = $3, sent_at = NOW(), last_error = NULL
+                   WHERE id = $1 RETURNING *, EXTRACT(EPOCH FROM sent_at - created_at)::float8 AS latency''',
+                item['id'], OUTBOX_STATUS_SENT, message_id
+            )
+        self.metrics.sent += 1
+        self.metrics.latencies.append(row['latency'])
+        self._resolve(row)
+
+    async def _reschedule(self, item: Dict, delay: float, error: str, consume_attempt: bool = True):
+        if consume_attempt:
+            self.metrics.retried += 1
+        else:
+            # 429: чат ждет ровно столько, сколько попросил Telegram; попытка не расходуется
+            self.metrics.rate_limited += 1
+            self.chat_blocked_until[item['chat_id']] = time.monotonic() + delay
+            logger.warning(f"Telegram rate limit for chat {item['chat_id']}: retry after {delay:.1f}s")
+
+        async with self.pool.acquire('outbox.reschedule') as conn:
+            await conn.execute(
+                '''UPDATE telegram_outbox
+                   SET status = $2, last_error = $3, claimed_at = NULL,
+                       attempts = attempts - $4,
+                       next_attempt_at = NOW() + make_interval(secs => $5)
+                   WHERE id = $1''',
+                item['id'], OUTBOX_STATUS_PENDING, error[:1000], 0 if consume_attempt else 1, delay
+            )
+
+    async def _fail(self, item: Dict, error: str):
+        logger.error(f"Telegram message #{item['id']} to chat {item['chat_id']} failed: {error}")
+        async with self.pool.acquire('outbox.failed') as conn:
+            row = await conn.fetchrow(
+                '''UPDATE telegram_outbox SET status = $2, last_error = $3, claimed_at = NULL
+                   WHERE id = $1 RETURNING *''',
+                item['id'], OUTBOX_STATUS_FAILED, error[:1000]
+            )
+        self.metrics.failed += 1
+        self._resolve(row)
+
+    async def _prune_periodically(self):
+        while True:
+            try:
+                async with self.pool.acquire('outbox.prune') as conn:
+                    result = await conn.execute(
+                        '''DELETE FROM telegram_outbox
+                           WHERE status IN ($1, $2) AND created_at < NOW() - make_interval(hours => $3)''',
+                        OUTBOX_STATUS_SENT, OUTBOX_STATUS_FAILED, OUTBOX_RETENTION_HOURS
+                    )
+                deleted = int(result.split()[-1])
+                if deleted:
+                    logger.info(f"Pruned {deleted} delivered outbox messages")
+            except Exception as e:
+                logger.error(f"Outbox prune failed: {e}")
+            await asyncio.sleep(3600)
+
+    async def stats(self) -> Dict:
+        """Queue depth by status, delivery counters and latency"""
+        async with self.pool.acquire('outbox.stats') as conn:
+            rows = await conn.fetch(
+                '''SELECT status, COUNT(*) AS count,
+                          EXTRACT(EPOCH FROM NOW() - MIN(created_at))::float8 AS oldest_age
+                   FROM telegram_outbox WHERE status IN ($1, $2) GROUP BY status''',
+                OUTBOX_STATUS_PENDING, OUTBOX_STATUS_SENDING
+            )
+        depth = {row['status']: row['count'] for row in rows}
+        oldest = max((row['oldest_age'] for row in rows), default=0.0)
+        return {
+            'queue_depth': depth.get(OUTBOX_STATUS_PENDING, 0),
+            'sending': depth.get(OUTBOX_STATUS_SENDING, 0),
+            'oldest_pending_s': round(oldest, 2),
+            'in_flight_chats': len(self.in_flight),
+            'rate_limited_chats': len(self.chat_blocked_until),
+            **self.metrics.to_dict()
+        }
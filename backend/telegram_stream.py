@@ -0,0 +1,172 @@
+"""
+Telegram Stream - progressive delivery of a streamed AI response
+Sends the first Telegram message as soon as the first sentence is ready,
+then edits it in throttled increments while generation continues. Posts run
+in one background task per response, so the token loop never waits for the
+webhook; texts that arrive while a post is in flight are coalesced into the
+next edit.
+"""
+
+import re
+import time
+import asyncio
+import logging
+from typing import Optional
+import httpx
+from constants import (
+    WEBHOOK_TIMEOUT,
+    STREAM_EDIT_INTERVAL,
+    STREAM_FIRST_MESSAGE_MAX_WAIT_CHARS
+)
+from metrics import histogram
+from tracing import span, trace_headers, SPAN_CLIENT
+
+logger = logging.getLogger(__name__)
+
+# Запросы воркеров к webhook серверу (потоковые правки и финальная доставка)
+WEBHOOK_POST_SECONDS = histogram('helpdesk_webhook_post_seconds', 'POST to the webhook server', ('action',))
+
+# Конец предложения: знак препинания + пробел/перевод строки, либо пустая строка
+SENTENCE_END = re.compile(r'[.!?…](\s|$)|\n\n')
+
+# Текст вместо недописанного ответа, если пользователь успел написать еще
+SUPERSEDED_TEXT = "⏳ Учитываю ваше новое сообщение..."
+
+_webhook_client: Optional[httpx.AsyncClient] = None
+
+
+def get_webhook_client() -> httpx.AsyncClient:
+    """Shared keep-alive client for worker requests to the webhook server"""
+    global _webhook_client
+    if _webhook_client is None or _webhook_client.is_closed:
+        _webhook_client = httpx.AsyncClient(timeout=WEBHOOK_TIMEOUT)
+    return _webhook_client
+
+
+async def close_webhook_client():
+    global _webhook_client
+    if _webhook_client is not None:
+        await _webhook_client.aclose()
+        _webhook_client = None
+
+
+class TelegramStreamSink:
+    """
+    Receives accumulated response text and mirrors it into one Telegram message
+
+    Delivery problems never interrupt generation: they are logged and the final
+    text is still delivered by the regular deliver job. Call close() before
+    reading message_id / outbox_id for the deliver job.
+    """
+
+    def __init__(
+        self,
+        webhook_base_url: str,
+        telegram_user_id: int,
+        ticket_number: str,
+        edit_interval: float = STREAM_EDIT_INTERVAL
+    ):
+        self.webhook_base_url = webhook_base_url
+        self.telegram_user_id = telegram_user_id
+        self.ticket_number = ticket_number
+        self.edit_interval = edit_interval
+        self.message_id: Optional[int] = None
+        # Первое сообщение осталось в очереди outbox: финальный текст заменит его, а не продублирует
+        self.outbox_id: Optional[int] = None
+        self._sent_text = ""
+        self._last_update = 0.0
+        self._failed = False
+        # Последний текст, еще не отправленный; промежуточные заменяются новыми
+        self._pending: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+        self._posting = False
+
+    async def __call__(self, text: str):
+        """Called from the token loop: only schedules the post, never waits for it"""
+        if self._failed:
+            return
+
+        if self.message_id is None and self._task is None:
+            if not SENTENCE_END.search(text) and len(text) < STREAM_FIRST_MESSAGE_MAX_WAIT_CHARS:
+                return
+
+        self._pending = text
+        if self._task is None:
+            self._task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        """Post the latest pending text until nothing new arrives; edits are throttled"""
+        try:
+            while self._pending is not None and not self._failed:
+                if self.message_id is not None:
+                    wait = self.edit_interval - (time.monotonic() - self._last_update)
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                text, self._pending = self._pending, None
+                if text is None or text == self._sent_text:
+                    continue
+                self._posting = True
+                try:
+                    await self._post('edit-message' if self.message_id is not None else 'send-message', text)
+                finally:
+                    self._posting = False
+        finally:
+            self._task = None
+
+    async def close(self):
+        """
+        Stop streaming: drop texts not yet sent and wait for the post in flight,
+        so message_id / outbox_id are final
+        """
+        self._pending = None
+        task = self._task
+        if task is None:
+            return
+        if not self._posting:
+            # Ждет интервала между правками - ждать нечего
+            task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    async def supersede(self):
+        """Replace the partial answer of a superseded generation with a short note"""
+        await self.close()
+        if self.message_id is not None and not self._failed:
+            await self._post('edit-message', SUPERSEDED_TEXT)
+        elif self.message_id is None and self.outbox_id is not None:
+            # Недописанный ответ еще в очереди - он уйдет уже с заменой
+            self._failed = False
+            await self._post('send-message', SUPERSEDED_TEXT)
+
+    async def _post(self, action: str, text: str):
+        body = {
+            "telegramUserId": self.telegram_user_id,
+            "message": text,
+            "ticketNumber": self.ticket_number,
+            "partial": True
+        }
+        if self.message_id is not None:
+            body["messageId"] = self.message_id
+        elif self.outbox_id is not None:
+            body["replaceOutboxId"] = self.outbox_id
+
+        try:
+            with WEBHOOK_POST_SECONDS.time(action), span(f'webhook {action}', SPAN_CLIENT, partial=True):
+                response = await get_webhook_client().post(
+                    f"{self.webhook_base_url}/webhook/{action}", json=body, headers=trace_headers()
+                )
+                response.raise_for_status()
+                data = response.json()
+            if not data.get('success'):
+                raise RuntimeError(data.get('error'))
+            # Первое сообщение застряло в очереди outbox (лимиты Telegram) - править нечего;
+            # его outboxId передается в deliver, чтобы финальный текст заменил строку в очереди
+            if self.message_id is None and not data.get('messageId'):
+                self.outbox_id = data.get('outboxId')
+                raise RuntimeError('first message queued')
+            self.message_id = data.get('messageId') or self.message_id
+            self._sent_text = text
+            self._last_update = time.monotonic()
+        except Exception as e:
+            # Дальше не пытаемся: финальный текст доставит задача deliver
+            self._failed = True
+            logger.warning(f"Streaming delivery to {self.telegram_user_id} stopped ({action}): {e}")
@@ -0,0 +1,238 @@
+"""
+Ticket Search - full-text search over conversations for managers
+Messages and ticket summaries carry a `search_tsv` tsvector ('russian'
+configuration: stemming, so "доставка" finds "доставку", "доставки") kept up
+to date by triggers and indexed with GIN. Ticket numbers and usernames are
+matched by prefix through trigram indexes (pg_trgm).
+
+Text matches are limited to messages and tickets created in the last
+`days` (SEARCH_WINDOW_DAYS by default): the created_at condition lets the
+planner intersect the GIN bitmap with the created_at index, so the heap rows
+read and rechecked are bounded by the window, not by the whole history. A
+common word still reads its whole GIN posting list, and inside the window
+every match is fetched before the SEARCH_CANDIDATES most recent are ranked,
+so its cost grows with the traffic of the window.
+
+Only those SEARCH_CANDIDATES newest matches per source are ranked, so for a
+common word the result is the best of the newest matches, not the best of
+the window, and pagination ends at the cap. The response says so with
+`truncated: true`; a narrower `days` or a more specific query gives a
+complete ranking. Highlights (ts_headline) are built for the returned page
+only. Pages are keyset-paginated by (rank, kind, id); the next page must be
+requested with the same `days`.
+
+For messages written before the search columns existed:
+    python backfill_search_index.py
+"""
+
+import json
+import html
+import base64
+import logging
+from typing import Dict, List, Optional, Tuple
+import asyncpg
+from constants import SEARCH_CONFIG, SEARCH_CANDIDATES, SEARCH_SNIPPET_WORDS, SEARCH_WINDOW_DAYS
+
+logger = logging.getLogger(__name__)
+
+HIT_MESSAGE = 'message'
+HIT_SUMMARY = 'summary'
+HIT_TICKET = 'ticket'
+
+# Маркеры подсветки из ts_headline; текст экранируется, затем маркеры становятся <mark>
+_MARK_START = '\x02'
+_MARK_STOP = '\x03'
+_HEADLINE_OPTIONS = (
+    f'StartSel={_MARK_START}, StopSel={_MARK_STOP}, '
+    f'MaxWords={SEARCH_SNIPPET_WORDS}, MinWords={SEARCH_SNIPPET_WORDS // 3}, MaxFragments=2, FragmentDelimiter=" … "'
+)
+
+# Ранг совпадения по номеру тикета / username выше любого ранга текста (ts_rank_cd с нормализацией 32 < 1)
+RANK_EXACT = 3.0
+RANK_PREFIX = 2.0
+
+
+async def init_search_schema(conn: asyncpg.Connection):
+    """Search columns, triggers and indexes on messages and tickets"""
+    await conn.execute('''
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_tsv tsvector;
+        ALTER TABLE tickets ADD COLUMN IF NOT EXISTS search_tsv tsvector;
+    ''')
+
+    # Вектор пересчитывается в той же строке при INSERT и изменении текста
+    await conn.execute(f'''
+        DROP TRIGGER IF EXISTS trg_messages_search_tsv ON messages;
+        CREATE TRIGGER trg_messages_search_tsv
+        BEFORE INSERT OR UPDATE OF content ON messages
+        FOR EACH ROW EXECUTE FUNCTION tsvector_update_trigger(search_tsv, 'pg_catalog.{SEARCH_CONFIG}', content);
+
+        DROP TRIGGER IF EXISTS trg_tickets_search_tsv ON tickets;
+        CREATE TRIGGER trg_tickets_search_tsv
+        BEFORE INSERT OR UPDATE OF ai_summary ON tickets
+        FOR EACH ROW EXECUTE FUNCTION tsvector_update_trigger(search_tsv, 'pg_catalog.{SEARCH_CONFIG}', ai_summary);
+    ''')
+
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_search_tsv ON messages USING GIN (search_tsv);
+        CREATE INDEX IF NOT EXISTS idx_tickets_search_tsv ON tickets USING GIN (search_tsv);
+    ''')
+
+    try:
+        await conn.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm;')
+    except asyncpg.PostgresError as e:
+        # Без прав на расширение поиск по номеру/username работает, но без индекса
+        logger.warning(f"pg_trgm not available, ticket number search is unindexed: {e}")
+        return
+
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tickets_number_trgm ON tickets USING GIN (ticket_number gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_tickets_username_trgm ON tickets USING GIN (lower(telegram_username) gin_trgm_ops);
+    ''')
+
+
+def encode_search_cursor(rank: float, kind: str, hit_id: int) -> str:
+    raw = json.dumps([rank, kind, hit_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_search_cursor(cursor: str) -> Tuple[float, str, int]:
+    """Raises ValueError on a malformed cursor"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        rank, kind, hit_id = json.loads(base64.urlsafe_b64decode(padded))
+        return float(rank), str(kind), int(hit_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def _like_prefix(text: str) -> str:
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'{escaped}%'
+
+
+def highlight(snippet: Optional[str]) -> Optional[str]:
+    """ts_headline output as safe HTML with <mark> around matches"""
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(_MARK_START, '<mark>').replace(_MARK_STOP, '</mark>')
+
+
+SEARCH_SQL = f'''
+    WITH q AS (
+        SELECT websearch_to_tsquery('{SEARCH_CONFIG}', $1) AS query
+    ),
+    hits AS (
+        SELECT '{HIT_MESSAGE}'::text AS kind, m.id, m.ticket_id,
+               ts_rank_cd(m.search_tsv, q.query, 32) AS rank
+        FROM (
+            SELECT id, ticket_id, search_tsv FROM messages, q
+            WHERE search_tsv @@ q.query AND created_at >= NOW() - make_interval(days => $10)
+            ORDER BY id DESC
+            LIMIT $4
+        ) m, q
+
+        UNION ALL
+
+        SELECT '{HIT_SUMMARY}', t.id, t.id, ts_rank_cd(t.search_tsv, q.query, 32)
+        FROM (
+            SELECT id, search_tsv FROM tickets, q
+            WHERE search_tsv @@ q.query AND created_at >= NOW() - make_interval(days => $10)
+            ORDER BY id DESC
+            LIMIT $4
+        ) t, q
+
+        UNION ALL
+
+        SELECT '{HIT_TICKET}', t.id, t.id, t.rank
+        FROM (
+            SELECT id,
+                   CASE WHEN ticket_number = upper($2) OR lower(telegram_username) = lower($2)
+                        THEN {RANK_EXACT}::real ELSE {RANK_PREFIX}::real END AS rank
+            FROM tickets
+            WHERE $3 AND (ticket_number LIKE upper($5) OR lower(telegram_username) LIKE lower($5))
+            ORDER BY rank DESC, id DESC
+            LIMIT $4
+        ) t
+    ),
+    truncated AS (
+        SELECT COUNT(*) FILTER (WHERE kind = '{HIT_MESSAGE}') >= $4
+            OR COUNT(*) FILTER (WHERE kind = '{HIT_SUMMARY}') >= $4
+            OR COUNT(*) FILTER (WHERE kind = '{HIT_TICKET}') >= $4 AS truncated
+        FROM hits
+    ),
+    page AS (
+        SELECT * FROM hits
+        WHERE $6::real IS NULL OR (rank, kind, id) < ($6::real, $7::text, $8::int)
+        ORDER BY rank DESC, kind DESC, id DESC
+        LIMIT $9
+    )
+    SELECT p.kind, p.id, p.rank,
+           t.id AS ticket_id, t.ticket_number, t.telegram_username, t.status,
+           m.sender_type, COALESCE(m.created_at, t.created_at) AS created_at,
+           CASE p.kind
+               WHEN '{HIT_MESSAGE}' THEN ts_headline('{SEARCH_CONFIG}', m.content, q.query, '{_HEADLINE_OPTIONS}')
+               WHEN '{HIT_SUMMARY}' THEN ts_headline('{SEARCH_CONFIG}', t.ai_summary, q.query, '{_HEADLINE_OPTIONS}')
+               ELSE left(t.first_message, 200)
+           END AS snippet,
+           tr.truncated
+    FROM page p
+    JOIN tickets t ON t.id = p.ticket_id
+    LEFT JOIN messages m ON p.kind = '{HIT_MESSAGE}' AND m.id = p.id
+    CROSS JOIN q
+    CROSS JOIN truncated tr
+    ORDER BY p.rank DESC, p.kind DESC, p.id DESC
+'''
+
+
+async def search_conversations(
+    conn: asyncpg.Connection,
+    text: str,
+    limit: int,
+    after: Optional[Tuple[float, str, int]] = None,
+    days: int = SEARCH_WINDOW_DAYS
+) -> Dict:
+    """
+    Ranked search over message texts, ticket summaries, ticket numbers and usernames
+
+    Args:
+        text: websearch syntax - words, "phrase", -excluded, or a ticket number / @username
+        after: decoded nextCursor of the previous page
+        days: only messages and summaries of tickets created in the last N days
+            are matched by text; ticket numbers and usernames are not limited
+
+    Returns:
+        {"items": [...], "nextCursor": str | None, "truncated": bool}; each item
+        has kind (message / summary / ticket), id of the hit, ticket fields and
+        an HTML-escaped snippet with <mark> around matched words. truncated is
+        true when a source reached SEARCH_CANDIDATES matches: only the newest
+        of them were ranked, older ones may be missing
+    """
+    text = text.strip()
+    # Номер тикета и username - одно слово; для фразы ищем только по тексту
+    identifier = text.lstrip('@')
+    match_identifiers = len(identifier) >= 2 and not any(ch.isspace() for ch in identifier)
+
+    rows = await conn.fetch(
+        SEARCH_SQL,
+        text, identifier, match_identifiers, SEARCH_CANDIDATES, _like_prefix(identifier),
+        *(after or (None, None, None)), limit + 1, days
+    )
+
+    has_more = len(rows) > limit
+    # Флаг одинаков во всех строках; пустая страница - совпадений нет, обрезать было нечего
+    truncated = bool(rows and rows[0]['truncated'])
+    rows = rows[:limit]
+    items: List[Dict] = []
+    for row in rows:
+        item = dict(row)
+        del item['truncated']
+        item['rank'] = round(row['rank'], 4)
+        # Для совпадения по номеру/username фрагмент - первое сообщение без подсветки
+        item['snippet'] = html.escape(row['snippet'] or '') if row['kind'] == HIT_TICKET else highlight(row['snippet'])
+        items.append(item)
+
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        next_cursor = encode_search_cursor(last['rank'], last['kind'], last['id'])
+    return {'items': items, 'nextCursor': next_cursor, 'truncated': truncated}
@@ -0,0 +1,408 @@
+"""
+Tracing - lightweight request traces across bot, API, AI workers and webhook
+A trace starts in a bot handler and travels with the work: as a W3C
+`traceparent` header on HTTP calls (bot -> API, worker -> webhook), inside the
+ai_jobs payload (API -> worker) and in the telegram_outbox row (webhook ->
+Telegram). Spans are recorded only inside a sampled trace, so background loops
+(job polling, outbox dispatch) cost nothing.
+
+Spans are buffered and exported by a background task to a JSONL file
+(TRACE_EXPORT=file, all processes can append to the same file) or to a local
+OpenTelemetry collector over OTLP/HTTP JSON (TRACE_EXPORT=otlp).
+
+    with start_trace('bot.message', user_id=42):
+        with span('api.inbound'):
+            ...
+
+Slowest traces as waterfalls:
+    python tracing.py --slowest 10
+    python tracing.py --trace 4bf92f3577b34da6a3ce929d0e0e4736
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional
+import httpx
+from constants import (
+    TRACE_FLUSH_INTERVAL,
+    TRACE_BUFFER_MAX,
+    TRACE_EXPORT_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT_HEADER = 'traceparent'
+
+TRACE_EXPORT = os.getenv('TRACE_EXPORT', '').lower()
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://127.0.0.1:4318').rstrip('/')
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '1.0'))
+
+SPAN_SERVER = 'server'
+SPAN_CLIENT = 'client'
+SPAN_INTERNAL = 'internal'
+
+# OTLP SpanKind
+_OTLP_KINDS = {SPAN_INTERNAL: 1, SPAN_SERVER: 2, SPAN_CLIENT: 3}
+
+
+class Span:
+    """One timed operation of a trace"""
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind', 'attributes', 'start', 'duration', 'error', '_started')
+
+    def __init__(self, trace_id: str, parent_id: Optional[str], name: str, kind: str, attributes: Dict):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = 0.0
+        self.error: Optional[str] = None
+        self._started = time.perf_counter()
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    @property
+    def traceparent(self) -> str:
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+    def to_dict(self) -> Dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'service': _exporter.service,
+            'kind': self.kind,
+            'start': round(self.start, 6),
+            'duration': round(self.duration, 6),
+            'attributes': self.attributes,
+            'error': self.error
+        }
+
+
+# Текущий span задачи; asyncio.create_task копирует контекст, так что дочерние задачи наследуют трейс
+_current_span: ContextVar[Optional[Span]] = ContextVar('current_span', default=None)
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[tuple]:
+    """'00-<trace_id>-<span_id>-<flags>' -> (trace_id, span_id) for sampled traces"""
+    if not value:
+        return None
+    parts = value.strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        sampled = int(parts[3], 16) & 1
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    return (parts[1], parts[2]) if sampled else None
+
+
+def current_traceparent() -> Optional[str]:
+    """traceparent of the active span (None outside a trace)"""
+    current = _current_span.get()
+    return current.traceparent if current is not None else None
+
+
+def trace_headers() -> Dict[str, str]:
+    """Headers that carry the active trace to another service"""
+    current = _current_span.get()
+    return {TRACEPARENT_HEADER: current.traceparent} if current is not None else {}
+
+
+@contextmanager
+def _record(current: Span):
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = repr(e)
+        raise
+    finally:
+        current.duration = time.perf_counter() - current._started
+        _current_span.reset(token)
+        _exporter.export(current)
+
+
+@contextmanager
+def span(name: str, kind: str = SPAN_INTERNAL, **attributes):
+    """Child span of the active one; yields None (and records nothing) outside a trace"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    with _record(Span(parent.trace_id, parent.span_id, name, kind, attributes)) as current:
+        yield current
+
+
+@contextmanager
+def start_trace(name: str, traceparent: Optional[str] = None, kind: str = SPAN_SERVER, **attributes):
+    """
+    Root span of a new trace, or a span continuing `traceparent` from another service
+
+    Without a parent a trace is started only when export is enabled and the
+    request is sampled; otherwise yields None.
+    """
+    parent = parse_traceparent(traceparent)
+    if parent is not None:
+        trace_id, parent_id = parent
+    elif not _exporter.enabled or random.random() >= TRACE_SAMPLE_RATE:
+        yield None
+        return
+    else:
+        trace_id, parent_id = os.urandom(16).hex(), None
+    with _record(Span(trace_id, parent_id, name, kind, attributes)) as current:
+        yield current
+
+
+async def tracing_middleware(request, call_next):
+    """FastAPI/Starlette middleware: continue a trace from the traceparent header"""
+    traceparent = request.headers.get(TRACEPARENT_HEADER)
+    if parse_traceparent(traceparent) is None:
+        return await call_next(request)
+    with start_trace(f'{request.method} {request.url.path}', traceparent) as current:
+        response = await call_next(request)
+        # Имя по шаблону маршрута известно только после роутинга
+        route = getattr(request.scope.get('route'), 'path', None)
+        if route:
+            current.name = f'{request.method} {route}'
+        current.set('status', response.status_code)
+        return response
+
+
+class SpanExporter:
+    """Buffers finished spans of this process and ships them in batches"""
+
+    def __init__(self):
+        self.service = 'helpdesk'
+        self.mode = TRACE_EXPORT if TRACE_EXPORT in ('file', 'otlp') else ''
+        self._buffer: List[Span] = []
+        self._task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self.exported = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.mode)
+
+    def export(self, finished: Span):
+        if not self.enabled:
+            return
+        if len(self._buffer) >= TRACE_BUFFER_MAX:
+            # Экспорт не успевает (коллектор недоступен) - теряем спаны, а не память
+            self.dropped += 1
+            return
+        self._buffer.append(finished)
+
+    async def start(self, service: str):
+        self.service = service
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+            target = TRACE_FILE if self.mode == 'file' else TRACE_OTLP_ENDPOINT
+            logger.info(f"Tracing enabled for {service}: {self.mode} -> {target} (sample rate {TRACE_SAMPLE_RATE})")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(TRACE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning(f"Span export failed: {e}")
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        if self.mode == 'file':
+            lines = ''.join(json.dumps(item.to_dict(), ensure_ascii=False) + '\n' for item in batch)
+            await asyncio.to_thread(self._append, lines)
+        else:
+            if self._client is None:
+                self._client = httpx.AsyncClient(timeout=TRACE_EXPORT_TIMEOUT)
+            response = await self._client.post(f'{TRACE_OTLP_ENDPOINT}/v1/traces', json=self._otlp(batch))
+            response.raise_for_status()
+        self.exported += len(batch)
+
+    @staticmethod
+    def _append(lines: str):
+        # Одна запись в режиме append - строки разных процессов не перемешиваются
+        with open(TRACE_FILE, 'a', encoding='utf-8') as f:
+            f.write(lines)
+
+    def _otlp(self, batch: List[Span]) -> Dict:
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return {'key': key, 'value': {'boolValue': value}}
+            if isinstance(value, int):
+                return {'key': key, 'value': {'intValue': str(value)}}
+            if isinstance(value, float):
+                return {'key': key, 'value': {'doubleValue': value}}
+            return {'key': key, 'value': {'stringValue': str(value)}}
+
+        spans = []
+        for item in batch:
+            start_ns = int(item.start * 1e9)
+            otlp_span = {
+                'traceId': item.trace_id,
+                'spanId': item.span_id,
+                'name': item.name,
+                'kind': _OTLP_KINDS[item.kind],
+                'startTimeUnixNano': str(start_ns),
+                'endTimeUnixNano': str(start_ns + int(item.duration * 1e9)),
+                'attributes': [attribute(key, value) for key, value in item.attributes.items()],
+                'status': {'code': 2, 'message': item.error} if item.error else {'code': 1}
+            }
+            if item.parent_id:
+                otlp_span['parentSpanId'] = item.parent_id
+            spans.append(otlp_span)
+        return {'resourceSpans': [{
+            'resource': {'attributes': [attribute('service.name', self.service)]},
+            'scopeSpans': [{'scope': {'name': 'helpdesk.tracing'}, 'spans': spans}]
+        }]}
+
+    def stats(self) -> Dict:
+        return {
+            'mode': self.mode or 'off',
+            'buffered': len(self._buffer),
+            'exported': self.exported,
+            'dropped': self.dropped
+        }
+
+
+_exporter = SpanExporter()
+
+
+async def start_tracing(service: str):
+    """Start the background span exporter of this process (no-op when TRACE_EXPORT is unset)"""
+    await _exporter.start(service)
+
+
+async def stop_tracing():
+    """Flush buffered spans and stop the exporter"""
+    await _exporter.stop()
+
+
+def tracing_stats() -> Dict:
+    return _exporter.stats()
+
+
+# ---------------------------------------------------------------------------
+# CLI: водопады самых медленных трейсов из JSONL файла
+# ---------------------------------------------------------------------------
+
+WATERFALL_WIDTH = 40
+
+
+def load_traces(path: str, since: Optional[float] = None) -> Dict[str, List[Dict]]:
+    """Spans from a JSONL export grouped by trace id"""
+    traces: Dict[str, List[Dict]] = defaultdict(list)
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            if since is None or item['start'] >= since:
+                traces[item['trace_id']].append(item)
+    return traces
+
+
+def trace_bounds(spans: List[Dict]) -> tuple:
+    start = min(item['start'] for item in spans)
+    end = max(item['start'] + item['duration'] for item in spans)
+    return start, end
+
+
+def format_waterfall(trace_id: str, spans: List[Dict]) -> str:
+    """Spans of one trace as an indented tree with time bars"""
+    start, end = trace_bounds(spans)
+    total = max(end - start, 1e-6)
+    ids = {item['span_id'] for item in spans}
+    children: Dict[Optional[str], List[Dict]] = defaultdict(list)
+    for item in spans:
+        # Родитель из процесса без экспорта - показываем спан как корень
+        parent = item['parent_id'] if item['parent_id'] in ids else None
+        children[parent].append(item)
+
+    started_at = datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M:%S')
+    lines = [f"trace {trace_id}  {total:.3f}s  {len(spans)} spans  {started_at}"]
+
+    def walk(parent: Optional[str], depth: int):
+        for item in sorted(children.get(parent, []), key=lambda s: s['start']):
+            offset = item['start'] - start
+            left = int(offset / total * WATERFALL_WIDTH)
+            width = max(1, round(item['duration'] / total * WATERFALL_WIDTH))
+            bar = ' ' * left + '█' * min(width, WATERFALL_WIDTH - left)
+            label = ('  ' * depth + item['name'])[:48]
+            marker = ' !' if item.get('error') else ''
+            lines.append(
+                f"  {offset:8.3f}s {item['duration']:8.3f}s  {item['service'][:8]:<8} "
+                f"{label:<48} |{bar:<{WATERFALL_WIDTH}}|{marker}"
+            )
+            walk(item['span_id'], depth + 1)
+
+    walk(None, 0)
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Show the slowest request traces as waterfalls")
+    parser.add_argument('--file', default=TRACE_FILE, help="JSONL span export (TRACE_FILE)")
+    parser.add_argument('--slowest', type=int, default=10, help="Number of traces to show")
+    parser.add_argument('--since', type=float, help="Only traces started in the last N minutes")
+    parser.add_argument('--trace', help="Show one trace by id")
+    args = parser.parse_args(argv)
+
+    since = time.time() - args.since * 60 if args.since else None
+    try:
+        traces = load_traces(args.file, since)
+    except OSError as e:
+        print(f"Cannot read {args.file}: {e}", file=sys.stderr)
+        return 1
+
+    if args.trace:
+        if args.trace not in traces:
+            print(f"Trace {args.trace} not found in {args.file}", file=sys.stderr)
+            return 1
+        print(format_waterfall(args.trace, traces[args.trace]))
+        return 0
+
+    ranked = sorted(traces.items(), key=lambda kv: trace_bounds(kv[1])[1] - trace_bounds(kv[1])[0], reverse=True)
+    for trace_id, spans in ranked[:args.slowest]:
+        print(format_waterfall(trace_id, spans))
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
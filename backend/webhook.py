@@ -1,12 +1,24 @@
 import os
 import logging
-from fastapi import FastAPI
-from pydantic import BaseModel
+from typing import Dict, List, Optional
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Response
+from pydantic import BaseModel, Field
 from telegram import Bot
 from telegram.constants import ParseMode
 from telegram.request import HTTPXRequest
+from telegram.error import BadRequest
 from dotenv import load_dotenv
 
+from constants import (
+    OUTBOX_ACTION_SEND, OUTBOX_ACTION_EDIT, OUTBOX_STATUS_FAILED,
+    OUTBOX_MAX_IN_FLIGHT, OUTBOX_SEND_WAIT, OUTBOX_BATCH_MAX, DB_LEASE_BUDGET
+)
+from db_pool import InstrumentedPool, create_pool
+from telegram_outbox import Outbox, init_outbox_schema
+from metrics import REGISTRY, CONTENT_TYPE, http_metrics_middleware
+from tracing import tracing_middleware, start_tracing, stop_tracing
+
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -19,6 +31,8 @@ load_dotenv()
 # Конфигурация
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '3002'))
+# Другой адрес Bot API - локальный telegram-bot-api сервер или заглушка нагрузочного теста
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
 
 # Валидация конфигурации
 if not TELEGRAM_BOT_TOKEN:
@@ -26,38 +40,179 @@ if not TELEGRAM_BOT_TOKEN:
     logger.error("Please set TELEGRAM_BOT_TOKEN in backend/.env file")
     raise ValueError("TELEGRAM_BOT_TOKEN is required to run the webhook server")
 
-app = FastAPI(title="Telegram Webhook")
-
-# Создание бота с правильной конфигурацией httpx
+# Создание бота с правильной конфигурацией httpx (пул под параллельные отправки outbox)
 request = HTTPXRequest(
-    connection_pool_size=8,
+    connection_pool_size=OUTBOX_MAX_IN_FLIGHT,
     connect_timeout=10.0,
     read_timeout=10.0
 )
-bot = Bot(token=TELEGRAM_BOT_TOKEN, request=request)
+bot = Bot(token=TELEGRAM_BOT_TOKEN, base_url=TELEGRAM_API_URL, request=request)
+
+# Очередь исходящих сообщений (telegram_outbox)
+db_pool: Optional[InstrumentedPool] = None
+outbox: Optional[Outbox] = None
+
+
+async def send_outbox_item(item: Dict) -> int:
+    """Фактическая отправка сообщения из outbox в Bot API"""
+    if item['action'] == OUTBOX_ACTION_EDIT:
+        try:
+            await bot.edit_message_text(
+                chat_id=item['chat_id'],
+                message_id=item['message_id'],
+                text=item['text'],
+                parse_mode=item['parse_mode']
+            )
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
+        return item['message_id']
+
+    sent = await bot.send_message(
+        chat_id=item['chat_id'],
+        text=item['text'],
+        parse_mode=item['parse_mode']
+    )
+    return sent.message_id
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global db_pool, outbox
+    # Startup
+    await start_tracing('webhook')
+    db_pool = await create_pool(
+        lease_budget=float(os.getenv('DB_LEASE_BUDGET', str(DB_LEASE_BUDGET))),
+        user=os.getenv('DB_USER', 'postgres'),
+        password=os.getenv('DB_PASSWORD', 'postgres'),
+        database=os.getenv('DB_NAME', 'sulpak_helpdesk'),
+        host=os.getenv('DB_HOST', '127.0.0.1'),
+        port=int(os.getenv('DB_PORT', '5432')),
+        min_size=1,
+        max_size=5
+    )
+    async with db_pool.acquire('webhook.init') as conn:
+        await init_outbox_schema(conn)
+    outbox = Outbox(db_pool, send_outbox_item)
+    await outbox.start()
+    yield
+    # Shutdown
+    await outbox.stop()
+    await db_pool.close()
+    await stop_tracing()
+
+
+app = FastAPI(title="Telegram Webhook", lifespan=lifespan)
+app.middleware("http")(http_metrics_middleware)
+app.middleware("http")(tracing_middleware)
 
 
 class SendMessageRequest(BaseModel):
     telegramUserId: int
     message: str
     ticketNumber: str
+    partial: bool = False  # Промежуточный текст потоковой генерации
+    replaceOutboxId: Optional[int] = None  # outboxId прежней отправки, которую заменяет это сообщение
+
+
+class SendBatchRequest(BaseModel):
+    messages: List[SendMessageRequest] = Field(min_length=1, max_length=OUTBOX_BATCH_MAX)
+
+
+class EditMessageRequest(BaseModel):
+    telegramUserId: int
+    messageId: int
+    message: str
+    ticketNumber: str
+    partial: bool = False
+
+
+def format_ai_message(ticket_number: str, message: str, partial: bool):
+    """Текст и parse_mode сообщения AI; промежуточный текст без Markdown (разметка может быть незакрыта)"""
+    if partial:
+        return f"🤖 AI Ассистент ({ticket_number}):\n\n{message} ▌", None
+    return f"🤖 *AI Ассистент* ({ticket_number}):\n\n{message}", ParseMode.MARKDOWN
+
+
+def delivery_response(outbox_id: int, result: Optional[Dict]) -> Dict:
+    """
+    Ответ на send/edit: результат отправки, если она уложилась в OUTBOX_SEND_WAIT.
+    Иначе сообщение остается в очереди и будет доставлено с учетом лимитов Telegram.
+    """
+    if result is None:
+        return {"success": True, "queued": True, "outboxId": outbox_id}
+    if result['status'] == OUTBOX_STATUS_FAILED:
+        return {"success": False, "outboxId": outbox_id, "error": result['error']}
+    return {"success": True, "outboxId": outbox_id, "messageId": result['messageId']}
 
 
 @app.post("/webhook/send-message")
 async def send_message(request: SendMessageRequest):
-    """Отправить AI ответ клиенту в Telegram"""
+    """
+    Отправить AI ответ клиенту в Telegram (через outbox).
+    С replaceOutboxId заменяет прежнюю отправку: текст еще стоящего в очереди сообщения
+    подменяется, уже отправленное сообщение правится - клиент не получает дубль.
+    """
+    try:
+        text, parse_mode = format_ai_message(request.ticketNumber, request.message, request.partial)
+        if request.replaceOutboxId:
+            outbox_id = await outbox.replace(request.replaceOutboxId, request.telegramUserId, text, parse_mode)
+        else:
+            outbox_id = await outbox.enqueue(request.telegramUserId, OUTBOX_ACTION_SEND, text, parse_mode)
+        result = await outbox.wait(outbox_id, OUTBOX_SEND_WAIT)
+        return delivery_response(outbox_id, result)
+    except Exception as e:
+        logger.error(f"Error queueing message to client {request.telegramUserId}: {e}", exc_info=True)
+        return {"success": False, "error": str(e)}
+
+
+@app.post("/webhook/send-batch")
+async def send_batch(request: SendBatchRequest):
+    """Поставить несколько сообщений в очередь одним запросом (без ожидания отправки)"""
+    items = []
+    for msg in request.messages:
+        text, parse_mode = format_ai_message(msg.ticketNumber, msg.message, msg.partial)
+        items.append({
+            'chat_id': msg.telegramUserId,
+            'action': OUTBOX_ACTION_SEND,
+            'text': text,
+            'parse_mode': parse_mode
+        })
     try:
-        await bot.send_message(
-            chat_id=request.telegramUserId,
-            text=f"🤖 *AI Ассистент* ({request.ticketNumber}):\n\n{request.message}",
-            parse_mode=ParseMode.MARKDOWN
+        ids = await outbox.enqueue_many(items)
+    except Exception as e:
+        logger.error(f"Error queueing batch of {len(items)} messages: {e}", exc_info=True)
+        raise HTTPException(status_code=503, detail="Outbox unavailable")
+    return {"success": True, "outboxIds": ids}
+
+
+@app.post("/webhook/edit-message")
+async def edit_message(request: EditMessageRequest):
+    """Обновить ранее отправленный AI ответ (потоковая генерация); правки одного сообщения в очереди схлопываются"""
+    try:
+        text, parse_mode = format_ai_message(request.ticketNumber, request.message, request.partial)
+        outbox_id = await outbox.enqueue(
+            request.telegramUserId, OUTBOX_ACTION_EDIT, text, parse_mode, message_id=request.messageId
         )
-        return {"success": True}
+        result = await outbox.wait(outbox_id, OUTBOX_SEND_WAIT)
+        return delivery_response(outbox_id, result)
     except Exception as e:
-        logger.error(f"Error sending message to client {request.telegramUserId}: {e}", exc_info=True)
+        logger.error(f"Error queueing edit of message {request.messageId} for client {request.telegramUserId}: {e}", exc_info=True)
         return {"success": False, "error": str(e)}
 
 
+@app.get("/webhook/outbox/stats")
+async def outbox_stats():
+    """Глубина очереди, счетчики доставки, 429 и задержка отправки"""
+    return await outbox.stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики процесса в текстовом формате Prometheus"""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
 @app.get("/health")
 async def health():
     """Health check"""
@@ -1,6 +1,8 @@
-import { useState, useEffect } from 'react'
+import { useState, useEffect, useRef } from 'react'
 
 const BACKEND_URL = 'http://localhost:3001'
+const TICKETS_PAGE_SIZE = 100
+const TICKETS_REFRESH_THROTTLE = 1000 // Не чаще одного запроса списка в секунду на поток событий
 
 // Status configurations - functional style
 const STATUS_CONFIG = {
@@ -16,27 +18,141 @@ function App() {
   const [selectedTicket, setSelectedTicket] = useState(null)
   const [messages, setMessages] = useState([])
   const [loading, setLoading] = useState(true)
+  const [nextCursor, setNextCursor] = useState(null)
+  const [loadingMore, setLoadingMore] = useState(false)
   const [filter, setFilter] = useState('all') // all, escalated, ai_processing
 
+  // Актуальные значения для обработчиков событий EventSource
+  const filterRef = useRef(filter)
+  const selectedTicketRef = useRef(selectedTicket)
+  const lastMessageIdRef = useRef(0)
+  // Догружены ли страницы после первой: обновление первой страницы их не сбрасывает
+  const olderLoadedRef = useRef(false)
+  const refreshTimerRef = useRef(null)
+  filterRef.current = filter
+  selectedTicketRef.current = selectedTicket
+
   useEffect(() => {
-    fetchTickets()
-    const interval = setInterval(fetchTickets, 5000)
-    return () => clearInterval(interval)
-  }, [])
+    fetchTickets(true)
+  }, [filter])
 
+  // Только смена тикета: обновление полей открытого тикета сообщения не перечитывает
   useEffect(() => {
     if (selectedTicket) {
       fetchMessages(selectedTicket.id)
-      const interval = setInterval(() => fetchMessages(selectedTicket.id), 3000)
-      return () => clearInterval(interval)
     }
-  }, [selectedTicket])
+  }, [selectedTicket?.id])
+
+  // Live обновления вместо опроса: сервер пушит события, EventSource сам переподключается
+  // и передает Last-Event-ID, поэтому пропущенные события досылаются сервером (или приходит resync)
+  useEffect(() => {
+    const source = new EventSource(`${BACKEND_URL}/api/v1/events/stream`)
+
+    // Изменения применяются из данных события; список запрашивается заново, только когда
+    // тикет появляется в нем или выпадает из него, и не чаще раза в TICKETS_REFRESH_THROTTLE.
+    // Открытый тикет перечитывается целиком: эскалация меняет ai_summary и escalated_at,
+    // которых нет в событии
+    const onTicketEvent = (event) => {
+      const { ticketId, data } = JSON.parse(event.data)
+      const filter = filterRef.current
+      const isSelected = selectedTicketRef.current?.id === ticketId
+
+      if (event.type === 'ticket_created') {
+        if (filter === 'all' || data.status === filter) scheduleTicketsRefresh()
+      } else if (event.type === 'status_changed') {
+        if (filter !== 'all' && data.previousStatus === filter) {
+          setTickets(prev => prev.filter(ticket => ticket.id !== ticketId))
+        } else if (filter !== 'all' && data.status === filter) {
+          scheduleTicketsRefresh()
+        } else {
+          patchTicket(ticketId, () => ({ status: data.status }))
+        }
+      } else if (event.type === 'message_added') {
+        patchTicket(ticketId, (ticket) => ({
+          message_count: (ticket.message_count || 0) + 1,
+          last_sender_type: data.senderType
+        }))
+        if (isSelected) {
+          fetchNewMessages(ticketId)
+        }
+      }
+
+      if (isSelected && event.type !== 'ticket_created') {
+        fetchSelectedTicket(ticketId)
+      }
+    }
 
-  const fetchTickets = async () => {
+    source.addEventListener('ticket_created', onTicketEvent)
+    source.addEventListener('message_added', onTicketEvent)
+    source.addEventListener('status_changed', onTicketEvent)
+    // Пропущенные события не восстановить точно - перечитываем список и открытый тикет
+    source.addEventListener('resync', () => {
+      fetchTickets(true)
+      if (selectedTicketRef.current) {
+        fetchMessages(selectedTicketRef.current.id)
+        fetchSelectedTicket(selectedTicketRef.current.id)
+      }
+    })
+    return () => {
+      source.close()
+      clearTimeout(refreshTimerRef.current)
+    }
+  }, [])
+
+  // Серия событий за секунду - один запрос первой страницы
+  const scheduleTicketsRefresh = () => {
+    if (refreshTimerRef.current) return
+    refreshTimerRef.current = setTimeout(() => {
+      refreshTimerRef.current = null
+      fetchTickets()
+    }, TICKETS_REFRESH_THROTTLE)
+  }
+
+  const patchTicket = (ticketId, patch) => {
+    setTickets(prev => prev.map(ticket => (ticket.id === ticketId ? { ...ticket, ...patch(ticket) } : ticket)))
+    setSelectedTicket(prev => (prev?.id === ticketId ? { ...prev, ...patch(prev) } : prev))
+  }
+
+  // Свежие поля открытого тикета (статус, ai_summary, escalated_at) без списка сообщений
+  const fetchSelectedTicket = async (ticketId) => {
     try {
-      const response = await fetch(`${BACKEND_URL}/api/v1/tickets`)
+      const response = await fetch(`${BACKEND_URL}/api/v1/tickets/${ticketId}?limit=1`)
       const data = await response.json()
-      setTickets(data)
+      if (!data.ticket) return
+      setSelectedTicket(prev => (prev?.id === ticketId ? { ...prev, ...data.ticket } : prev))
+      setTickets(prev => prev.map(ticket => (ticket.id === ticketId ? { ...ticket, ...data.ticket } : ticket)))
+    } catch (error) {
+      console.error('Error fetching ticket:', error)
+    }
+  }
+
+  const fetchTicketsPage = async (cursor) => {
+    // Фильтр по статусу и лимит применяются на сервере
+    const params = new URLSearchParams({ limit: TICKETS_PAGE_SIZE })
+    if (filterRef.current !== 'all') params.append('status', filterRef.current)
+    if (cursor) params.append('cursor', cursor)
+    const response = await fetch(`${BACKEND_URL}/api/v1/tickets?${params}`)
+    return response.json()
+  }
+
+  // Первая страница; reset - заново (смена фильтра), иначе догруженные старые тикеты остаются
+  const fetchTickets = async (reset = false) => {
+    try {
+      const data = await fetchTicketsPage(null)
+      const fresh = data.items || []
+      if (reset || !olderLoadedRef.current) {
+        olderLoadedRef.current = false
+        setTickets(fresh)
+        setNextCursor(data.nextCursor)
+      } else {
+        // Список отсортирован по created_at: старше последнего тикета первой страницы - из догруженных
+        const boundary = fresh.length ? fresh[fresh.length - 1].created_at : null
+        const freshIds = new Set(fresh.map(t => t.id))
+        setTickets(prev => [
+          ...fresh,
+          ...prev.filter(t => !freshIds.has(t.id) && (boundary === null || t.created_at < boundary))
+        ])
+      }
       setLoading(false)
     } catch (error) {
       console.error('Error fetching tickets:', error)
@@ -44,16 +160,52 @@ function App() {
     }
   }
 
+  // Следующая страница по nextCursor
+  const loadMoreTickets = async () => {
+    if (!nextCursor || loadingMore) return
+    setLoadingMore(true)
+    const requestedFilter = filterRef.current
+    try {
+      const data = await fetchTicketsPage(nextCursor)
+      if (filterRef.current !== requestedFilter) return
+      olderLoadedRef.current = true
+      setTickets(prev => {
+        const ids = new Set(prev.map(t => t.id))
+        return [...prev, ...(data.items || []).filter(t => !ids.has(t.id))]
+      })
+      setNextCursor(data.nextCursor)
+    } catch (error) {
+      console.error('Error loading more tickets:', error)
+    } finally {
+      setLoadingMore(false)
+    }
+  }
+
   const fetchMessages = async (ticketId) => {
     try {
       const response = await fetch(`${BACKEND_URL}/api/v1/tickets/${ticketId}`)
       const data = await response.json()
-      setMessages(data.messages || [])
+      const loaded = data.messages || []
+      lastMessageIdRef.current = loaded.reduce((max, m) => Math.max(max, m.id), 0)
+      setMessages(loaded)
     } catch (error) {
       console.error('Error fetching messages:', error)
     }
   }
 
+  // Догрузка только новых сообщений открытого тикета
+  const fetchNewMessages = async (ticketId) => {
+    try {
+      const response = await fetch(`${BACKEND_URL}/api/v1/tickets/${ticketId}/messages?after_id=${lastMessageIdRef.current}`)
+      const data = await response.json()
+      if (selectedTicketRef.current?.id !== ticketId || !data.messages?.length) return
+      lastMessageIdRef.current = data.lastId
+      setMessages(prev => [...prev, ...data.messages.filter(m => !prev.some(p => p.id === m.id))])
+    } catch (error) {
+      console.error('Error fetching new messages:', error)
+    }
+  }
+
   const formatTime = (timestamp) => {
     if (!timestamp) return '--:--'
     const date = new Date(timestamp)
@@ -66,11 +218,7 @@ function App() {
     return `${String(date.getDate()).padStart(2, '0')}.${String(date.getMonth() + 1).padStart(2, '0')}.${date.getFullYear()}`
   }
 
-  const filteredTickets = tickets.filter(ticket => {
-    if (filter === 'escalated') return ticket.status === 'escalated'
-    if (filter === 'ai_processing') return ticket.status === 'ai_processing'
-    return true
-  })
+  const filteredTickets = tickets
 
   const getTicketPreview = (ticket) => {
     return ticket.first_message?.substring(0, 60) || 'Без сообщения'
@@ -108,7 +256,7 @@ function App() {
             <div className="w-1.5 h-1.5 bg-[#9ece6a] rounded-full"></div>
             ONLINE
           </div>
-          <span className="text-[#565f89]">{tickets.length} tickets</span>
+          <span className="text-[#565f89]">{tickets.length}{nextCursor ? '+' : ''} tickets</span>
           <span className="text-[#3b4261]">{new Date().toLocaleTimeString('ru-RU')}</span>
         </div>
       </header>
@@ -171,6 +319,15 @@ function App() {
                 </div>
               ))
             )}
+            {!loading && nextCursor && (
+              <button
+                onClick={loadMoreTickets}
+                disabled={loadingMore}
+                className="w-full px-2.5 py-2 text-[11px] text-[#7aa2f7] hover:bg-[#7aa2f7]/4 disabled:text-[#565f89]"
+              >
+                {loadingMore ? 'Загрузка...' : 'Загрузить еще'}
+              </button>
+            )}
           </div>
         </div>
 